@@ -0,0 +1,174 @@
+# --- ClinicalTrialsIndexer.py ---
+# Builds the local ClinicalTrials.gov store used by OncoVarAgent's `query_clinical_trials`
+# tool (CLINICAL_TRIALS_LOCAL_DB). Loads a bulk JSON export (the zip of per-study files,
+# saved API v2 /studies pages, or JSON Lines; optionally .gz) into a SQLite database with
+# filter columns for status and study type (the filters `query_clinical_trials` applies)
+# and an FTS5 index over interventions, conditions and free text.
+#
+# Bulk export: https://clinicaltrials.gov/api/int/studies/download?format=json.zip
+
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import time
+import zipfile
+
+# Study records keep only the fields `query_clinical_trials` returns (its `fields` projection),
+# so a local answer has exactly the shape of a live API answer.
+RECORD_FIELDS = [
+    ("identificationModule", "nctId"),
+    ("identificationModule", "briefTitle"),
+    ("descriptionModule", "briefSummary"),
+    ("designModule", "studyType"),
+    ("designModule", "phases"),
+    ("statusModule", "overallStatus"),
+    ("conditionsModule", "conditions"),
+    ("armsAndInterventionsModule", "interventions"),
+    ("eligibilityModule", "eligibilityCriteria"),
+]
+
+# `studies_fts` is an external-content FTS5 index over the text columns of `studies`; the
+# triggers keep it in sync on insert/update/delete.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    rowid INTEGER PRIMARY KEY,
+    nct_id TEXT UNIQUE NOT NULL,
+    overall_status TEXT,
+    study_type TEXT,
+    interventions TEXT,
+    conditions TEXT,
+    other_terms TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS studies_filters ON studies(overall_status, study_type);
+CREATE VIRTUAL TABLE IF NOT EXISTS studies_fts USING fts5(
+    interventions, conditions, other_terms, content='studies', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS studies_ai AFTER INSERT ON studies BEGIN
+    INSERT INTO studies_fts(rowid, interventions, conditions, other_terms) VALUES (new.rowid, new.interventions, new.conditions, new.other_terms);
+END;
+CREATE TRIGGER IF NOT EXISTS studies_ad AFTER DELETE ON studies BEGIN
+    INSERT INTO studies_fts(studies_fts, rowid, interventions, conditions, other_terms) VALUES ('delete', old.rowid, old.interventions, old.conditions, old.other_terms);
+END;
+CREATE TRIGGER IF NOT EXISTS studies_au AFTER UPDATE ON studies BEGIN
+    INSERT INTO studies_fts(studies_fts, rowid, interventions, conditions, other_terms) VALUES ('delete', old.rowid, old.interventions, old.conditions, old.other_terms);
+    INSERT INTO studies_fts(rowid, interventions, conditions, other_terms) VALUES (new.rowid, new.interventions, new.conditions, new.other_terms);
+END;
+"""
+
+UPSERT_SQL = """
+INSERT INTO studies (nct_id, overall_status, study_type, interventions, conditions, other_terms, record)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(nct_id) DO UPDATE SET overall_status = excluded.overall_status, study_type = excluded.study_type,
+    interventions = excluded.interventions, conditions = excluded.conditions, other_terms = excluded.other_terms,
+    record = excluded.record
+"""
+
+COMMIT_EVERY = 10000
+
+
+def open_store(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _load_json(raw: bytes) -> list:
+    """Returns the study records in one JSON document: a single study or an API page with `studies`."""
+    data = json.loads(raw)
+    if isinstance(data, dict) and "studies" in data:
+        return data["studies"]
+    return data if isinstance(data, list) else [data]
+
+
+def iter_studies(path: str):
+    """Yields raw study records from a zip export, a directory, a JSON/JSON Lines file or its .gz."""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".json", ".json.gz", ".jsonl", ".ndjson")):
+                yield from iter_studies(os.path.join(path, name))
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith(".json"):
+                    yield from _load_json(archive.read(name))
+    else:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            if path.removesuffix(".gz").endswith((".jsonl", ".ndjson")):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield from _load_json(f.read())
+
+
+def parse_study(study: dict) -> tuple | None:
+    """Maps a study record onto the `studies` columns; None when it has no NCT ID."""
+    proto = study.get("protocolSection", {})
+    record = {}
+    for module, field in RECORD_FIELDS:
+        value = proto.get(module, {}).get(field)
+        if value is not None:
+            record.setdefault(module, {})[field] = value
+    nct_id = record.get("identificationModule", {}).get("nctId")
+    if not nct_id:
+        return None
+    interventions = proto.get("armsAndInterventionsModule", {}).get("interventions") or []
+    intervention_text = " ".join(
+        " ".join([i.get("name") or ""] + (i.get("otherNames") or [])) for i in interventions
+    )
+    conditions = proto.get("conditionsModule", {})
+    condition_text = " ".join((conditions.get("conditions") or []) + (conditions.get("keywords") or []))
+    other_text = " ".join(filter(None, [
+        proto.get("identificationModule", {}).get("briefTitle"),
+        proto.get("identificationModule", {}).get("officialTitle"),
+        proto.get("descriptionModule", {}).get("briefSummary"),
+    ]))
+    design = proto.get("designModule", {})
+    return (
+        nct_id,
+        proto.get("statusModule", {}).get("overallStatus"),
+        (design.get("studyType") or "").upper() or None,
+        intervention_text,
+        condition_text,
+        other_text,
+        json.dumps({"protocolSection": record}, ensure_ascii=False),
+    )
+
+
+def ingest_file(conn: sqlite3.Connection, path: str) -> int:
+    """Streams one export into the store; returns the number of studies upserted."""
+    upserted = 0
+    for study in iter_studies(path):
+        row = parse_study(study)
+        if row is None:
+            continue
+        conn.execute(UPSERT_SQL, row)
+        upserted += 1
+        if upserted % COMMIT_EVERY == 0:
+            conn.commit()
+    conn.commit()
+    return upserted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the local ClinicalTrials.gov store for OncoVarAgent.")
+    parser.add_argument("exports", nargs="+", help="Bulk export zip files, directories, or .json/.jsonl files (optionally .gz), applied in order.")
+    parser.add_argument("--db", type=str, default="clinical_trials_local.sqlite", help="SQLite database to create or update.")
+    parser.add_argument("--optimize", action="store_true", help="Merge the FTS5 index segments after loading.")
+    args = parser.parse_args()
+
+    conn = open_store(args.db)
+    for export in args.exports:
+        start = time.time()
+        upserted = ingest_file(conn, export)
+        print(f"---{export}: {upserted} studies upserted in {time.time() - start:.1f}s---")
+    if args.optimize:
+        conn.execute("INSERT INTO studies_fts(studies_fts) VALUES ('optimize')")
+        conn.commit()
+    conn.close()
+    print(f"--- ✅ Local ClinicalTrials.gov store ready at '{args.db}' ---")
@@ -3,11 +3,13 @@
 
 import os
 import sys
+import asyncio
 import json
 from dotenv import load_dotenv
-from typing import TypedDict, List, Dict, Any, Annotated, Sequence,Callable 
+from typing import TypedDict, List, Dict, Any, Annotated, Sequence, Iterator, AsyncIterator,Callable 
 import operator
 import argparse
+import numpy as np
 import pandas as pd
 import subprocess
 import tempfile
@@ -15,15 +17,30 @@ import re
 import requests
 import xml.etree.ElementTree as ET
 import time
+import hashlib
+import sqlite3
+import threading
+import weakref
+import httpx
+from collections import OrderedDict
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+
+try:
+    import fcntl # POSIX-only; used for the optional cross-process NCBI rate limit
+except ImportError:
+    fcntl = None
 
 # --- LangChain & LangGraph Imports ---
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.tools import tool
-from langchain_core.messages import BaseMessage, ToolMessage
+from langchain_core.tools import tool, StructuredTool
+from langchain_core.messages import BaseMessage, ToolMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages # Helper for state
 from langgraph.prebuilt import ToolNode # Prebuilt tool calling node
+from langgraph.types import Send # Map step for per-variant fan-out
 from langchain_core.runnables import RunnableConfig,RunnableLambda
 
 
@@ -58,30 +75,541 @@ ONCOKB_TO_AMP_MAPPING = {"1":{"tier":"Tier I","level":"A"},"2":{"tier":"Tier I",
 LEVEL_PRECEDENCE = ['1','2','R1','3A','3B','R2','4']
 
 def add_amp_tier_to_df(df: pd.DataFrame) -> pd.DataFrame:
-    def process_row(row):
-        drug_info_list, tier = [], None
-        for key in LEVEL_PRECEDENCE:
-            col = f'LEVEL_{key}'
-            if col in row.index and pd.notna(row[col]):
-                drugs, mapping = str(row[col]), ONCOKB_TO_AMP_MAPPING.get(key)
-                if not mapping: continue
-                if tier is None: tier = mapping['tier']
-                status = "resistance" if 'R' in key else "sensitive"
-                for drug in [d.strip() for d in drugs.split(',') if d.strip()]:
-                    drug_info_list.append(f"{drug}({status}, Level {mapping['level']} Evidence)")
-        if tier is None:
-            oncogenic_status = row.get('ONCOGENIC')
-            if oncogenic_status in ['Oncogenic', 'Likely Oncogenic']:
-                tier = "Tier II"
-            elif oncogenic_status in ['Likely Neutral', 'Neutral']:
-                tier = "Tier IV"
-            else:
-                tier = "Tier III"
-        drugs_str = "; ".join(drug_info_list) or "N/A"
-        return pd.Series([tier, drugs_str])
-    df[['AMP_TIER', 'Drugs']] = df.apply(process_row, axis=1)
+    # Column-wise over LEVEL_PRECEDENCE: the tier comes from the first level column with a value, and the
+    # drugs of all level columns are joined per row in precedence order.
+    n = len(df)
+    levels = [(key, f'LEVEL_{key}') for key in LEVEL_PRECEDENCE if f'LEVEL_{key}' in df.columns]
+    oncogenic = df['ONCOGENIC'] if 'ONCOGENIC' in df.columns else pd.Series(None, index=df.index, dtype=object)
+    tier = np.select(
+        [oncogenic.isin(['Oncogenic', 'Likely Oncogenic']).to_numpy(), oncogenic.isin(['Likely Neutral', 'Neutral']).to_numpy()],
+        ["Tier II", "Tier IV"], default="Tier III").astype(object)
+    if levels:
+        tier = np.select([df[col].notna().to_numpy() for _, col in levels],
+                         [ONCOKB_TO_AMP_MAPPING[key]['tier'] for key, _ in levels], default=tier)
+    drug_parts = []
+    for key, col in levels:
+        mapping = ONCOKB_TO_AMP_MAPPING[key]
+        status = "resistance" if 'R' in key else "sensitive"
+        drugs = pd.Series(df[col].to_numpy(), index=np.arange(n)).dropna().astype(str).str.split(',').explode().str.strip()
+        drugs = drugs[drugs.notna() & (drugs != '')]
+        drug_parts.append(drugs + f"({status}, Level {mapping['level']} Evidence)")
+    drugs_str = np.full(n, "N/A", dtype=object)
+    if drug_parts:
+        joined = pd.concat(drug_parts).groupby(level=0, sort=False).agg("; ".join)
+        drugs_str[joined.index.to_numpy()] = joined.to_numpy()
+    df['AMP_TIER'] = tier
+    df['Drugs'] = drugs_str
     return df
 
+# Persistent caches live in a per-user cache directory rather than wherever the agent is started from
+CACHE_DIR = os.getenv("ONCOVARAGENT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "oncovaragent"))
+
+def connect_cache_db(cache_path: str) -> sqlite3.Connection:
+    """Opens a cache database, creating its directory on first use."""
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    return sqlite3.connect(cache_path, timeout=30)
+
+# --- Deep Research Cache ---
+# Finished ReAct investigations are stored in SQLite so a repeat analysis of the same
+# variant/cancer pair (with the same model and task prompt) skips the research phase.
+RESEARCH_CACHE_PATH = os.getenv("RESEARCH_CACHE_PATH", os.path.join(CACHE_DIR, "research_cache.sqlite"))
+RESEARCH_CACHE_TTL_DAYS = float(os.getenv("RESEARCH_CACHE_TTL_DAYS", "30"))
+
+def research_cache_key(variant: Dict[str, Any], cancer_type: str, model_name: str, task: str) -> str:
+    """Content address of a research run: variant, cancer type, model and a hash of the task prompt."""
+    task_hash = hashlib.sha256(task.encode("utf-8")).hexdigest()
+    key_parts = [variant.get('Hugo_Symbol'), variant.get('HGVSp_Short'), cancer_type, model_name, task_hash]
+    return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+def _open_research_cache(cache_path: str) -> sqlite3.Connection:
+    conn = connect_cache_db(cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS research_cache ("
+        "cache_key TEXT PRIMARY KEY, gene TEXT, protein_change TEXT, cancer_type TEXT, model_name TEXT, "
+        "created_at REAL, payload TEXT)"
+    )
+    return conn
+
+def load_cached_research(cache_path: str, cache_key: str, ttl_days: float) -> Dict[str, Any] | None:
+    """Returns the cached deep_research_node output, or None on a miss or an expired entry."""
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+    try:
+        conn = _open_research_cache(cache_path)
+        try:
+            row = conn.execute("SELECT created_at, payload FROM research_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"  - WARNING: Research cache lookup failed: {e}")
+        return None
+    if row is None or (ttl_days > 0 and time.time() - row[0] > ttl_days * 86400):
+        return None
+    return json.loads(row[1])
+
+def tool_call_succeeded(content: Any) -> bool:
+    """A tool output counts as a success when it is a JSON result without an error status."""
+    try:
+        output = json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        return False  # "CRITICAL ERROR: ..." strings and ToolNode's "Error: ..." messages
+    return isinstance(output, dict) and output.get("status") != "error"
+
+def store_cached_research(cache_path: str, cache_key: str, variant: Dict[str, Any], cancer_type: str, model_name: str, result: Dict[str, Any]) -> None:
+    """Saves a deep_research_node output (evidence summary plus curated articles/trials)."""
+    if not cache_path:
+        return
+    try:
+        conn = _open_research_cache(cache_path)
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO research_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cache_key, variant.get('Hugo_Symbol'), variant.get('HGVSp_Short'), cancer_type, model_name,
+                     time.time(), json.dumps(result, ensure_ascii=False))
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"  - WARNING: Could not write research cache: {e}")
+
+# --- Shared HTTP Session ---
+# One keep-alive connection pool for every PubMed and ClinicalTrials.gov request, with
+# retry/backoff on throttling and server errors and a (connect, read) timeout per host.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRY_TOTAL = 3
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_STATUS_FORCELIST = [429, 500, 502, 503, 504]
+HTTP_TIMEOUTS = {
+    "eutils.ncbi.nlm.nih.gov": (5, 30),
+    "clinicaltrials.gov": (5, 30),
+}
+HTTP_DEFAULT_TIMEOUT = (5, 60)
+
+def _build_http_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=HTTP_RETRY_TOTAL,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUS_FORCELIST,
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,  # Hand the last response back so raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, pool_block=True, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+HTTP_SESSION = _build_http_session()
+_http_request_counts: Dict[str, Dict[str, int]] = {}
+_http_stats_lock = threading.Lock()
+
+def http_get(url: str, params: Dict[str, Any] | None = None, stream: bool = False) -> requests.Response:
+    """GET through the shared session, using the timeout configured for the target host."""
+    host = urlparse(url).hostname or ""
+    with _http_stats_lock:
+        counts = _http_request_counts.setdefault(host, {"requests": 0, "errors": 0})
+        counts["requests"] += 1
+    try:
+        return HTTP_SESSION.get(url, params=params, timeout=HTTP_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT), stream=stream)
+    except requests.exceptions.RequestException:
+        with _http_stats_lock:
+            counts["errors"] += 1
+        raise
+
+def get_http_pool_stats() -> Dict[str, Dict[str, int]]:
+    """Per-host request counts plus connection pool usage (connections opened vs. requests served)."""
+    with _http_stats_lock:
+        stats = {host: dict(counts) for host, counts in _http_request_counts.items()}
+    for adapter in {id(a): a for a in HTTP_SESSION.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, {"requests": 0, "errors": 0})
+            host_stats["connections_opened"] = host_stats.get("connections_opened", 0) + pool.num_connections
+            host_stats["pool_requests"] = host_stats.get("pool_requests", 0) + pool.num_requests
+    return stats
+
+# Async counterpart for the Streamlit event loop: a pooled httpx client per running loop
+# (each analysis runs in a fresh loop), with the same timeouts, retry policy and counters.
+_async_http_clients = weakref.WeakKeyDictionary()
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+        transport = httpx.AsyncHTTPTransport(retries=HTTP_RETRY_TOTAL, limits=limits) # retries cover connect errors only
+        client = httpx.AsyncClient(transport=transport, follow_redirects=True)
+        _async_http_clients[loop] = client
+    return client
+
+async def aclose_http_clients() -> None:
+    """Closes the running loop's pooled client; await it before the loop ends, e.g. at the end of an asyncio.run."""
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    retry_after = response.headers.get("Retry-After", "")
+    return float(retry_after) if retry_after.isdigit() else HTTP_RETRY_BACKOFF * (2 ** attempt)
+
+async def ahttp_get(url: str, params: Dict[str, Any] | None = None, stream: bool = False) -> httpx.Response:
+    """Non-blocking GET with per-host timeouts and backoff on 429/5xx. Streamed responses must be closed by the caller."""
+    host = urlparse(url).hostname or ""
+    connect_timeout, read_timeout = HTTP_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+    with _http_stats_lock:
+        counts = _http_request_counts.setdefault(host, {"requests": 0, "errors": 0})
+        counts["requests"] += 1
+    client = _get_async_http_client()
+    request = client.build_request("GET", url, params=params, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+    try:
+        for attempt in range(HTTP_RETRY_TOTAL + 1):
+            response = await client.send(request, stream=stream)
+            if response.status_code not in HTTP_RETRY_STATUS_FORCELIST or attempt == HTTP_RETRY_TOTAL:
+                return response
+            await response.aclose()
+            await asyncio.sleep(_retry_delay(response, attempt))
+    except httpx.HTTPError:
+        with _http_stats_lock:
+            counts["errors"] += 1
+        raise
+
+# --- NCBI E-utilities Rate Limiting ---
+# NCBI allows 3 requests/second per client, or 10/second with an API key. The token bucket
+# holds a single token, so requests are spaced at least 1/rate seconds apart and never burst
+# above the limit; set NCBI_RATE_LIMIT_FILE to share the bucket between processes through a
+# locked state file (POSIX only).
+NCBI_API_KEY = os.getenv("NCBI_API_KEY")
+NCBI_REQUESTS_PER_SECOND = 10 if NCBI_API_KEY else 3
+NCBI_RATE_LIMIT_FILE = os.getenv("NCBI_RATE_LIMIT_FILE")
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None, state_file: str | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.state_file = state_file if fcntl is not None else None
+        if state_file and self.state_file is None:
+            print("WARNING: File locking is unavailable on this platform; NCBI rate limit is per-process only.")
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float, updated: float) -> tuple:
+        """Refills the bucket up to now and tries to take one token; returns (tokens, updated, wait_seconds)."""
+        now = time.time()
+        tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def _take_shared(self) -> float:
+        with open(self.state_file, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    tokens, updated = (float(v) for v in f.read().split())
+                except ValueError:
+                    tokens, updated = self.capacity, time.time()
+                tokens, updated, wait = self._take(tokens, updated)
+                f.seek(0)
+                f.truncate()
+                f.write(f"{tokens} {updated}")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def _try_acquire(self) -> float:
+        """Takes a token if one is available; otherwise returns the seconds to wait before retrying."""
+        with self._lock:
+            if self.state_file:
+                return self._take_shared()
+            self._tokens, self._updated, wait = self._take(self._tokens, self._updated)
+            return wait
+
+    def acquire(self) -> None:
+        """Blocks until a token is available."""
+        while (wait := self._try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Waits for a token without blocking the event loop."""
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+NCBI_RATE_LIMITER = TokenBucket(NCBI_REQUESTS_PER_SECOND, capacity=1, state_file=NCBI_RATE_LIMIT_FILE)
+
+def ncbi_get(endpoint: str, params: Dict[str, Any], stream: bool = False) -> requests.Response:
+    """Rate-limited E-utilities GET; adds NCBI_API_KEY to the query when configured."""
+    if NCBI_API_KEY:
+        params = {**params, "api_key": NCBI_API_KEY}
+    NCBI_RATE_LIMITER.acquire()
+    return http_get(f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/{endpoint}", params=params, stream=stream)
+
+async def ancbi_get(endpoint: str, params: Dict[str, Any], stream: bool = False) -> httpx.Response:
+    """Async ncbi_get: waits for the shared token bucket without blocking the event loop."""
+    if NCBI_API_KEY:
+        params = {**params, "api_key": NCBI_API_KEY}
+    await NCBI_RATE_LIMITER.acquire_async()
+    return await ahttp_get(f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/{endpoint}", params=params, stream=stream)
+
+def _pubmed_article_from_elem(elem: ET.Element) -> Dict[str, Any]:
+    title = elem.find("MedlineCitation/Article/ArticleTitle")
+    abstract = "\n".join("".join(e.itertext()) for e in elem.iterfind("MedlineCitation/Article/Abstract/AbstractText"))
+    return {
+        "title": "".join(title.itertext()) if title is not None else "No Title Available",
+        "abstract": abstract or "No Abstract Available",
+        "support_literatures": elem.findtext("MedlineCitation/PMID", "N/A"),
+    }
+
+def iter_pubmed_articles(xml_stream) -> Iterator[Dict[str, Any]]:
+    """Incrementally parses an efetch XML stream, yielding one article dict per completed <PubmedArticle>."""
+    context = ET.iterparse(xml_stream, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end" or elem.tag != "PubmedArticle":
+            continue
+        yield _pubmed_article_from_elem(elem)
+        # Release the finished article (and anything before it) so the tree never grows
+        root.clear()
+
+async def aiter_pubmed_articles(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """Async iter_pubmed_articles: feeds a streamed httpx response into a pull parser chunk by chunk."""
+    parser, root = ET.XMLPullParser(events=("start", "end")), None
+    async for chunk in response.aiter_bytes():
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if root is None:
+                root = elem
+            if event == "end" and elem.tag == "PubmedArticle":
+                yield _pubmed_article_from_elem(elem)
+                root.clear()
+    parser.close()
+
+# --- Local PubMed Store ---
+# Optional SQLite FTS5 abstract store built by PubMedIndexer.py. PUBMED_BACKEND selects
+# 'remote' (E-utilities only), 'hybrid' (local store first, E-utilities only on a miss)
+# or 'local' (offline, never touches the network).
+PUBMED_LOCAL_DB = os.getenv("PUBMED_LOCAL_DB")
+PUBMED_BACKEND = os.getenv("PUBMED_BACKEND", "hybrid" if PUBMED_LOCAL_DB else "remote").lower()
+
+_PUBMED_QUERY_TOKEN = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+def pubmed_query_to_fts5(query: str, keep_operators: bool = True) -> str:
+    """Translates a PubMed-style boolean query (`GENE AND (therapy OR inhibitor)`) into an FTS5 MATCH expression."""
+    parts = []
+    for token in _PUBMED_QUERY_TOKEN.findall(re.sub(r'\[[^\]]*\]', ' ', query)): # drop field tags such as [tiab]
+        if token.upper() in ("AND", "OR", "NOT", ")"):
+            if keep_operators:
+                parts.append(token.upper())
+            continue
+        if token == "(":
+            part = token
+        else:
+            term = re.sub(r'^p\.', '', token.strip('"')) # abstracts write 'G12C' rather than 'p.G12C'
+            prefix = term.endswith('*')
+            term = term.rstrip('*').replace('"', '""')
+            if not term.strip():
+                continue
+            part = f'"{term}"' + ('*' if prefix else '')
+        if not keep_operators and part == "(":
+            continue
+        # FTS5 has no implicit AND in front of a group, so make adjacency explicit
+        if parts and parts[-1] not in ("(", "AND", "OR", "NOT"):
+            parts.append("AND")
+        parts.append(part)
+    return " ".join(parts)
+
+def search_local_pubmed(query: str, max_results: int) -> List[Dict[str, Any]]:
+    """Answers a PubMed query from the local FTS5 store, best BM25 matches first."""
+    if not PUBMED_LOCAL_DB or not os.path.exists(PUBMED_LOCAL_DB):
+        return []
+    sql = (
+        "SELECT a.pmid, a.title, a.abstract FROM articles_fts JOIN articles a ON a.rowid = articles_fts.rowid "
+        "WHERE articles_fts MATCH ? ORDER BY bm25(articles_fts) LIMIT ?"
+    )
+    conn = sqlite3.connect(PUBMED_LOCAL_DB)
+    try:
+        try:
+            rows = conn.execute(sql, (pubmed_query_to_fts5(query), max_results)).fetchall()
+        except sqlite3.OperationalError:
+            # Malformed boolean structure: fall back to requiring every term
+            terms_only = pubmed_query_to_fts5(query, keep_operators=False)
+            rows = conn.execute(sql, (terms_only, max_results)).fetchall() if terms_only else []
+    finally:
+        conn.close()
+    return [
+        {"title": title or "No Title Available", "abstract": abstract or "No Abstract Available", "support_literatures": pmid}
+        for pmid, title, abstract in rows
+    ]
+
+# --- PubMed Article Cache ---
+# Parsed efetch articles are cached by PMID (in-memory LRU in front of SQLite) and esearch
+# PMID lists by normalized query with a TTL, so overlapping searches across ReAct phases
+# and variants of the same gene only fetch PMIDs that have not been seen before.
+PUBMED_CACHE_PATH = os.getenv("PUBMED_CACHE_PATH", os.path.join(CACHE_DIR, "pubmed_cache.sqlite"))
+PUBMED_CACHE_MEMORY_SIZE = int(os.getenv("PUBMED_CACHE_MEMORY_SIZE", "5000"))
+PUBMED_SEARCH_CACHE_TTL_HOURS = float(os.getenv("PUBMED_SEARCH_CACHE_TTL_HOURS", "168"))
+
+def normalize_pubmed_query(query: str) -> str:
+    """Collapses whitespace and case-folds search terms; boolean operators keep their PubMed meaning."""
+    query = " ".join(query.split())
+    return re.sub(r'\b(?!(?:AND|OR|NOT)\b)\w+', lambda m: m.group().lower(), query)
+
+class PubMedCache:
+    """PMID -> article LRU backed by SQLite, plus a TTL cache of esearch results per normalized query."""
+
+    def __init__(self, db_path: str | None, memory_size: int, search_ttl_hours: float):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.search_ttl = search_ttl_hours * 3600
+        self._articles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = connect_cache_db(self.db_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS pubmed_articles (pmid TEXT PRIMARY KEY, article TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS pubmed_searches (query TEXT PRIMARY KEY, retmax INTEGER, pmids TEXT, created_at REAL)")
+        return conn
+
+    def _remember(self, pmid: str, article: Dict[str, Any]) -> None:
+        with self._lock:
+            self._articles[pmid] = article
+            self._articles.move_to_end(pmid)
+            while len(self._articles) > self.memory_size:
+                self._articles.popitem(last=False)
+
+    def get_articles(self, pmids: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        with self._lock:
+            for pmid in pmids:
+                if pmid in self._articles:
+                    self._articles.move_to_end(pmid)
+                    found[pmid] = self._articles[pmid]
+        missing = [pmid for pmid in pmids if pmid not in found]
+        if missing and self.db_path:
+            try:
+                conn = self._connect()
+                try:
+                    placeholders = ",".join("?" * len(missing))
+                    rows = conn.execute(f"SELECT pmid, article FROM pubmed_articles WHERE pmid IN ({placeholders})", missing).fetchall()
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                print(f"  - WARNING: PubMed cache lookup failed: {e}")
+                rows = []
+            for pmid, article in rows:
+                found[pmid] = json.loads(article)
+                self._remember(pmid, found[pmid])
+        return found
+
+    def put_articles(self, articles: List[Dict[str, Any]]) -> None:
+        for article in articles:
+            self._remember(article["support_literatures"], article)
+        if not self.db_path or not articles:
+            return
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO pubmed_articles VALUES (?, ?)",
+                        [(a["support_literatures"], json.dumps(a, ensure_ascii=False)) for a in articles]
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"  - WARNING: Could not write PubMed cache: {e}")
+
+    def get_search(self, query: str, max_results: int) -> List[str] | None:
+        """Cached PMID list for the query, or None when absent, expired or fetched with a smaller retmax."""
+        if not self.db_path:
+            return None
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT retmax, pmids, created_at FROM pubmed_searches WHERE query = ?",
+                                   (normalize_pubmed_query(query),)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"  - WARNING: PubMed cache lookup failed: {e}")
+            return None
+        if row is None or time.time() - row[2] > self.search_ttl:
+            return None
+        retmax, pmids = row[0], json.loads(row[1])
+        # A larger earlier search answers a smaller one; so does one that already returned every hit
+        if retmax < max_results and len(pmids) >= retmax:
+            return None
+        return pmids[:max_results]
+
+    def put_search(self, query: str, max_results: int, pmids: List[str]) -> None:
+        if not self.db_path:
+            return
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO pubmed_searches VALUES (?, ?, ?, ?)",
+                                 (normalize_pubmed_query(query), max_results, json.dumps(pmids), time.time()))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"  - WARNING: Could not write PubMed cache: {e}")
+
+PUBMED_CACHE = PubMedCache(PUBMED_CACHE_PATH, PUBMED_CACHE_MEMORY_SIZE, PUBMED_SEARCH_CACHE_TTL_HOURS)
+
+# --- In-Process OncoKB Annotation ---
+# AnnotatorCore is imported from the directory of ONCOKB_ANNOTATOR_PATH and run on an in-memory
+# table, avoiding a Python subprocess, a second token validation and a temp TSV per run.
+# ONCOKB_ANNOTATOR_MODE=subprocess restores the MafAnnotator.py subprocess, which is also the
+# fallback when in-process annotation fails. AnnotatorCore keeps the token, annotation cache
+# and HTTP session in module globals, so setting them and annotating happen under one lock.
+ONCOKB_ANNOTATOR_MODE = os.getenv("ONCOKB_ANNOTATOR_MODE", "library").lower()
+# SQLite file caching raw OncoKB annotations across runs (AnnotatorCore `-k`); unset disables it.
+ONCOKB_ANNOTATION_CACHE = os.getenv("ONCOKB_ANNOTATION_CACHE", "")
+ONCOKB_OUTPUT_COLUMNS = ['Hugo_Symbol', 'HGVSp_Short', 'ONCOGENIC', 'AMP_TIER', 'Drugs', 'MUTATION_EFFECT','MUTATION_EFFECT_CITATIONS','MUTATION_EFFECT_DESCRIPTION']
+_annotator_lock = threading.RLock()
+_validated_oncokb_tokens = set()
+
+def load_annotator_core(annotator_path: str, api_token: str):
+    """Imports AnnotatorCore from next to MafAnnotator.py and validates each token once per process."""
+    with _annotator_lock:
+        annotator_dir = os.path.dirname(os.path.abspath(annotator_path))
+        if annotator_dir not in sys.path:
+            sys.path.insert(0, annotator_dir)
+        import AnnotatorCore
+        AnnotatorCore.setoncokbapitoken(api_token)
+        if ONCOKB_ANNOTATION_CACHE and hasattr(AnnotatorCore, "setannotationcachefile"):
+            AnnotatorCore.setannotationcachefile(ONCOKB_ANNOTATION_CACHE)
+        if api_token not in _validated_oncokb_tokens:
+            try:
+                AnnotatorCore.validate_oncokb_token()
+            except SystemExit: # AnnotatorCore exits the interpreter on a bad token
+                raise RuntimeError("OncoKB API token validation failed.")
+            _validated_oncokb_tokens.add(api_token)
+        return AnnotatorCore
+
+def annotate_in_process(maf_filepath: str, tumor_type: str, annotator_path: str, api_token: str) -> pd.DataFrame:
+    """Equivalent of `MafAnnotator.py -i <maf> -t <tumor_type> -d`, returning the annotated table."""
+    records = pd.read_csv(maf_filepath, sep='\t', comment='#', dtype=str, keep_default_na=False).to_dict('records')
+    with _annotator_lock: # another run must not switch the token or cache mid-annotation
+        core = load_annotator_core(annotator_path, api_token)
+        annotated = pd.DataFrame(core.annotatealterationrecords(records, tumor_type, {}, include_descriptions=True))
+    return annotated.mask(annotated == '') # empty cells become NaN, as when the output file is read back with pandas
+
+def oncokb_records_json(df: pd.DataFrame) -> str:
+    df = add_amp_tier_to_df(df)
+    return df[[c for c in ONCOKB_OUTPUT_COLUMNS if c in df.columns]].to_json(orient='records')
+
 # --- Tool Definitions ---
 @tool
 def run_oncokb_annotator(maf_filepath: str, tumor_type: str) -> str:
@@ -89,56 +617,135 @@ def run_oncokb_annotator(maf_filepath: str, tumor_type: str) -> str:
     print(f"---TOOL: Running OncoKB Annotator on {maf_filepath} for {tumor_type}---")
     annotator_path, api_token = os.getenv("ONCOKB_ANNOTATOR_PATH"), os.getenv("ONCOKB_API_TOKEN")
     if not all([annotator_path, api_token]): return "ERROR: OncoKB annotator path or API token not configured."
+    if ONCOKB_ANNOTATOR_MODE == "library":
+        try:
+            df = annotate_in_process(maf_filepath, tumor_type, annotator_path, api_token)
+            if not df.empty:
+                return oncokb_records_json(df)
+            return "WARNING: OncoKB annotator produced no annotated rows."
+        except Exception as e:
+            print(f"  - WARNING: In-process OncoKB annotation failed ({e}); falling back to MafAnnotator.py.")
     fd, output_path = tempfile.mkstemp(suffix=".txt")
     os.close(fd)
     command = [sys.executable, annotator_path, "-i", maf_filepath, "-o", output_path, "-b", api_token, "-t", tumor_type, "-d"]
     try:
         subprocess.run(command, check=True, capture_output=True, text=True)
         if os.path.getsize(output_path) > 0:
-            df = add_amp_tier_to_df(pd.read_csv(output_path, sep='\t'))
-            cols = ['Hugo_Symbol', 'HGVSp_Short', 'ONCOGENIC', 'AMP_TIER', 'Drugs', 'MUTATION_EFFECT','MUTATION_EFFECT_CITATIONS','MUTATION_EFFECT_DESCRIPTION']
-            return df[[c for c in cols if c in df.columns]].to_json(orient='records')
+            return oncokb_records_json(pd.read_csv(output_path, sep='\t'))
         return "WARNING: OncoKB annotator produced an empty output file."
     except Exception as e: return f"CRITICAL ERROR: OncoKB annotator failed. {e}"
     finally:
         if os.path.exists(output_path):
             os.remove(output_path)
 
-@tool
-def pubmed_search(query: str, max_results: int = 20) -> dict:
-    """Searches PubMed for a specific query and returns structured article data."""
-    print(f"---TOOL: Searching PubMed for query: '{query}'---")
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+def search_remote_pubmed(query: str, max_results: int) -> dict:
+    """Runs esearch + efetch against NCBI E-utilities, fetching only PMIDs missing from PUBMED_CACHE."""
     try:
-        params={"db":"pubmed","term":query,"retmax":str(max_results),"retmode":"json"}; r=requests.get(f"{base_url}esearch.fcgi",params=params); time.sleep(1); r.raise_for_status()
-        ids = r.json().get("esearchresult", {}).get("idlist", [])
+        ids = PUBMED_CACHE.get_search(query, max_results)
+        if ids is None:
+            params={"db":"pubmed","term":query,"retmax":str(max_results),"retmode":"json"}; r=ncbi_get("esearch.fcgi",params); r.raise_for_status()
+            ids = r.json().get("esearchresult", {}).get("idlist", [])
+            PUBMED_CACHE.put_search(query, max_results, ids)
         if not ids: return {"status": "no results found", "articles": []}
-        params={"db":"pubmed","id":",".join(ids),"retmode":"xml","rettype":"abstract"}; r=requests.get(f"{base_url}efetch.fcgi",params=params); time.sleep(1); r.raise_for_status()
-        root, articles = ET.fromstring(r.content), []
-        for article in root.findall(".//PubmedArticle"):
-            pmid = article.findtext(".//PMID", "N/A")
-            title = article.findtext(".//ArticleTitle", "No Title Available")
-            abstract = "\n".join(["".join(e.itertext()) for e in article.findall(".//Abstract/AbstractText")]) or "No Abstract Available"
-            articles.append({"title": title, "abstract": abstract, "support_literatures": pmid})
+        cached = PUBMED_CACHE.get_articles(ids)
+        missing = [pmid for pmid in ids if pmid not in cached]
+        print(f"  - PubMed cache: {len(cached)} cached, {len(missing)} to fetch.")
+        if missing:
+            params={"db":"pubmed","id":",".join(missing),"retmode":"xml","rettype":"abstract"}
+            with ncbi_get("efetch.fcgi", params, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True # Let urllib3 undo any gzip transfer encoding
+                fetched = list(iter_pubmed_articles(r.raw))
+            PUBMED_CACHE.put_articles(fetched)
+            cached.update({a["support_literatures"]: a for a in fetched})
+        articles = [cached[pmid] for pmid in ids if pmid in cached]
         return {"status": "success", "articles": articles}
     except Exception as e: return {"status": "error", "message": f"PubMed search failed: {e}"}
 
-@tool
-def query_clinical_trials(
-    intervention: str = None,
-    condition: str = None,
-    other_terms: str = None,
-    max_results: int = 20,
-    status: str = "Active", # Use a user-friendly default
-    study_type: str = "Interventional"
-) -> dict:
-    """
-    Queries ClinicalTrials.gov for relevant studies using structured parameters.
-    Provide at least one of 'intervention', 'condition', or 'other_terms'.
-    """
-    print(f"---TOOL: Querying ClinicalTrials.gov for intervention='{intervention}', condition='{condition}', status='{status}'---")
-    base_url = "https://clinicaltrials.gov/api/v2/studies"
-    
+async def asearch_remote_pubmed(query: str, max_results: int) -> dict:
+    """Async search_remote_pubmed over the pooled httpx client."""
+    try:
+        ids = PUBMED_CACHE.get_search(query, max_results)
+        if ids is None:
+            params={"db":"pubmed","term":query,"retmax":str(max_results),"retmode":"json"}; r=await ancbi_get("esearch.fcgi",params); r.raise_for_status()
+            ids = r.json().get("esearchresult", {}).get("idlist", [])
+            PUBMED_CACHE.put_search(query, max_results, ids)
+        if not ids: return {"status": "no results found", "articles": []}
+        cached = PUBMED_CACHE.get_articles(ids)
+        missing = [pmid for pmid in ids if pmid not in cached]
+        print(f"  - PubMed cache: {len(cached)} cached, {len(missing)} to fetch.")
+        if missing:
+            params={"db":"pubmed","id":",".join(missing),"retmode":"xml","rettype":"abstract"}
+            r = await ancbi_get("efetch.fcgi", params, stream=True)
+            try:
+                r.raise_for_status()
+                fetched = [article async for article in aiter_pubmed_articles(r)]
+            finally:
+                await r.aclose()
+            PUBMED_CACHE.put_articles(fetched)
+            cached.update({a["support_literatures"]: a for a in fetched})
+        articles = [cached[pmid] for pmid in ids if pmid in cached]
+        return {"status": "success", "articles": articles}
+    except Exception as e: return {"status": "error", "message": f"PubMed search failed: {e}"}
+
+def _search_local_first(query: str, max_results: int) -> dict | None:
+    """Local-store part of pubmed_search; None means the remote API should be asked."""
+    if PUBMED_BACKEND not in ("hybrid", "local"):
+        return None
+    try:
+        articles = search_local_pubmed(query, max_results)
+    except sqlite3.Error as e:
+        print(f"  - WARNING: Local PubMed store failed: {e}")
+        articles = []
+    if articles:
+        print(f"  - Answered from local PubMed store ({len(articles)} articles).")
+        return {"status": "success", "articles": articles}
+    if PUBMED_BACKEND == "local":
+        return {"status": "no results found", "articles": []}
+    return None
+
+def _pubmed_search(query: str, max_results: int = 20) -> dict:
+    """Searches PubMed for a specific query and returns structured article data."""
+    print(f"---TOOL: Searching PubMed for query: '{query}'---")
+    local = _search_local_first(query, max_results)
+    return local if local is not None else search_remote_pubmed(query, max_results)
+
+async def _apubmed_search(query: str, max_results: int = 20) -> dict:
+    print(f"---TOOL: Searching PubMed for query: '{query}'---")
+    local = _search_local_first(query, max_results)
+    return local if local is not None else await asearch_remote_pubmed(query, max_results)
+
+# Sync and native async implementations; ToolNode picks the coroutine when the graph runs via astream
+pubmed_search = StructuredTool.from_function(func=_pubmed_search, coroutine=_apubmed_search, name="pubmed_search")
+
+# Only the study fields parse_clinical_trials reads are requested from the API (`fields` projection)
+CLINICAL_TRIALS_URL = "https://clinicaltrials.gov/api/v2/studies"
+CLINICAL_TRIALS_FIELDS = ",".join([
+    "protocolSection.identificationModule.nctId",
+    "protocolSection.identificationModule.briefTitle",
+    "protocolSection.descriptionModule.briefSummary",
+    "protocolSection.designModule.studyType",
+    "protocolSection.designModule.phases",
+    "protocolSection.statusModule.overallStatus",
+    "protocolSection.conditionsModule.conditions",
+    "protocolSection.armsAndInterventionsModule.interventions",
+    "protocolSection.eligibilityModule.eligibilityCriteria",
+])
+CLINICAL_TRIALS_PAGE_SIZE = int(os.getenv("CLINICAL_TRIALS_PAGE_SIZE", "20")) # the API allows up to 1000
+CLINICAL_TRIALS_MAX_PAGES = int(os.getenv("CLINICAL_TRIALS_MAX_PAGES", "10"))
+CLINICAL_TRIALS_PAGE_CACHE_SIZE = int(os.getenv("CLINICAL_TRIALS_PAGE_CACHE_SIZE", "256"))
+# Opt-in compact mode: brief summaries and eligibility criteria longer than this many characters are cut (0, the
+# default, keeps them whole)
+CLINICAL_TRIALS_TEXT_LIMIT = int(os.getenv("CLINICAL_TRIALS_TEXT_LIMIT", "0"))
+
+def truncate_text(text: str | None, limit: int) -> str | None:
+    """Cuts text to at most `limit` characters on a word boundary, marking the cut."""
+    if not text or limit <= 0 or len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " ...[truncated]"
+
+def clinical_trials_status_filter(status: str) -> str:
+    """Returns the pipe-separated overallStatus enums for a user-friendly status."""
     # --- [FIX 1] --- Map user-friendly status to the correct API enums
     # 'Active' is a common concept for studies that are ongoing.
     status_mapping = {
@@ -148,12 +755,18 @@ def query_clinical_trials(
         # Add other mappings as needed
     }
     # Default to all if status is not in our map
-    api_status = status_mapping.get(status.lower(), "RECRUITING|NOT_YET_RECRUITING|ACTIVE_NOT_RECRUITING|ENROLLING_BY_INVITATION|COMPLETED|TERMINATED")
+    return status_mapping.get(status.lower(), "RECRUITING|NOT_YET_RECRUITING|ACTIVE_NOT_RECRUITING|ENROLLING_BY_INVITATION|COMPLETED|TERMINATED")
 
+def build_clinical_trials_params(intervention: str = None, condition: str = None, other_terms: str = None,
+                                 max_results: int = 20, status: str = "Active", study_type: str = "Interventional") -> dict:
+    """Maps the tool arguments onto ClinicalTrials.gov v2 query parameters."""
+    # A fixed page size lets calls with different max_results share cached pages; the tool pages until it has enough
     params = {
-        "pageSize": max_results,
+        "pageSize": CLINICAL_TRIALS_PAGE_SIZE,
+        "countTotal": "true",
         "format": "json",
-        "filter.overallStatus": api_status
+        "fields": CLINICAL_TRIALS_FIELDS,
+        "filter.overallStatus": clinical_trials_status_filter(status)
     }
 
     # --- [FIX 2] --- Use the correct structured query parameters
@@ -167,55 +780,262 @@ def query_clinical_trials(
     # --- [FIX 3] --- Use the correct parameter for study_type
     if study_type:
         params["filter.advanced"] = f"AREA[StudyType]{study_type}"
+    return params
 
-    try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status() # Will raise an exception for 4xx/5xx errors
-        time.sleep(0.5)
+def parse_clinical_trials(data: dict, downloaded_bytes: int = 0, text_limit: int = CLINICAL_TRIALS_TEXT_LIMIT) -> dict:
+    """
+    Flattens a ClinicalTrials.gov v2 /studies response into the tool's output schema.
+    Long free-text fields are truncated to `text_limit`; `payload_stats` reports the bytes downloaded for the
+    projected records and the characters cut.
+    """
+    studies = data.get("studies", [])
+    if not studies: 
+        return {"status": "no results found", "trials": []}
+        
+    trial_list = []
+    chars_truncated = 0
+    for t in studies:
+        proto = t.get("protocolSection", {})
         
-        data = response.json()
-        studies = data.get("studies", [])
-        if not studies: 
-            return {"status": "no results found", "trials": []}
-            
-        trial_list = []
-        for t in studies:
-            proto = t.get("protocolSection", {})
-            
-            def get_nested(data, path):
-                for key in path:
-                    if isinstance(data, dict): data = data.get(key)
-                    else: return None
-                return data
-
-        #    locations = get_nested(proto, ["contactsLocationsModule", "locations"]) or []
-        #    location_str = ", ".join(
-        #        [f"{loc.get('city', '')}, {loc.get('country', '')}" for loc in locations if loc.get('country')]
-        #    )
-
-            trial_info = {
-                "nct_id": get_nested(proto, ["identificationModule", "nctId"]),
-                "title": get_nested(proto, ["identificationModule", "briefTitle"]),
-                "brief_summary": get_nested(proto, ["descriptionModule", "briefSummary"]),
-                "study_type": get_nested(proto, ["designModule", "studyType"]),
-                "status": get_nested(proto, ["statusModule", "overallStatus"]),
-                "phase": ", ".join(get_nested(proto, ["designModule", "phases"]) or []),
-                "conditions": ", ".join(get_nested(proto, ["conditionsModule", "conditions"]) or []),
-                "interventions": [
-                    {"type": i.get("type"), "name": i.get("name")} 
-                    for i in get_nested(proto, ["armsAndInterventionsModule", "interventions"]) or []
-                ],
-
-                "eligibility_criteria_text": get_nested(proto, ["eligibilityModule", "eligibilityCriteria"]),
-            }
-            trial_list.append(trial_info)
-
-        return {"status": "success", "total_found": data.get("totalCount", 0), "trials": trial_list}
+        def get_nested(data, path):
+            for key in path:
+                if isinstance(data, dict): data = data.get(key)
+                else: return None
+            return data
+
+    #    locations = get_nested(proto, ["contactsLocationsModule", "locations"]) or []
+    #    location_str = ", ".join(
+    #        [f"{loc.get('city', '')}, {loc.get('country', '')}" for loc in locations if loc.get('country')]
+    #    )
+
+        brief_summary = get_nested(proto, ["descriptionModule", "briefSummary"])
+        eligibility = get_nested(proto, ["eligibilityModule", "eligibilityCriteria"])
+        trial_info = {
+            "nct_id": get_nested(proto, ["identificationModule", "nctId"]),
+            "title": get_nested(proto, ["identificationModule", "briefTitle"]),
+            "brief_summary": truncate_text(brief_summary, text_limit),
+            "study_type": get_nested(proto, ["designModule", "studyType"]),
+            "status": get_nested(proto, ["statusModule", "overallStatus"]),
+            "phase": ", ".join(get_nested(proto, ["designModule", "phases"]) or []),
+            "conditions": ", ".join(get_nested(proto, ["conditionsModule", "conditions"]) or []),
+            "interventions": [
+                {"type": i.get("type"), "name": i.get("name")} 
+                for i in get_nested(proto, ["armsAndInterventionsModule", "interventions"]) or []
+            ],
+
+            "eligibility_criteria_text": truncate_text(eligibility, text_limit),
+        }
+        for full, kept in ((brief_summary, trial_info["brief_summary"]), (eligibility, trial_info["eligibility_criteria_text"])):
+            if full and kept != full:
+                chars_truncated += len(full) - len(kept)
+        trial_list.append(trial_info)
+
+    # ~4 characters per token for English text
+    print(f"  - ClinicalTrials.gov payload: {downloaded_bytes} bytes downloaded, {chars_truncated} characters "
+          f"(~{chars_truncated // 4} tokens) truncated.")
+    payload_stats = {"downloaded_bytes": downloaded_bytes, "truncated_chars": chars_truncated}
+    return {"status": "success", "total_found": data.get("totalCount", 0), "trials": trial_list, "payload_stats": payload_stats}
+
+# --- ClinicalTrials.gov Pagination ---
+# Results are read page by page via nextPageToken, deduplicated by NCT ID as they arrive, and
+# paging stops as soon as max_results trials are collected. Decoded pages are kept in an LRU
+# keyed by query parameters and page token, so repeated or broadened searches reuse them.
+class ClinicalTrialsPageCache:
+    """In-memory LRU of decoded /studies pages."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(params: dict, page_token: str | None) -> str:
+        return json.dumps({**params, "pageToken": page_token}, sort_keys=True)
+
+    def get(self, params: dict, page_token: str | None) -> dict | None:
+        key = self._key(params, page_token)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, params: dict, page_token: str | None, page: dict) -> None:
+        with self._lock:
+            self._pages[self._key(params, page_token)] = page
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+CLINICAL_TRIALS_PAGE_CACHE = ClinicalTrialsPageCache(CLINICAL_TRIALS_PAGE_CACHE_SIZE)
+
+def iter_clinical_trials_pages(params: dict) -> Iterator[tuple]:
+    """Follows nextPageToken, yielding (page, downloaded_bytes); cached pages are served without a request."""
+    page_token = None
+    for _ in range(CLINICAL_TRIALS_MAX_PAGES):
+        page, downloaded = CLINICAL_TRIALS_PAGE_CACHE.get(params, page_token), 0
+        if page is None:
+            response = http_get(CLINICAL_TRIALS_URL, params={**params, "pageToken": page_token} if page_token else params)
+            response.raise_for_status() # Will raise an exception for 4xx/5xx errors
+            time.sleep(0.5)
+            page, downloaded = response.json(), len(response.content)
+            CLINICAL_TRIALS_PAGE_CACHE.put(params, page_token, page)
+        yield page, downloaded
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            return
+
+async def aiter_clinical_trials_pages(params: dict) -> AsyncIterator[tuple]:
+    """Async iter_clinical_trials_pages over the pooled httpx client."""
+    page_token = None
+    for _ in range(CLINICAL_TRIALS_MAX_PAGES):
+        page, downloaded = CLINICAL_TRIALS_PAGE_CACHE.get(params, page_token), 0
+        if page is None:
+            response = await ahttp_get(CLINICAL_TRIALS_URL, params={**params, "pageToken": page_token} if page_token else params)
+            response.raise_for_status()
+            await asyncio.sleep(0.5)
+            page, downloaded = response.json(), len(response.content)
+            CLINICAL_TRIALS_PAGE_CACHE.put(params, page_token, page)
+        yield page, downloaded
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            return
+
+def merge_clinical_trials_page(merged: Dict[str, dict], page: dict, max_results: int) -> bool:
+    """Adds a page's unseen studies to `merged` (keyed by NCT ID); returns True once max_results are collected."""
+    for study in page.get("studies", []):
+        nct_id = study.get("protocolSection", {}).get("identificationModule", {}).get("nctId")
+        if nct_id and nct_id not in merged:
+            merged[nct_id] = study
+            if len(merged) >= max_results:
+                return True
+    return False
+
+# --- Local ClinicalTrials.gov Store ---
+# Optional SQLite snapshot built by ClinicalTrialsIndexer.py. CLINICAL_TRIALS_BACKEND selects
+# 'remote' (live API only), 'hybrid' (local store first, live API only on a miss) or 'local'
+# (offline, never touches the network).
+CLINICAL_TRIALS_LOCAL_DB = os.getenv("CLINICAL_TRIALS_LOCAL_DB")
+CLINICAL_TRIALS_BACKEND = os.getenv("CLINICAL_TRIALS_BACKEND", "hybrid" if CLINICAL_TRIALS_LOCAL_DB else "remote").lower()
+
+def search_local_trials(intervention: str = None, condition: str = None, other_terms: str = None,
+                        max_results: int = 20, status: str = "Active", study_type: str = "Interventional") -> tuple:
+    """
+    Answers a query_clinical_trials call from the local store.
+    Returns up to max_results API-shaped study records and the number of studies matching the query.
+    """
+    if not CLINICAL_TRIALS_LOCAL_DB or not os.path.exists(CLINICAL_TRIALS_LOCAL_DB):
+        return [], 0
+    statuses = clinical_trials_status_filter(status).split("|")
+    filters, args = [f"s.overall_status IN ({', '.join('?' * len(statuses))})"], statuses
+    if study_type:
+        filters.append("s.study_type = ?")
+        args = args + [study_type.upper()]
+
+    def match_expression(keep_operators: bool) -> str:
+        # intervention/condition search their own columns, like query.intr/query.cond; other_terms searches everything
+        clauses = []
+        for column, text in (("interventions", intervention), ("conditions", condition), (None, other_terms)):
+            expression = pubmed_query_to_fts5(text, keep_operators) if text else ""
+            if expression:
+                clauses.append(f"{column} : ({expression})" if column else f"({expression})")
+        return " AND ".join(clauses)
+
+    conn = sqlite3.connect(CLINICAL_TRIALS_LOCAL_DB)
+    try:
+        expression = match_expression(keep_operators=True)
+        if not expression:
+            where = f"FROM studies s WHERE {' AND '.join(filters)}"
+            rows = conn.execute(f"SELECT s.record {where} LIMIT ?", args + [max_results]).fetchall()
+            total = conn.execute(f"SELECT COUNT(*) {where}", args).fetchone()[0]
+        else:
+            where = f"FROM studies_fts JOIN studies s ON s.rowid = studies_fts.rowid WHERE studies_fts MATCH ? AND {' AND '.join(filters)}"
+            sql = f"SELECT s.record {where} ORDER BY bm25(studies_fts) LIMIT ?"
+            try:
+                rows = conn.execute(sql, [expression] + args + [max_results]).fetchall()
+            except sqlite3.OperationalError:
+                # Malformed boolean structure: fall back to requiring every term
+                expression = match_expression(keep_operators=False)
+                rows = conn.execute(sql, [expression] + args + [max_results]).fetchall() if expression else []
+            total = conn.execute(f"SELECT COUNT(*) {where}", [expression] + args).fetchone()[0] if rows else 0
+    finally:
+        conn.close()
+    return [json.loads(record) for (record,) in rows], total
+
+def _search_local_trials_first(intervention: str, condition: str, other_terms: str, max_results: int,
+                               status: str, study_type: str) -> dict | None:
+    """Local-store part of query_clinical_trials; None means the live API should be asked."""
+    if CLINICAL_TRIALS_BACKEND not in ("hybrid", "local"):
+        return None
+    try:
+        studies, total = search_local_trials(intervention, condition, other_terms, max_results, status, study_type)
+    except sqlite3.Error as e:
+        print(f"  - WARNING: Local ClinicalTrials store failed: {e}")
+        studies = []
+    if studies:
+        print(f"  - Answered from local ClinicalTrials store ({len(studies)} of {total} matching trials).")
+        return parse_clinical_trials({"studies": studies, "totalCount": total})
+    if CLINICAL_TRIALS_BACKEND == "local":
+        return {"status": "no results found", "trials": []}
+    return None
+
+def _query_clinical_trials(
+    intervention: str = None,
+    condition: str = None,
+    other_terms: str = None,
+    max_results: int = 20,
+    status: str = "Active", # Use a user-friendly default
+    study_type: str = "Interventional"
+) -> dict:
+    """
+    Queries ClinicalTrials.gov for relevant studies using structured parameters.
+    Provide at least one of 'intervention', 'condition', or 'other_terms'.
+    """
+    print(f"---TOOL: Querying ClinicalTrials.gov for intervention='{intervention}', condition='{condition}', status='{status}'---")
+    local = _search_local_trials_first(intervention, condition, other_terms, max_results, status, study_type)
+    if local is not None:
+        return local
+    params = build_clinical_trials_params(intervention, condition, other_terms, max_results, status, study_type)
+    try:
+        merged, downloaded, total = {}, 0, 0
+        for page, page_bytes in iter_clinical_trials_pages(params):
+            downloaded += page_bytes
+            total = page.get("totalCount", total) # only the first page carries the count
+            if merge_clinical_trials_page(merged, page, max_results):
+                break
+        return parse_clinical_trials({"studies": list(merged.values()), "totalCount": total}, downloaded)
     except requests.exceptions.HTTPError as e:
         # Provide a more informative error message
         return {"status": "error", "message": f"ClinicalTrials search failed with HTTP {e.response.status_code}. URL: {e.request.url}. Response: {e.response.text}"}
     except Exception as e:
         return {"status": "error", "message": f"An unexpected error occurred in ClinicalTrials search: {e}"}
+
+async def _aquery_clinical_trials(
+    intervention: str = None,
+    condition: str = None,
+    other_terms: str = None,
+    max_results: int = 20,
+    status: str = "Active",
+    study_type: str = "Interventional"
+) -> dict:
+    print(f"---TOOL: Querying ClinicalTrials.gov for intervention='{intervention}', condition='{condition}', status='{status}'---")
+    local = _search_local_trials_first(intervention, condition, other_terms, max_results, status, study_type)
+    if local is not None:
+        return local
+    params = build_clinical_trials_params(intervention, condition, other_terms, max_results, status, study_type)
+    try:
+        merged, downloaded, total = {}, 0, 0
+        async for page, page_bytes in aiter_clinical_trials_pages(params):
+            downloaded += page_bytes
+            total = page.get("totalCount", total)
+            if merge_clinical_trials_page(merged, page, max_results):
+                break
+        return parse_clinical_trials({"studies": list(merged.values()), "totalCount": total}, downloaded)
+    except httpx.HTTPStatusError as e:
+        return {"status": "error", "message": f"ClinicalTrials search failed with HTTP {e.response.status_code}. URL: {e.request.url}. Response: {e.response.text}"}
+    except Exception as e:
+        return {"status": "error", "message": f"An unexpected error occurred in ClinicalTrials search: {e}"}
+
+query_clinical_trials = StructuredTool.from_function(func=_query_clinical_trials, coroutine=_aquery_clinical_trials, name="query_clinical_trials")
         
 # --- Agent & Graph State Definition ---
 class AgentState(TypedDict):
@@ -223,6 +1043,7 @@ class AgentState(TypedDict):
     variants_to_process: List[Dict[str, Any]]
     processed_variants_reports: Annotated[List[Dict[str, Any]], operator.add]
     current_variant_info: Dict[str, Any]
+    variant_indices: List[int]
     pubmed_results: Dict[str, Any]
     clinical_trial_results: Dict[str, Any]
     summarized_evidence: str
@@ -278,24 +1099,47 @@ def annotator_node(state: AgentState) -> dict:
         input_filepath = info["input_txt"]
         df = pd.read_csv(input_filepath, sep='\t', comment='#')
         tumor_type = df[info["cancer_type_col"]].iloc[0]
-        state["patient_info"]["cancer_type"] = tumor_type # Update state
         result_str = run_oncokb_annotator.invoke({"maf_filepath": input_filepath, "tumor_type": tumor_type})
         variants = json.loads(result_str)
-        return {"variants_to_process": variants if isinstance(variants, list) else []}
+        # Return the updated patient_info so every fanned-out branch sees the cancer type
+        return {"patient_info": {**info, "cancer_type": tumor_type},
+                "variants_to_process": variants if isinstance(variants, list) else []}
     except Exception as e:
         print(f"Error in annotator node: {e}")
         return {"variants_to_process": []}
 
-def get_next_variant(state: AgentState) -> dict:
-    """Pops the next variant from the list to be processed."""
-    print("\n---NODE: Get Next Variant---")
+def variant_dedup_key(variant: Dict[str, Any], cancer_type: str, index: int) -> tuple:
+    """Normalized (gene, protein change, cancer type) key used to research recurrent variants only once.
+    Rows without a protein change (intronic, UTR, ...) are never merged and are keyed by their row index."""
+    gene = str(variant.get('Hugo_Symbol') or '').strip().upper()
+    protein_change = str(variant.get('HGVSp_Short') or '').strip()
+    if protein_change.lower().startswith('p.'):
+        protein_change = protein_change[2:]
+    if not protein_change:
+        return ('row', index)
+    return gene, protein_change.upper(), str(cancer_type or '').strip().lower()
+
+def fan_out_variants(state: AgentState):
+    """Maps every unique annotated variant onto its own 'process_variant' branch via Send."""
     variants = state.get('variants_to_process', [])
     if not variants:
-        print("No more variants to process.")
-        return {"current_variant_info": None}
-    next_variant = variants.pop(0)
-    print(f"Processing: {next_variant.get('Hugo_Symbol')} {next_variant.get('HGVSp_Short')}")
-    return {"current_variant_info": next_variant, "variants_to_process": variants}
+        print("No variants to process.")
+        return "final_combiner"
+    # Collapse recurrent variants; each branch remembers every source row it reports for
+    cancer_type = state["patient_info"].get("cancer_type")
+    groups = {}
+    for index, variant in enumerate(variants):
+        groups.setdefault(variant_dedup_key(variant, cancer_type, index), []).append(index)
+    print(f"\n---FAN-OUT: Dispatching {len(groups)} unique variants ({len(variants)} input rows)---")
+    return [
+        Send("process_variant", {
+            "patient_info": state["patient_info"],
+            "current_variant_info": variants[indices[0]],
+            "variant_indices": indices,
+            "processed_variants_reports": [],
+        })
+        for indices in groups.values()
+    ]
 
 # --- [NEW] ReAct Agent for PubMed Search (Custom Implementation) ---
 
@@ -307,6 +1151,8 @@ class ReActState(TypedDict):
     # --- [NEW] --- Add fields to store curated results
     curated_pubmed_articles: Annotated[List[Dict[str, Any]], operator.add]
     curated_clinical_trials: Annotated[List[Dict[str, Any]], operator.add]
+    # Full outputs of tool messages that were replaced by digests in `messages`
+    tool_payloads: Annotated[List[Dict[str, Any]], operator.add]
     log_callback: Callable[[str], Any] | None
 
 
@@ -315,6 +1161,11 @@ class ReActState(TypedDict):
 deep_research_tools = [pubmed_search,query_clinical_trials]
 llm_with_tools = LLM_CREATIVE.bind_tools(deep_research_tools)
 
+# Opt-in parallel tool calling: the task prompt lets the agent batch independent searches into one step and
+# ToolNode runs them concurrently (up to MAX_PARALLEL_TOOL_CALLS at once). Off by default so the two modes can be compared.
+PARALLEL_TOOL_CALLS = os.getenv("PARALLEL_TOOL_CALLS", "false").lower() in ("1", "true", "yes")
+MAX_PARALLEL_TOOL_CALLS = int(os.getenv("MAX_PARALLEL_TOOL_CALLS", "8"))
+
 # 3. Define the Nodes for the ReAct agent's graph
 # --- 3. Define the Nodes for the ReAct agent's graph
 async def call_model(state: ReActState):
@@ -322,7 +1173,7 @@ async def call_model(state: ReActState):
     print("  - ReAct Agent: Thinking...")
     log_callback = state.get("log_callback")
     
-    response = llm_with_tools.invoke(state["messages"])
+    response = await llm_with_tools.ainvoke(state["messages"])
 
     if log_callback:
         log_message = "🤔 **Thought Process:**\n"
@@ -355,6 +1206,62 @@ async def call_model(state: ReActState):
 # We can use the prebuilt ToolNode, which is a convenient way to call tools
 tool_node = ToolNode(deep_research_tools)
 
+# Context compaction: once the agent has moved past a tool step, the raw outputs of that step (up to 20 abstracts
+# or eligibility texts each) are replaced in the history by short digests, so later model calls stop resending them.
+# The full payloads move to `tool_payloads` for the curation step in deep_research_node.
+REACT_COMPACT_HISTORY = os.getenv("REACT_COMPACT_HISTORY", "true").lower() in ("1", "true", "yes")
+REACT_FULL_TOOL_STEPS = max(1, int(os.getenv("REACT_FULL_TOOL_STEPS", "1")))
+
+def key_sentences(text: str, count: int = 2, max_chars: int = 300) -> List[str]:
+    """Returns the closing sentences of an abstract, where the conclusions usually are."""
+    sentences = [s for s in re.split(r'(?<=[.!?])\s+', text or "") if s.strip()]
+    return [s[:max_chars] for s in sentences[-count:]]
+
+def digest_tool_output(name: str, content: str) -> str:
+    """Compacts a pubmed_search / query_clinical_trials result to IDs, titles and a few key facts."""
+    try:
+        output = json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        return content
+    if name == 'pubmed_search' and output.get('articles'):
+        output['articles'] = [
+            {"pmid": a.get('support_literatures'), "title": a.get('title'), "key_sentences": key_sentences(a.get('abstract'))}
+            for a in output['articles']
+        ]
+    elif name == 'query_clinical_trials' and output.get('trials'):
+        output.pop('payload_stats', None)
+        output['trials'] = [
+            {"nct_id": t.get('nct_id'), "title": t.get('title'), "status": t.get('status'), "phase": t.get('phase'),
+             "interventions": ", ".join(i.get('name') or "" for i in t.get('interventions') or [])}
+            for t in output['trials']
+        ]
+    else:
+        return content
+    output['note'] = "Digest of an earlier result; the full text was already reviewed."
+    return json.dumps(output, ensure_ascii=False)
+
+def compact_history(state: ReActState):
+    """Replaces tool outputs older than the last REACT_FULL_TOOL_STEPS tool steps with digests."""
+    messages = state["messages"]
+    tool_steps = [i for i, m in enumerate(messages) if isinstance(m, AIMessage) and m.tool_calls]
+    if len(tool_steps) <= REACT_FULL_TOOL_STEPS:
+        return {}
+    compacted, payloads, chars_before, chars_after = [], [], 0, 0
+    for message in messages[:tool_steps[-REACT_FULL_TOOL_STEPS]]:
+        if not isinstance(message, ToolMessage) or message.additional_kwargs.get("compacted"):
+            continue
+        digest = digest_tool_output(message.name, message.content)
+        payloads.append({"name": message.name, "tool_call_id": message.tool_call_id, "content": message.content})
+        # Same id, so add_messages replaces the original message in place
+        compacted.append(ToolMessage(content=digest, name=message.name, tool_call_id=message.tool_call_id,
+                                     id=message.id, additional_kwargs={"compacted": True}))
+        chars_before += len(message.content)
+        chars_after += len(digest)
+    if not compacted:
+        return {}
+    print(f"  - ReAct Agent: Compacted {len(compacted)} earlier tool results ({chars_before} -> {chars_after} chars).")
+    return {"messages": compacted, "tool_payloads": payloads}
+
 # 4. Define the Conditional Edge for the ReAct agent's graph
 def should_continue(state: ReActState):
     """Conditional edge to decide whether to continue the loop or finish."""
@@ -371,6 +1278,8 @@ react_workflow = StateGraph(ReActState)
 
 react_workflow.add_node("agent", call_model)
 react_workflow.add_node("action", tool_node)
+if REACT_COMPACT_HISTORY:
+    react_workflow.add_node("compact", compact_history)
 
 react_workflow.set_entry_point("agent")
 
@@ -379,7 +1288,11 @@ react_workflow.add_conditional_edges(
     should_continue,
     {"continue": "action", "end": END},
 )
-react_workflow.add_edge("action", "agent")
+if REACT_COMPACT_HISTORY:
+    react_workflow.add_edge("action", "compact")
+    react_workflow.add_edge("compact", "agent")
+else:
+    react_workflow.add_edge("action", "agent")
 
 # Compile the graph into a runnable agent
 deep_researcher_agent = react_workflow.compile()
@@ -394,7 +1307,16 @@ async def deep_research_node(state: AgentState, config: RunnableConfig) -> dict:
     patient = state['patient_info']
 
     log_callback = config.get("configurable", {}).get("react_log_callback")
-    
+    parallel_tools = patient.get('parallel_tools', PARALLEL_TOOL_CALLS)
+    if parallel_tools:
+        tool_call_rule = (
+            f"\n2.  **Parallel Tool Calls:** You MAY issue several independent tool calls in a single thinking step; they are executed concurrently. "
+            f"Batch calls whose inputs do not depend on each other (e.g., Actions A and B of a phase, or validating several drugs with `query_clinical_trials`). "
+            f"A call that builds on another call's results MUST wait for the next step."
+        )
+    else:
+        tool_call_rule = f"\n2.  **Single Tool Per Action:** You MUST call only one tool in a single thinking step. Do not issue multiple tool calls at once. Plan your steps sequentially."
+
     task = (
         f"You are an expert oncology researcher. Your mission is to uncover all relevant therapeutic evidence for the variant **{variant['Hugo_Symbol']} {variant['HGVSp_Short']}** in **{patient['cancer_type']}**."
         f"\nYou must follow a strict, function-driven workflow."
@@ -433,7 +1355,7 @@ async def deep_research_node(state: AgentState, config: RunnableConfig) -> dict:
 
         f"\n\n**--- Tool Usage Rules ---**"
         f"\n1.  **Think Step-by-Step:** Before every tool call, you MUST output your thought process. This thought process MUST start with a brief summary of the previous action's result (e.g., 'The last search found 2 relevant articles(must list pmid or nctid)..., '), then state your reasoning for the next action."
-        f"\n2.  **Single Tool Per Action:** You MUST call only one tool in a single thinking step. Do not issue multiple tool calls at once. Plan your steps sequentially."
+        f"{tool_call_rule}"
         f"\n3.  **`pubmed_search`:** For 'OR' conditions, you MUST use parentheses: `(therapy OR treatment)`. Always set `max_results` to 20."
         f"\n4.  **`query_clinical_trials`:** You MUST use structured parameters (`intervention`, `condition`). If a specific search fails or returns no results, DO NOT give up. Your immediate next step is to broaden the search by calling the tool with only one parameter (e.g., just `intervention`).Always set `max_results` to 20."
 
@@ -452,29 +1374,48 @@ async def deep_research_node(state: AgentState, config: RunnableConfig) -> dict:
         f"\n`Relevant NCTs: [\"NCT_ID1\", \"NCT_ID2\"]`"
     )
     
+    cache_path = patient.get('research_cache', RESEARCH_CACHE_PATH)
+    cache_key = research_cache_key(variant, patient['cancer_type'], LLM_MODEL, task)
+    if not patient.get('refresh'):
+        # The cache is a blocking SQLite file; keep it off the event loop shared by the other variants
+        cached = await asyncio.to_thread(load_cached_research, cache_path, cache_key,
+                                         patient.get('cache_ttl_days', RESEARCH_CACHE_TTL_DAYS))
+        if cached:
+            print("  - ReAct Agent: Loaded previous research from cache.")
+            if log_callback:
+                await log_callback("♻️ **Cached Result:** Reusing a previous deep research run for this variant.")
+            return cached
+
     initial_react_state = {
         "messages": [("user", task)],
         "log_callback": log_callback       
         }
-    final_react_state = await deep_researcher_agent.ainvoke(initial_react_state)
+    # Own concurrency limit so the outer per-variant max_concurrency does not serialize a batch of tool calls
+    final_react_state = await deep_researcher_agent.ainvoke(initial_react_state, {"max_concurrency": MAX_PARALLEL_TOOL_CALLS})
 
     final_conclusion = final_react_state['messages'][-1].content
     print(f"\n  >>> LLM Final Conclusion:\n  {final_conclusion}\n")
+    model_turns = sum(isinstance(m, AIMessage) for m in final_react_state['messages'])
+    tool_calls = sum(isinstance(m, ToolMessage) for m in final_react_state['messages'])
+    print(f"  - ReAct Agent used {model_turns} model turns for {tool_calls} tool calls ({'parallel' if parallel_tools else 'single'} tool mode).")
     
     # --- NEW: Extract structured data directly from tool calls ---
     # Step 1: Gather ALL results found during the process, just like before.
+    # Compacted tool messages only hold digests; their full outputs are in `tool_payloads`.
     all_articles_found = []
     all_trials_found = []
-    for message in final_react_state['messages']:
-        if isinstance(message, ToolMessage):
-            try:
-                tool_output = json.loads(message.content)
-                if message.name == 'pubmed_search' and tool_output.get('articles'):
-                    all_articles_found.extend(tool_output['articles'])
-                elif message.name == 'query_clinical_trials' and tool_output.get('trials'):
-                    all_trials_found.extend(tool_output['trials'])
-            except (json.JSONDecodeError, TypeError):
-                continue
+    tool_outputs = [(m.name, m.content) for m in final_react_state['messages']
+                    if isinstance(m, ToolMessage) and not m.additional_kwargs.get("compacted")]
+    tool_outputs += [(p['name'], p['content']) for p in final_react_state.get('tool_payloads', [])]
+    for name, content in tool_outputs:
+        try:
+            tool_output = json.loads(content)
+            if name == 'pubmed_search' and tool_output.get('articles'):
+                all_articles_found.extend(tool_output['articles'])
+            elif name == 'query_clinical_trials' and tool_output.get('trials'):
+                all_trials_found.extend(tool_output['trials'])
+        except (json.JSONDecodeError, TypeError):
+            continue
 
     # Step 2: Use the LLM's final conclusion to filter these comprehensive lists.
     # The regex is designed to be flexible, handling formats like ["123"], "123", [123], etc.
@@ -497,11 +1438,17 @@ async def deep_research_node(state: AgentState, config: RunnableConfig) -> dict:
     print(f"  - ReAct Agent curated {len(curated_articles)} relevant articles from its search.")
     print(f"  - ReAct Agent curated {len(curated_trials)} relevant trials from its search.")
 
-    return {
+    result = {
         "pubmed_results": {"status": "success", "articles": curated_articles},
         "clinical_trial_results": {"status": "success", "trials": curated_trials},
         "summarized_evidence": final_conclusion
     }
+    # A run whose every tool call failed (network down, rate limits) is not worth keeping for the cache TTL
+    if not tool_outputs or any(tool_call_succeeded(content) for _, content in tool_outputs):
+        await asyncio.to_thread(store_cached_research, cache_path, cache_key, variant, patient['cancer_type'], LLM_MODEL, result)
+    else:
+        print("  - ReAct Agent: All tool calls failed; the result is not cached.")
+    return result
     
 
 
@@ -529,7 +1476,7 @@ def format_oncokb_only_node(state: AgentState) -> dict:
     }
     return {"processed_variants_reports": [report]}
 
-def single_variant_synthesizer_node(state: AgentState) -> dict:
+async def single_variant_synthesizer_node(state: AgentState) -> dict:
     """Synthesizes OncoKB data with new evidence from deep research into a structured report."""
     print("---NODE: Synthesize with Agent Findings---")
     variant = state['current_variant_info']
@@ -547,12 +1494,12 @@ def single_variant_synthesizer_node(state: AgentState) -> dict:
     }
     
     chain = FINAL_SYNTHESIZER_PROMPT | LLM_FACTUAL
-    raw_output = chain.invoke({
+    raw_output = (await chain.ainvoke({
         "gene": base_report["gene"], "variant": base_report["protein_change"],
         "cancer_type": base_report["cancer_type"],
         "oncokb_info": json.dumps(variant),
         "summarized_evidence": state.get("summarized_evidence", "No new evidence was summarized by the research agent.")
-    }).content
+    })).content
     
     try:
         json_match = re.search(r"\{.*\}", raw_output, re.DOTALL)
@@ -576,12 +1523,12 @@ def single_variant_synthesizer_node(state: AgentState) -> dict:
 def final_combiner_node(state: AgentState) -> dict:
     """Combines all individual variant reports into one final file."""
     print("\n---NODE: Final Combiner---")
-    return {"final_report": {"variant_report": state.get('processed_variants_reports', [])}}
-
-# --- Graph Assembly (No changes here) ---
-workflow = StateGraph(AgentState)
+    # Branches finish in arbitrary order; restore the input order of the annotated variants
+    reports = sorted(state.get('processed_variants_reports', []), key=lambda r: r.get('variant_index', 0))
+    reports = [{k: v for k, v in r.items() if k != 'variant_index'} for r in reports]
+    return {"final_report": {"variant_report": reports}}
 
-# In --- Graph Assembly --- section
+# --- Graph Assembly ---
 
 def route_after_variant_get(state: AgentState) -> str:
     """
@@ -608,25 +1555,45 @@ def route_after_variant_get(state: AgentState) -> str:
     print(f"  - ROUTING: Proceeding to deep search for {current_variant.get('HGVSp_Short')}. Reason: Actionable oncogenicity ('{oncogenicity}') with no drugs listed.")
     return "perform_deep_search"
 
-workflow.add_node("annotator", annotator_node)
-workflow.add_node("get_next_variant", get_next_variant)
-workflow.add_node("deep_researcher", deep_research_node)
-workflow.add_node("format_oncokb_only", format_oncokb_only_node)
+# Per-variant sub-workflow: triage -> (deep research -> synthesis | OncoKB-only formatting)
+variant_workflow = StateGraph(AgentState)
 
-workflow.add_node("single_variant_synthesizer", single_variant_synthesizer_node)
-workflow.add_node("final_combiner", final_combiner_node)
+variant_workflow.add_node("deep_researcher", deep_research_node)
+variant_workflow.add_node("format_oncokb_only", format_oncokb_only_node)
+variant_workflow.add_node("single_variant_synthesizer", single_variant_synthesizer_node)
 
-workflow.set_entry_point("annotator")
-workflow.add_edge("annotator", "get_next_variant")
-workflow.add_conditional_edges(
-    "get_next_variant", route_after_variant_get,
-    {"end_loop": "final_combiner", "skip_deep_search": "format_oncokb_only", "perform_deep_search": "deep_researcher"}
+variant_workflow.set_conditional_entry_point(
+    route_after_variant_get,
+    {"end_loop": END, "skip_deep_search": "format_oncokb_only", "perform_deep_search": "deep_researcher"}
 )
+variant_workflow.add_edge("deep_researcher", "single_variant_synthesizer")
+variant_workflow.add_edge("single_variant_synthesizer", END)
+variant_workflow.add_edge("format_oncokb_only", END)
+
+variant_app = variant_workflow.compile()
+
 
-workflow.add_edge("format_oncokb_only", "get_next_variant")
+async def process_variant_node(state: AgentState, config: RunnableConfig) -> dict:
+    """Runs the per-variant sub-workflow for one fanned-out variant and copies its report to every source row."""
+    variant, indices = state['current_variant_info'], state['variant_indices']
+    print(f"\n---NODE: Process Variant #{indices[0] + 1}---")
+    print(f"Processing: {variant.get('Hugo_Symbol')} {variant.get('HGVSp_Short')} ({len(indices)} input row(s))")
+    # Forward the run config so the ReAct log callback reaches deep_research_node
+    result = await variant_app.ainvoke(state, config)
+    reports = result.get('processed_variants_reports', [])
+    return {"processed_variants_reports": [{**r, "variant_index": i} for i in indices for r in reports]}
 
-workflow.add_edge("deep_researcher", "single_variant_synthesizer")
-workflow.add_edge("single_variant_synthesizer", "get_next_variant")
+
+workflow = StateGraph(AgentState)
+
+workflow.add_node("annotator", annotator_node)
+workflow.add_node("process_variant", process_variant_node)
+workflow.add_node("final_combiner", final_combiner_node)
+
+workflow.set_entry_point("annotator")
+# Variants run concurrently; the number of branches in flight is capped by the `max_concurrency` run config
+workflow.add_conditional_edges("annotator", fan_out_variants, ["process_variant", "final_combiner"])
+workflow.add_edge("process_variant", "final_combiner")
 workflow.add_edge("final_combiner", END)
 
 app = workflow.compile()
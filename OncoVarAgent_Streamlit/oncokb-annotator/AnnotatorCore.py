@@ -1,20 +1,36 @@
 #!/usr/bin/env python
+import bisect
 import datetime
+import gzip
+import hashlib
 import json
 import csv
-import sys
 
 import requests
 import os.path
 import logging
 import re
+import io
+import sqlite3
 import ctypes as ct
+import struct
+import threading
+import time
+import zlib
 
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 from datetime import date
 
+# zstandard is only needed to read or write .zst files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -37,10 +53,17 @@ oncokb_annotation_api_url = oncokb_api_url + "/v1"
 
 oncokb_api_bearer_token = ""
 
-# 'U', which no longer has any effect in python 3. 3.11 completely removed the option.
-# It will throw error if we don't do condition check.
-# https://stackoverflow.com/questions/56791545/what-is-the-non-deprecated-version-of-open-u-mode
-DEFAULT_READ_FILE_MODE = 'r' if sys.version_info.major > 2 else 'rU'
+DEFAULT_READ_FILE_MODE = 'r'
+
+# annotated files are written a batch at a time, a large buffer turns those into few big writes
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# input files are decompressed on the fly based on their content, output files are compressed based on their
+# extension: .gz, .bgz (bgzip, readable by gzip and indexable by tabix) or .zst
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_COMPRESS_LEVEL = 6
+ZSTD_COMPRESS_LEVEL = 3
 
 
 def setoncokbbaseurl(u):
@@ -49,6 +72,8 @@ def setoncokbbaseurl(u):
         global oncokb_annotation_api_url
         oncokb_api_url = u.rstrip('/') + '/api'
         oncokb_annotation_api_url = oncokb_api_url + '/v1'
+        global _oncokb_data_version
+        _oncokb_data_version = None
 
 
 def setoncokbapitoken(t):
@@ -72,12 +97,23 @@ def set3dhotspotsbaseurl(u):
     _3dhotspotsbaseurl = u
 
 
+# Hotspot catalogs are kept on disk and downloaded again once they are older than HOTSPOTS_CACHE_MAX_AGE_DAYS
+hotspotscachedir = os.path.join(os.path.expanduser('~'), '.cache', 'oncokb-annotator')
+HOTSPOTS_CACHE_MAX_AGE_DAYS = 7
+
+
+def sethotspotscachedir(d):
+    global hotspotscachedir
+    hotspotscachedir = d
+
+
 sampleidsfilter = None
 
 
 def setsampleidsfileterfile(f):
     global sampleidsfilter
-    content = [line.rstrip() for line in open(f)]
+    with openinputfile(f) as infile:
+        content = [line.rstrip() for line in infile]
     sampleidsfilter = set(content)
     log.info(len(sampleidsfilter))
 
@@ -291,29 +327,150 @@ def validate_oncokb_token():
         exit()
 
 
+def requirezstandard(f):
+    if zstandard is None:
+        raise ImportError('The python package zstandard is required to read or write %s, '
+                          'install it with: pip install zstandard' % f)
+
+
+def openinputfile(infile):
+    with open(infile, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        # bgzip files are concatenated gzip members, which gzip reads as one stream
+        return gzip.open(infile, 'rt')
+    if magic == ZSTD_MAGIC:
+        requirezstandard(infile)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(infile, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(io.BufferedReader(reader))
+    return open(infile, DEFAULT_READ_FILE_MODE)
+
+
+class BgzfWriter(io.RawIOBase):
+    # https://samtools.github.io/hts-specs/SAMv1.pdf section 4.1, every block is a gzip member of at most 64 KiB
+    # with the compressed size in the BC extra field, the file ends with an empty block
+    BLOCK_DATA_SIZE = 0xff00
+    EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self, outfile):
+        self.f = open(outfile, 'wb')
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        while len(self.data) >= self.BLOCK_DATA_SIZE:
+            self.writeblock(bytes(self.data[:self.BLOCK_DATA_SIZE]))
+            del self.data[:self.BLOCK_DATA_SIZE]
+        return len(b)
+
+    def writeblock(self, data):
+        compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        self.f.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00')
+        self.f.write(struct.pack('<H', len(cdata) + 25))
+        self.f.write(cdata)
+        self.f.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        if not self.closed:
+            if len(self.data) > 0:
+                self.writeblock(bytes(self.data))
+            self.f.write(self.EOF_BLOCK)
+            self.f.close()
+        super(BgzfWriter, self).close()
+
+
+def openoutputfile(outfile):
+    if outfile.endswith('.gz'):
+        return gzip.open(outfile, 'wt', compresslevel=GZIP_COMPRESS_LEVEL)
+    if outfile.endswith('.bgz'):
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(outfile), OUTPUT_BUFFER_SIZE))
+    if outfile.endswith('.zst'):
+        requirezstandard(outfile)
+        writer = zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL).stream_writer(open(outfile, 'wb'))
+        return io.TextIOWrapper(io.BufferedWriter(writer, OUTPUT_BUFFER_SIZE))
+    return open(outfile, 'w+', OUTPUT_BUFFER_SIZE)
+
+
 def generateReadme(outfile):
-    outf = open(outfile, 'w+', 1000)
+    outf = openoutputfile(outfile)
     outf.write(getOncokbInfo())
     outf.close()
 
 
-def gethotspots(url, type):
-    hotspots = {}
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
-    if response.status_code == 200:
+def gethotspotsjson(url):
+    cachefile = None
+    if hotspotscachedir:
+        cachefile = os.path.join(hotspotscachedir, 'hotspots-%s.json' % hashlib.md5(url.encode('utf-8')).hexdigest())
+        maxage = HOTSPOTS_CACHE_MAX_AGE_DAYS * 24 * 3600
+        if os.path.isfile(cachefile) and time.time() - os.path.getmtime(cachefile) < maxage:
+            with open(cachefile) as f:
+                return json.load(f)
+
+    try:
+        response = requests.get(url, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
         hotspotsjson = response.json()
+    except Exception as e:
+        if cachefile and os.path.isfile(cachefile):
+            log.warning("error when processing %s, the cached copy is used\n" % url + "reason: %s" % e)
+            with open(cachefile) as f:
+                return json.load(f)
+        log.error("error when processing %s \n" % url + "reason: %s" % e)
+        return None
+
+    if cachefile:
+        try:
+            if not os.path.isdir(hotspotscachedir):
+                os.makedirs(hotspotscachedir)
+            # written next to the cache and moved in place, so that concurrent runs never read a partial file
+            tmpfile = '%s.%d.tmp' % (cachefile, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump(hotspotsjson, f)
+            os.replace(tmpfile, cachefile)
+        except OSError as e:
+            log.warning("error when caching %s: %s" % (url, e))
+    return hotspotsjson
+
+
+# Hotspots of a gene are stored as sorted, non-overlapping residue intervals in two lists of starts and ends
+def buildhotspotintervals(ranges):
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if len(ends) > 0 and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
 
+def overlapshotspot(intervals, start, end):
+    starts, ends = intervals
+    # the last interval starting at or before the end is the only one that can reach the start
+    i = bisect.bisect_right(starts, end) - 1
+    return start <= end and i >= 0 and ends[i] >= start
+
+
+def gethotspots(url, type):
+    hotspots = {}
+    hotspotsjson = gethotspotsjson(url)
+    if hotspotsjson is not None:
+        ranges = {}
         for hs in hotspotsjson:
             gene = hs['hugoSymbol']
             start = hs['aminoAcidPosition']['start']
             end = hs['aminoAcidPosition']['end']
             if type is None or hs['type'] == type:
-                if gene not in hotspots:
-                    hotspots[gene] = set()
-                for i in range(start, end + 1):
-                    hotspots[gene].add(i)
-    else:
-        log.error("error when processing %s \n" % url + "reason: %s" % response.reason)
+                if gene not in ranges:
+                    ranges[gene] = []
+                ranges[gene].append((start, end))
+        for gene in ranges:
+            hotspots[gene] = buildhotspotintervals(ranges[gene])
     return hotspots
 
 
@@ -323,6 +480,7 @@ def requests_retry_session(
         status_forcelist=API_REQUEST_RETRY_STATUS_FORCELIST,
         allowed_methods=('GET', 'HEAD'),
         session=None,
+        pool_maxsize=requests.adapters.DEFAULT_POOLSIZE,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -333,20 +491,66 @@ def requests_retry_session(
         status_forcelist=status_forcelist,
         allowed_methods=allowed_methods,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+# All OncoKB API requests go through one session, so the connections stay open across batches
+# instead of being set up again for every request.
+API_POOL_SIZE = 10
+API_KEEP_ALIVE = True
+API_REQUEST_RETRIES = 3
+API_REQUEST_BACKOFF_FACTOR = 0.3
+
+_oncokb_session = None
+
+
+def setoncokbsessionoptions(pool_size=None, keep_alive=None, retries=None, backoff_factor=None):
+    global API_POOL_SIZE, API_KEEP_ALIVE, API_REQUEST_RETRIES, API_REQUEST_BACKOFF_FACTOR, _oncokb_session
+    if pool_size is not None:
+        API_POOL_SIZE = pool_size
+    if keep_alive is not None:
+        API_KEEP_ALIVE = keep_alive
+    if retries is not None:
+        API_REQUEST_RETRIES = retries
+    if backoff_factor is not None:
+        API_REQUEST_BACKOFF_FACTOR = backoff_factor
+    if _oncokb_session is not None:
+        _oncokb_session.close()
+        _oncokb_session = None
+
+
+def getoncokbsession():
+    global _oncokb_session
+    if _oncokb_session is None:
+        session = requests_retry_session(retries=API_REQUEST_RETRIES, backoff_factor=API_REQUEST_BACKOFF_FACTOR,
+                                         allowed_methods=['HEAD', 'GET', 'POST'], pool_maxsize=API_POOL_SIZE)
+        if not API_KEEP_ALIVE:
+            session.headers['Connection'] = 'close'
+        _oncokb_session = session
+    return _oncokb_session
+
+
+def logoncokbsessionstats():
+    if _oncokb_session is None or not log.isEnabledFor(logging.DEBUG):
+        return
+    adapter = _oncokb_session.get_adapter('https://')
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools[key]
+        log.debug('%s://%s: %d requests over %d connections' % (
+            pool.scheme, pool.host, pool.num_requests, pool.num_connections))
+
+
 def makeoncokbpostrequest(url, body):
     headers = {
         'Content-Type': 'application/json',
         'Authorization': 'Bearer %s' % oncokb_api_bearer_token
     }
-    return requests_retry_session(allowed_methods=["POST"]).post(url, headers=headers,
-                                                                 data=json.dumps(body, default=lambda o: o.__dict__),
-                                                                 timeout=REQUEST_TIMEOUT)
+    return getoncokbsession().post(url, headers=headers, data=json.dumps(body, default=lambda o: o.__dict__),
+                                   timeout=REQUEST_TIMEOUT)
 
 
 def makeoncokbgetrequest(url):
@@ -354,7 +558,94 @@ def makeoncokbgetrequest(url):
         'Content-Type': 'application/json',
         'Authorization': 'Bearer %s' % oncokb_api_bearer_token
     }
-    return requests_retry_session(allowed_methods=["HEAD", "GET"]).get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    return getoncokbsession().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+
+
+# Raw OncoKB annotations are cached on disk keyed on the serialized query (endpoint included) and the
+# OncoKB data version, so a data release invalidates every entry. The cache is off unless a file is set.
+annotation_cache_file = None
+annotation_cache_stats = {'hits': 0, 'misses': 0}
+_annotation_cache_stats_lock = threading.Lock()
+_oncokb_data_version = None
+
+ANNOTATION_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    data_version TEXT NOT NULL,
+    query TEXT NOT NULL,
+    annotation TEXT NOT NULL,
+    PRIMARY KEY (data_version, query)
+) WITHOUT ROWID
+"""
+
+
+def setannotationcachefile(f):
+    global annotation_cache_file
+    annotation_cache_file = f
+
+
+def getoncokbdataversion():
+    global _oncokb_data_version
+    if _oncokb_data_version is None:
+        try:
+            info = requests.get(oncokb_annotation_api_url + "/info", timeout=REQUEST_TIMEOUT).json()
+            _oncokb_data_version = info['dataVersion']['version']
+        except Exception:
+            log.warning("error when fetch OncoKB data version, the annotation cache is not used")
+    return _oncokb_data_version
+
+
+def serializequery(url, query):
+    return json.dumps([url, query], default=lambda o: o.__dict__, sort_keys=True)
+
+
+def openannotationcache():
+    conn = sqlite3.connect(annotation_cache_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(ANNOTATION_CACHE_SCHEMA)
+    return conn
+
+
+# fetch(url, queries) returns one raw annotation per query, None when the query failed
+def getannotations(url, queries, fetch):
+    if not annotation_cache_file or getoncokbdataversion() is None:
+        return fetch(url, queries)
+
+    keys = [serializequery(url, query) for query in queries]
+    annotations = [None] * len(queries)
+    misses = []
+    conn = openannotationcache()
+    try:
+        for i, key in enumerate(keys):
+            cached = conn.execute('SELECT annotation FROM annotations WHERE data_version = ? AND query = ?',
+                                  (_oncokb_data_version, key)).fetchone()
+            if cached is None:
+                misses.append(i)
+            else:
+                annotations[i] = json.loads(cached[0])
+        with _annotation_cache_stats_lock:
+            annotation_cache_stats['hits'] += len(queries) - len(misses)
+            annotation_cache_stats['misses'] += len(misses)
+
+        if len(misses) > 0:
+            fetched = fetch(url, [queries[i] for i in misses])
+            for i, annotation in zip(misses, fetched):
+                annotations[i] = annotation
+            # failed queries are not cached so that they are retried on the next run
+            conn.executemany('INSERT OR REPLACE INTO annotations (data_version, query, annotation) VALUES (?, ?, ?)',
+                             [(_oncokb_data_version, keys[i], json.dumps(annotation))
+                              for i, annotation in zip(misses, fetched) if annotation is not None])
+            conn.commit()
+    finally:
+        conn.close()
+    return annotations
+
+
+def logannotationcachestats():
+    if annotation_cache_file:
+        log.info('annotation cache: %d hits, %d misses' % (
+            annotation_cache_stats['hits'], annotation_cache_stats['misses']))
+    annotation_cache_stats['hits'] = 0
+    annotation_cache_stats['misses'] = 0
 
 
 _3dhotspots = None
@@ -409,15 +700,14 @@ def append_annotation_to_file(outf, ncols, rows, annotations):
     if len(rows) != len(annotations):
         log.error('The length of the rows and annotations do not match')
 
-    for index, annotation in enumerate(annotations):
-        row = rows[index]
-        if annotation is not None:
-            row = row + annotation
+    if len(annotations) == 0:
+        return
 
-        row = padrow(row, ncols)
-        rowstr = '\t'.join(row)
-        rowstr = rowstr.encode('ascii', 'ignore').decode('ascii')
-        outf.write(rowstr + "\n")
+    # the whole batch is serialized and written at once, non-ascii characters are dropped from the output
+    batchstr = '\n'.join(['\t'.join(padrow(row if annotation is None else row + annotation, ncols))
+                          for row, annotation in zip(rows, annotations)])
+    batchstr = batchstr.encode('ascii', 'ignore').decode('ascii')
+    outf.write(batchstr + "\n")
 
 
 def get_tumor_type_from_row(row, row_index, defaultCancerType, icancertype, cancerTypeMap, sample):
@@ -505,50 +795,74 @@ def processalterationevents(eventfile, outfile, previousoutfile, defaultCancerTy
         init_3d_hotspots()
     if os.path.isfile(previousoutfile):
         cacheannotated(previousoutfile, defaultCancerType, cancerTypeMap)
-    outf = open(outfile, 'w+', 1000)
-    with open(eventfile, DEFAULT_READ_FILE_MODE) as infile:
+    outf = openoutputfile(outfile)
+    with openinputfile(eventfile) as infile:
         reader = csv.reader(infile, delimiter='\t')
+        annotatealterationevents(reader, outf, defaultCancerType, cancerTypeMap, annotatehotspots,
+                                 user_input_query_type, default_reference_genome, include_descriptions)
+    outf.close()
 
-        headers = readheaders(reader)
 
-        ncols = headers["length"]
-        if ncols == 0:
-            return
-        newncols = 0
+def annotatealterationrecords(records, defaultCancerType, cancerTypeMap=None, annotatehotspots=False,
+                              user_input_query_type=None, default_reference_genome=None, include_descriptions=False):
+    # Library mode of processalterationevents: annotates in-memory rows (dicts keyed by column name, as in a MAF)
+    # and returns the annotated rows as dicts with the same columns MafAnnotator.py would write.
+    if not records:
+        return []
+    if annotatehotspots and _3dhotspots is None:
+        init_3d_hotspots()
+    columns = list(records[0].keys())
+    rows = [columns] + [['' if record.get(c) is None else str(record.get(c)) for c in columns] for record in records]
+    outf = io.StringIO()
+    annotatealterationevents(iter(rows), outf, defaultCancerType, cancerTypeMap or {}, annotatehotspots,
+                             user_input_query_type, default_reference_genome, include_descriptions)
+    outf.seek(0)
+    return list(csv.DictReader(outf, delimiter='\t'))
 
-        outf.write(headers['^-$'])
 
-        if annotatehotspots:
-            outf.write("\tIS-A-HOTSPOT")
-            outf.write("\tIS-A-3D-HOTSPOT")
-            newncols += 2
+def annotatealterationevents(reader, outf, defaultCancerType, cancerTypeMap, annotatehotspots, user_input_query_type,
+                             default_reference_genome, include_descriptions):
+    headers = readheaders(reader)
 
-        outf.write("\t")
+    ncols = headers["length"]
+    if ncols == 0:
+        return
+    newncols = 0
 
-        query_type = resolve_query_type(user_input_query_type, headers)
-        if (query_type == QueryType.HGVSP_SHORT):
-            newncols = append_headers(outf, newncols, include_descriptions, False)
-            process_alteration(reader, outf, headers, [HGVSP_SHORT_HEADER, ALTERATION_HEADER], ncols, newncols,
-                               defaultCancerType,
-                               cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
-
-        if (query_type == QueryType.HGVSP):
-            newncols = append_headers(outf, newncols, include_descriptions, False)
-            process_alteration(reader, outf, headers, [HGVSP_HEADER, ALTERATION_HEADER], ncols, newncols,
-                               defaultCancerType,
-                               cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
-
-        if (query_type == QueryType.HGVSG):
-            newncols = append_headers(outf, newncols, include_descriptions, True)
-            process_hvsg(reader, outf, headers, [HGVSG_HEADER, ALTERATION_HEADER], ncols, newncols, defaultCancerType,
-                         cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
-
-        if (query_type == QueryType.GENOMIC_CHANGE):
-            newncols = append_headers(outf, newncols, include_descriptions, True)
-            process_genomic_change(reader, outf, headers, ncols, newncols, defaultCancerType, cancerTypeMap,
-                                   annotatehotspots, default_reference_genome, include_descriptions)
+    outf.write(headers['^-$'])
 
-    outf.close()
+    if annotatehotspots:
+        outf.write("\tIS-A-HOTSPOT")
+        outf.write("\tIS-A-3D-HOTSPOT")
+        newncols += 2
+
+    outf.write("\t")
+
+    query_type = resolve_query_type(user_input_query_type, headers)
+    if (query_type == QueryType.HGVSP_SHORT):
+        newncols = append_headers(outf, newncols, include_descriptions, False)
+        process_alteration(reader, outf, headers, [HGVSP_SHORT_HEADER, ALTERATION_HEADER], ncols, newncols,
+                           defaultCancerType,
+                           cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
+
+    if (query_type == QueryType.HGVSP):
+        newncols = append_headers(outf, newncols, include_descriptions, False)
+        process_alteration(reader, outf, headers, [HGVSP_HEADER, ALTERATION_HEADER], ncols, newncols,
+                           defaultCancerType,
+                           cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
+
+    if (query_type == QueryType.HGVSG):
+        newncols = append_headers(outf, newncols, include_descriptions, True)
+        process_hvsg(reader, outf, headers, [HGVSG_HEADER, ALTERATION_HEADER], ncols, newncols, defaultCancerType,
+                     cancerTypeMap, annotatehotspots, default_reference_genome, include_descriptions)
+
+    if (query_type == QueryType.GENOMIC_CHANGE):
+        newncols = append_headers(outf, newncols, include_descriptions, True)
+        process_genomic_change(reader, outf, headers, ncols, newncols, defaultCancerType, cancerTypeMap,
+                               annotatehotspots, default_reference_genome, include_descriptions)
+
+    logannotationcachestats()
+    logoncokbsessionstats()
 
 
 def get_cell_content(row, index, return_empty_string=False):
@@ -608,74 +922,79 @@ def process_alteration(maffilereader, outf, maf_headers, alteration_column_names
     ireferencegenome = geIndexOfHeader(maf_headers, REFERENCE_GENOME_HEADERS)
 
     posp = re.compile('[0-9]+')
+    annotation_headers = get_annotation_column_headers(annotatehotspots, include_descriptions, False)
 
-    i = 0
-    queries = []
-    rows = []
-    for row in maffilereader:
-        i = i + 1
-
-        if i % POST_QUERIES_THRESHOLD == 0:
-            log.info(i)
-
-        row = padrow(row, ncols)
-
-        sample = row[isample]
-        if sampleidsfilter and sample not in sampleidsfilter:
-            continue
+    with AnnotationPipeline(outf, ncols + nannotationcols) as pipeline:
+        i = 0
+        queries = []
+        rows = []
+        previous_annotations = []
+        for row in maffilereader:
+            i = i + 1
 
-        hugo = row[ihugo]
+            if i % POST_QUERIES_THRESHOLD == 0:
+                log.info(i)
 
-        consequence = get_cell_content(row, iconsequence)
-        if consequence in mutationtypeconsequencemap:
-            consequence = '%2B'.join(mutationtypeconsequencemap[consequence])
+            row = padrow(row, ncols)
 
-        hgvs = row[ihgvs]
-        if hgvs.startswith('p.'):
-            hgvs = hgvs[2:]
+            sample = row[isample]
+            if sampleidsfilter and sample not in sampleidsfilter:
+                continue
 
-        cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
-        reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
-                                                         default_reference_genome)
+            hugo = row[ihugo]
 
-        hgvs = conversion(hgvs)
+            consequence = get_cell_content(row, iconsequence)
+            if consequence in mutationtypeconsequencemap:
+                consequence = '%2B'.join(mutationtypeconsequencemap[consequence])
 
-        start = get_cell_content(row, istart)
+            hgvs = row[ihgvs]
+            if hgvs.startswith('p.'):
+                hgvs = hgvs[2:]
 
-        end = get_cell_content(row, iend)
+            cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+            reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
+                                                             default_reference_genome)
 
-        if start is None and iproteinpos >= 0 and row[iproteinpos] != "" and row[iproteinpos] != "." and \
-                row[iproteinpos] != "-":
-            poss = row[iproteinpos].split('/')[0].split('-')
-            try:
-                if len(poss) > 0:
-                    start = int(poss[0])
-                if len(poss) == 2:
-                    end = int(poss[1])
-            except ValueError:
-                log.info("position wrong at line %s: %s" % (str(i), row[iproteinpos]))
+            hgvs = conversion(hgvs)
 
-        if start is None and consequence == "missense_variant":
-            m = posp.search(hgvs)
-            if m:
-                start = m.group()
+            start = get_cell_content(row, istart)
 
-        if start is not None and end is None:
-            end = start
+            end = get_cell_content(row, iend)
 
-        query = ProteinChangeQuery(hugo, hgvs, cancertype, reference_genome, consequence, start, end)
-        queries.append(query)
-        rows.append(row)
+            if start is None and iproteinpos >= 0 and row[iproteinpos] != "" and row[iproteinpos] != "." and \
+                    row[iproteinpos] != "-":
+                poss = row[iproteinpos].split('/')[0].split('-')
+                try:
+                    if len(poss) > 0:
+                        start = int(poss[0])
+                    if len(poss) == 2:
+                        end = int(poss[1])
+                except ValueError:
+                    log.info("position wrong at line %s: %s" % (str(i), row[iproteinpos]))
+
+            if start is None and consequence == "missense_variant":
+                m = posp.search(hgvs)
+                if m:
+                    start = m.group()
+
+            if start is not None and end is None:
+                end = start
+
+            query = ProteinChangeQuery(hugo, hgvs, cancertype, reference_genome, consequence, start, end)
+            queries.append(query)
+            rows.append(row)
+            previous_annotations.append(get_previous_annotation(row, cancertype, annotation_headers))
 
-        if len(queries) == POST_QUERIES_THRESHOLD:
-            annotations = pull_protein_change_info(queries, include_descriptions, annotatehotspots)
-            append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
-            queries = []
-            rows = []
+            if len(rows) == POST_QUERIES_THRESHOLD:
+                pipeline.submit(rows, previous_annotations, queries, pull_protein_change_info, include_descriptions,
+                                annotatehotspots)
+                queries = []
+                rows = []
+                previous_annotations = []
 
-    if len(queries) > 0:
-        annotations = pull_protein_change_info(queries, include_descriptions, annotatehotspots)
-        append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
+        if len(rows) > 0:
+            pipeline.submit(rows, previous_annotations, queries, pull_protein_change_info, include_descriptions,
+                            annotatehotspots)
 
 
 # this method is from genome-nexus annotation-tools
@@ -710,47 +1029,52 @@ def process_genomic_change(maffilereader, outf, maf_headers, ncols, nannotationc
     isample = geIndexOfHeader(maf_headers, SAMPLE_HEADERS)
     icancertype = geIndexOfHeader(maf_headers, CANCER_TYPE_HEADERS)
     ireferencegenome = geIndexOfHeader(maf_headers, REFERENCE_GENOME_HEADERS)
+    annotation_headers = get_annotation_column_headers(annotatehotspots, include_descriptions, True)
 
-    i = 0
-    queries = []
-    rows = []
-    for row in maffilereader:
-        i = i + 1
+    with AnnotationPipeline(outf, ncols + nannotationcols) as pipeline:
+        i = 0
+        queries = []
+        rows = []
+        previous_annotations = []
+        for row in maffilereader:
+            i = i + 1
 
-        if i % POST_QUERIES_THRESHOLD_GC_HGVSG == 0:
-            log.info(i)
+            if i % POST_QUERIES_THRESHOLD_GC_HGVSG == 0:
+                log.info(i)
 
-        row = padrow(row, ncols)
+            row = padrow(row, ncols)
 
-        sample = row[isample]
-        if sampleidsfilter and sample not in sampleidsfilter:
-            continue
+            sample = row[isample]
+            if sampleidsfilter and sample not in sampleidsfilter:
+                continue
 
-        cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
-        reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
-                                                         default_reference_genome)
-
-        chromosome = get_cell_content(row, ichromosome, True)
-        start = get_cell_content(row, istart, True)
-        end = get_cell_content(row, iend, True)
-        ref_allele = get_cell_content(row, irefallele, True)
-        var_allele_1 = get_cell_content(row, ivarallele1, True)
-        var_allele_2 = get_cell_content(row, ivarallele2, True)
-        var_allele = get_var_allele(ref_allele, var_allele_1, var_allele_2)
-
-        query = GenomicChangeQuery(chromosome, start, end, ref_allele, var_allele, cancertype, reference_genome)
-        queries.append(query)
-        rows.append(row)
-
-        if len(queries) == POST_QUERIES_THRESHOLD_GC_HGVSG:
-            annotations = pull_genomic_change_info(queries, include_descriptions, annotatehotspots)
-            append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
-            queries = []
-            rows = []
+            cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+            reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
+                                                             default_reference_genome)
+
+            chromosome = get_cell_content(row, ichromosome, True)
+            start = get_cell_content(row, istart, True)
+            end = get_cell_content(row, iend, True)
+            ref_allele = get_cell_content(row, irefallele, True)
+            var_allele_1 = get_cell_content(row, ivarallele1, True)
+            var_allele_2 = get_cell_content(row, ivarallele2, True)
+            var_allele = get_var_allele(ref_allele, var_allele_1, var_allele_2)
+
+            query = GenomicChangeQuery(chromosome, start, end, ref_allele, var_allele, cancertype, reference_genome)
+            queries.append(query)
+            rows.append(row)
+            previous_annotations.append(get_previous_annotation(row, cancertype, annotation_headers))
 
-    if len(queries) > 0:
-        annotations = pull_genomic_change_info(queries, include_descriptions, annotatehotspots)
-        append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
+            if len(rows) == POST_QUERIES_THRESHOLD_GC_HGVSG:
+                pipeline.submit(rows, previous_annotations, queries, pull_genomic_change_info, include_descriptions,
+                                annotatehotspots)
+                queries = []
+                rows = []
+                previous_annotations = []
+
+        if len(rows) > 0:
+            pipeline.submit(rows, previous_annotations, queries, pull_genomic_change_info, include_descriptions,
+                            annotatehotspots)
 
 
 def process_hvsg(maffilereader, outf, maf_headers, alteration_column_names, ncols, nannotationcols, defaultCancerType,
@@ -759,49 +1083,56 @@ def process_hvsg(maffilereader, outf, maf_headers, alteration_column_names, ncol
     isample = geIndexOfHeader(maf_headers, SAMPLE_HEADERS)
     icancertype = geIndexOfHeader(maf_headers, CANCER_TYPE_HEADERS)
     ireferencegenome = geIndexOfHeader(maf_headers, REFERENCE_GENOME_HEADERS)
+    annotation_headers = get_annotation_column_headers(annotatehotspots, include_descriptions, True)
 
-    i = 0
-    queries = []
-    rows = []
-    for row in maffilereader:
-        i = i + 1
+    with AnnotationPipeline(outf, ncols + nannotationcols) as pipeline:
+        i = 0
+        queries = []
+        rows = []
+        previous_annotations = []
+        for row in maffilereader:
+            i = i + 1
 
-        if i % POST_QUERIES_THRESHOLD_GC_HGVSG == 0:
-            log.info(i)
+            if i % POST_QUERIES_THRESHOLD_GC_HGVSG == 0:
+                log.info(i)
 
-        row = padrow(row, ncols)
+            row = padrow(row, ncols)
 
-        sample = row[isample]
-        if sampleidsfilter and sample not in sampleidsfilter:
-            continue
+            sample = row[isample]
+            if sampleidsfilter and sample not in sampleidsfilter:
+                continue
 
-        hgvsg = get_cell_content(row, ihgvsg)
+            hgvsg = get_cell_content(row, ihgvsg)
 
-        cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
-        reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
-                                                         default_reference_genome)
+            cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+            reference_genome = get_reference_genome_from_row(get_cell_content(row, ireferencegenome),
+                                                             default_reference_genome)
 
-        if hgvsg is None:
-            if annotatehotspots:
-                default_cols = [['', '', 'False']]
+            if hgvsg is None:
+                # the row is not queried, it is written with the default columns in its place in the batch
+                if annotatehotspots:
+                    default_cols = ['', '', 'False']
+                else:
+                    default_cols = ['False']
+                queries.append(None)
+                rows.append(row)
+                previous_annotations.append(default_cols)
             else:
-                default_cols = [['False']]
-            append_annotation_to_file(outf, ncols + nannotationcols, [row],
-                                      default_cols)
-        else:
-            query = HGVSgQuery(hgvsg, cancertype, reference_genome)
-            queries.append(query)
-            rows.append(row)
+                query = HGVSgQuery(hgvsg, cancertype, reference_genome)
+                queries.append(query)
+                rows.append(row)
+                previous_annotations.append(get_previous_annotation(row, cancertype, annotation_headers))
 
-        if len(queries) == POST_QUERIES_THRESHOLD_GC_HGVSG:
-            annotations = pull_hgvsg_info(queries, include_descriptions, annotatehotspots)
-            append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
-            queries = []
-            rows = []
+            if len(rows) == POST_QUERIES_THRESHOLD_GC_HGVSG:
+                pipeline.submit(rows, previous_annotations, queries, pull_hgvsg_info, include_descriptions,
+                                annotatehotspots)
+                queries = []
+                rows = []
+                previous_annotations = []
 
-    if len(queries) > 0:
-        annotations = pull_hgvsg_info(queries, include_descriptions, annotatehotspots)
-        append_annotation_to_file(outf, ncols + nannotationcols, rows, annotations)
+        if len(rows) > 0:
+            pipeline.submit(rows, previous_annotations, queries, pull_hgvsg_info, include_descriptions,
+                            annotatehotspots)
 
 
 def getgenesfromfusion(fusion, nameregex=None):
@@ -823,8 +1154,8 @@ def getgenesfromfusion(fusion, nameregex=None):
 def process_fusion(svdata, outfile, previousoutfile, defaultCancerType, cancerTypeMap, nameregex, include_descriptions):
     if os.path.isfile(previousoutfile):
         cacheannotated(previousoutfile, defaultCancerType, cancerTypeMap)
-    outf = open(outfile, 'w+')
-    with open(svdata, DEFAULT_READ_FILE_MODE) as infile:
+    outf = openoutputfile(outfile)
+    with openinputfile(svdata) as infile:
         reader = csv.reader(infile, delimiter='\t')
 
         headers = readheaders(reader)
@@ -848,53 +1179,57 @@ def process_fusion(svdata, outfile, previousoutfile, defaultCancerType, cancerTy
         isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
         icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
 
-        i = 0
-        queries = []
-        rows = []
-        for row in reader:
-            i = i + 1
-            if i % POST_QUERIES_THRESHOLD == 0:
-                log.info(i)
-
-            row = padrow(row, ncols)
-
-            sample = row[isample]
+        with AnnotationPipeline(outf, newcols) as pipeline:
+            i = 0
+            queries = []
+            rows = []
+            previous_annotations = []
+            for row in reader:
+                i = i + 1
+                if i % POST_QUERIES_THRESHOLD == 0:
+                    log.info(i)
 
-            if sampleidsfilter and sample not in sampleidsfilter:
-                continue
+                row = padrow(row, ncols)
 
-            geneA = None
-            geneB = None
-            if igeneA >= 0:
-                geneA = row[igeneA]
-            if igeneB >= 0:
-                geneB = row[igeneB]
-            if igeneA < 0 and igeneB < 0 and ifusion >= 0:
-                fusion = row[ifusion]
-                geneA, geneB = getgenesfromfusion(fusion, nameregex)
+                sample = row[isample]
 
-            cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+                if sampleidsfilter and sample not in sampleidsfilter:
+                    continue
 
-            queries.append(StructuralVariantQuery(geneA, geneB, 'FUSION', cancertype))
-            rows.append(row)
+                geneA = None
+                geneB = None
+                if igeneA >= 0:
+                    geneA = row[igeneA]
+                if igeneB >= 0:
+                    geneB = row[igeneB]
+                if igeneA < 0 and igeneB < 0 and ifusion >= 0:
+                    fusion = row[ifusion]
+                    geneA, geneB = getgenesfromfusion(fusion, nameregex)
 
-            if len(queries) == POST_QUERIES_THRESHOLD:
-                annotations = pull_structural_variant_info(queries, include_descriptions)
-                append_annotation_to_file(outf, newcols, rows, annotations)
-                queries = []
-                rows = []
+                cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
 
-        if len(queries) > 0:
-            annotations = pull_structural_variant_info(queries, include_descriptions)
-            append_annotation_to_file(outf, newcols, rows, annotations)
+                queries.append(StructuralVariantQuery(geneA, geneB, 'FUSION', cancertype))
+                rows.append(row)
+                previous_annotations.append(get_previous_annotation(row, cancertype, oncokb_annotation_headers))
+
+                if len(rows) == POST_QUERIES_THRESHOLD:
+                    pipeline.submit(rows, previous_annotations, queries, pull_structural_variant_info, include_descriptions)
+                    queries = []
+                    rows = []
+                    previous_annotations = []
+
+            if len(rows) > 0:
+                pipeline.submit(rows, previous_annotations, queries, pull_structural_variant_info, include_descriptions)
+    logannotationcachestats()
+    logoncokbsessionstats()
     outf.close()
 
 
 def process_sv(svdata, outfile, previousoutfile, defaultCancerType, cancerTypeMap, include_descriptions):
     if os.path.isfile(previousoutfile):
         cacheannotated(previousoutfile, defaultCancerType, cancerTypeMap)
-    outf = open(outfile, 'w+')
-    with open(svdata, DEFAULT_READ_FILE_MODE) as infile:
+    outf = openoutputfile(outfile)
+    with openinputfile(svdata) as infile:
         reader = csv.reader(infile, delimiter='\t')
 
         headers = readheaders(reader)
@@ -918,56 +1253,60 @@ def process_sv(svdata, outfile, previousoutfile, defaultCancerType, cancerTypeMa
         isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
         icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
 
-        i = 0
-        queries = []
-        rows = []
-        for row in reader:
-            i = i + 1
-            if i % POST_QUERIES_THRESHOLD == 0:
-                log.info(i)
-
-            row = padrow(row, ncols)
-
-            sample = row[isample]
-
-            if sampleidsfilter and sample not in sampleidsfilter:
-                continue
-
-            if igeneA < 0 or igeneB < 0:
-                log.warning("Please specify two genes")
-                continue
-
-            # SVs will sometimes have only 1 gene (intragenic)
-            genes = []
-            if (igeneA > -1):
-                genes.append(igeneA)
-            if (igeneB > -1):
-                genes.append(igeneB)
-
-            svtype = None
-            if isvtype >= 0:
-                svtype = row[isvtype].upper()
-                if svtype not in SV_TYPES:
-                    svtype = None
-            if svtype is None:
-                svtype = UNKNOWN
-
-            cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+        with AnnotationPipeline(outf, newcols) as pipeline:
+            i = 0
+            queries = []
+            rows = []
+            previous_annotations = []
+            for row in reader:
+                i = i + 1
+                if i % POST_QUERIES_THRESHOLD == 0:
+                    log.info(i)
 
-            # If its only one gene, it's intragenic and thus not a functional fusion
-            sv_query = StructuralVariantQuery(row[igeneA], row[igeneB], svtype, cancertype, len(genes) > 1)
-            queries.append(sv_query)
-            rows.append(row)
+                row = padrow(row, ncols)
 
-            if len(queries) == POST_QUERIES_THRESHOLD:
-                annotations = pull_structural_variant_info(queries, include_descriptions)
-                append_annotation_to_file(outf, newcols, rows, annotations)
-                queries = []
-                rows = []
+                sample = row[isample]
 
-        if len(queries) > 0:
-            annotations = pull_structural_variant_info(queries, include_descriptions)
-            append_annotation_to_file(outf, newcols, rows, annotations)
+                if sampleidsfilter and sample not in sampleidsfilter:
+                    continue
+
+                if igeneA < 0 or igeneB < 0:
+                    log.warning("Please specify two genes")
+                    continue
+
+                # SVs will sometimes have only 1 gene (intragenic)
+                genes = []
+                if (igeneA > -1):
+                    genes.append(igeneA)
+                if (igeneB > -1):
+                    genes.append(igeneB)
+
+                svtype = None
+                if isvtype >= 0:
+                    svtype = row[isvtype].upper()
+                    if svtype not in SV_TYPES:
+                        svtype = None
+                if svtype is None:
+                    svtype = UNKNOWN
+
+                cancertype = get_tumor_type_from_row(row, i, defaultCancerType, icancertype, cancerTypeMap, sample)
+
+                # If its only one gene, it's intragenic and thus not a functional fusion
+                sv_query = StructuralVariantQuery(row[igeneA], row[igeneB], svtype, cancertype, len(genes) > 1)
+                queries.append(sv_query)
+                rows.append(row)
+                previous_annotations.append(get_previous_annotation(row, cancertype, oncokb_annotation_headers))
+
+                if len(rows) == POST_QUERIES_THRESHOLD:
+                    pipeline.submit(rows, previous_annotations, queries, pull_structural_variant_info, include_descriptions)
+                    queries = []
+                    rows = []
+                    previous_annotations = []
+
+            if len(rows) > 0:
+                pipeline.submit(rows, previous_annotations, queries, pull_structural_variant_info, include_descriptions)
+    logannotationcachestats()
+    logoncokbsessionstats()
     outf.close()
 
 
@@ -985,27 +1324,38 @@ def get_cna(cell_value, annotate_gain_loss=False):
     return cna
 
 
+# The CNA readers write the output header and return the output columns with a generator of (row, query) per copy
+# number alteration, which reads the file lazily so that the annotation runs in bounded memory. Rows without a query
+# are written unannotated in their place.
 def process_gistic_data(outf, gistic_data_file, defaultCancerType, cancerTypeMap, annotate_gain_loss,
                         include_descriptions):
-    with open(gistic_data_file, DEFAULT_READ_FILE_MODE) as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        headers = readheaders(reader)
-        samples = []
-        rawsamples = []
-        if headers["length"] != 0:
-            startofsamples = getfirstcolumnofsampleingisticdata(headers['^-$'].split('\t'))
-            rawsamples = headers['^-$'].split('\t')[startofsamples:]
-        for rs in rawsamples:
-            samples.append(rs)
-
-        if defaultCancerType == '' and not set(cancerTypeMap.keys()).issuperset(set(samples)):
-            log.info(
-                "Cancer type for all samples should be defined for a more accurate result\nsamples in cna file: %s\n" % (
-                    samples))
+    infile = openinputfile(gistic_data_file)
+    reader = csv.reader(infile, delimiter='\t')
+    headers = readheaders(reader)
+    samples = []
+    rawsamples = []
+    if headers["length"] != 0:
+        startofsamples = getfirstcolumnofsampleingisticdata(headers['^-$'].split('\t'))
+        rawsamples = headers['^-$'].split('\t')[startofsamples:]
+    for rs in rawsamples:
+        samples.append(rs)
+
+    if defaultCancerType == '' and not set(cancerTypeMap.keys()).issuperset(set(samples)):
+        log.info(
+            "Cancer type for all samples should be defined for a more accurate result\nsamples in cna file: %s\n" % (
+                samples))
+
+    row_headers = ['SAMPLE_ID', 'CANCER_TYPE', 'HUGO_SYMBOL', 'ALTERATION'] + get_oncokb_annotation_column_headers(
+        include_descriptions, False)
+    outf.write('\t'.join(row_headers))
+    outf.write('\n')
+    return row_headers, iter_gistic_data(infile, reader, headers, rawsamples, defaultCancerType, cancerTypeMap,
+                                         annotate_gain_loss)
 
+
+def iter_gistic_data(infile, reader, headers, rawsamples, defaultCancerType, cancerTypeMap, annotate_gain_loss):
+    with infile:
         i = 0
-        rows = []
-        queries = []
         for row in reader:
             i = i + 1
             if i % POST_QUERIES_THRESHOLD == 0:
@@ -1032,37 +1382,32 @@ def process_gistic_data(outf, gistic_data_file, defaultCancerType, cancerTypeMap
                         if sample in cancerTypeMap:
                             cancer_type = cancerTypeMap[sample]
 
-                        rows.append([sample, cancer_type, hugo, cna_type])
-                        queries.append(CNAQuery(hugo, cna_type, cancer_type))
-
-        headers = ['SAMPLE_ID', 'CANCER_TYPE', 'HUGO_SYMBOL', 'ALTERATION'] + get_oncokb_annotation_column_headers(
-            include_descriptions, False)
-        outf.write('\t'.join(headers))
-        outf.write('\n')
-        return headers, rows, queries
+                        yield [sample, cancer_type, hugo, cna_type], CNAQuery(hugo, cna_type, cancer_type)
 
 
 def process_individual_cna_file(outf, cna_data_file, defaultCancerType, cancerTypeMap, annotate_gain_loss,
                                 include_descriptions):
-    with open(cna_data_file, DEFAULT_READ_FILE_MODE) as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        headers = readheaders(reader)
-        row_headers = headers['^-$'].split('\t') + get_oncokb_annotation_column_headers(include_descriptions, False)
+    infile = openinputfile(cna_data_file)
+    reader = csv.reader(infile, delimiter='\t')
+    headers = readheaders(reader)
+    row_headers = headers['^-$'].split('\t') + get_oncokb_annotation_column_headers(include_descriptions, False)
 
-        i = 0
-        rows = []
-        queries = []
+    outf.write('\t'.join(row_headers))
+    outf.write('\n')
+    return row_headers, iter_individual_cna_file(infile, reader, headers, defaultCancerType, cancerTypeMap,
+                                                 annotate_gain_loss)
 
-        outf.write('\t'.join(row_headers))
-        outf.write('\n')
 
+def iter_individual_cna_file(infile, reader, headers, defaultCancerType, cancerTypeMap, annotate_gain_loss):
+    isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
+    ihugo = geIndexOfHeader(headers, HUGO_HEADERS)
+    icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
+    icna = geIndexOfHeader(headers, CNA_HEADERS)
+
+    with infile:
+        i = 0
         for row in reader:
             i = i + 1
-            isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
-            ihugo = geIndexOfHeader(headers, HUGO_HEADERS)
-            icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
-            icna = geIndexOfHeader(headers, CNA_HEADERS)
-
             hugo = row[ihugo] if ihugo >= 0 else None
             cna_type = get_cna(row[icna], annotate_gain_loss)
             sample = row[isample] if isample >= 0 else None
@@ -1072,16 +1417,13 @@ def process_individual_cna_file(outf, cna_data_file, defaultCancerType, cancerTy
                 continue
 
             if hugo and cna_type:
-                rows.append(row)
-                queries.append(CNAQuery(hugo, cna_type, cancer_type))
+                yield row, CNAQuery(hugo, cna_type, cancer_type)
             else:
-                outf.write('\t'.join(row))
-                outf.write('\n')
+                yield row, None
                 if not hugo:
                     log.warning("Gene is not specified for row " + str(row))
                 if not cna_type:
                     log.warning("CNA is not specified for row " + str(row))
-        return row_headers, rows, queries
 
 
 def process_cna_data(cnafile, outfile, previousoutfile, defaultCancerType, cancerTypeMap, include_descriptions,
@@ -1094,29 +1436,44 @@ def process_cna_data(cnafile, outfile, previousoutfile, defaultCancerType, cance
         log.error('The CNA file format is not supported, only gistic or individual can be used ')
         return
 
-    outf = open(outfile, 'w+', 1000)
+    outf = openoutputfile(outfile)
 
-    headers = []
-    rows = []
-    queries = []
     if cna_format == CNA_FILE_FORMAT_GISTIC:
-        headers, rows, queries = process_gistic_data(outf, cnafile, defaultCancerType, cancerTypeMap,
-                                                     annotate_gain_loss, include_descriptions)
+        headers, cnas = process_gistic_data(outf, cnafile, defaultCancerType, cancerTypeMap, annotate_gain_loss,
+                                            include_descriptions)
     else:
-        headers, rows, queries = process_individual_cna_file(outf, cnafile, defaultCancerType, cancerTypeMap,
-                                                             annotate_gain_loss, include_descriptions)
+        headers, cnas = process_individual_cna_file(outf, cnafile, defaultCancerType, cancerTypeMap,
+                                                    annotate_gain_loss, include_descriptions)
 
     ncols = len(headers)
+    annotation_headers = get_annotation_column_headers(False, include_descriptions, False)
+
+    with AnnotationPipeline(outf, ncols) as pipeline:
+        i = 0
+        queries = []
+        rows = []
+        previous_annotations = []
+        for row, query in cnas:
+            queries.append(query)
+            rows.append(row)
+            if query is None:
+                previous_annotations.append([])
+            else:
+                previous_annotations.append(get_previous_annotation(row, query.tumorType, annotation_headers))
+
+            if len(rows) == POST_QUERIES_THRESHOLD:
+                i += len(rows)
+                log.info(i)
+                pipeline.submit(rows, previous_annotations, queries, pull_cna_info, include_descriptions)
+                queries = []
+                rows = []
+                previous_annotations = []
 
-    i = 0
-    while len(rows) > 0:
-        i += POST_QUERIES_THRESHOLD
-        log.info(i)
-        rows_sec, rows = rows[:POST_QUERIES_THRESHOLD], rows[POST_QUERIES_THRESHOLD:]
-        queries_sec, queries = queries[:POST_QUERIES_THRESHOLD], queries[POST_QUERIES_THRESHOLD:]
-        annotations = pull_cna_info(queries_sec, include_descriptions)
-        append_annotation_to_file(outf, ncols, rows_sec, annotations)
+        if len(rows) > 0:
+            pipeline.submit(rows, previous_annotations, queries, pull_cna_info, include_descriptions)
 
+    logannotationcachestats()
+    logoncokbsessionstats()
     outf.close()
 
 
@@ -1138,7 +1495,7 @@ def getfirstcolumnofsampleingisticdata(headers):
 
 
 def file_len(fname):
-    with open(fname) as f:
+    with openinputfile(fname) as f:
         for i, l in enumerate(f):
             pass
     return i + 1
@@ -1157,7 +1514,7 @@ def process_clinical_data(annotatedmutfiles, clinicalfile, outfile):
     sample_tx_resistance_count = {}
     samplealterationcount = {}
     for annotatedmutfile in annotatedmutfiles:
-        with open(annotatedmutfile, DEFAULT_READ_FILE_MODE) as mutfile:
+        with openinputfile(annotatedmutfile) as mutfile:
             reader = csv.reader(mutfile, delimiter='\t')
             headers = readheaders(reader)
 
@@ -1274,10 +1631,10 @@ def process_clinical_data(annotatedmutfiles, clinicalfile, outfile):
                         samplemutationswithprognosis[sample].append(variant)
                         samplepxlevels[sample].append(row[ihighestpxlevel])
 
-    outf = open(outfile, 'w+')
+    outf = openoutputfile(outfile)
 
     # export to annotated file
-    with open(clinicalfile, DEFAULT_READ_FILE_MODE) as clinfile:
+    with openinputfile(clinicalfile) as clinfile:
         reader = csv.reader(clinfile, delimiter='\t')
         headers = readheaders(reader)
         outf.write(headers['^-$'])
@@ -1387,58 +1744,164 @@ def process_clinical_data(annotatedmutfiles, clinicalfile, outfile):
     outf.close()
 
 
+# Successfully annotated rows of the previous result file (-p), keyed on the cancer type and the input
+# columns of the row. Each entry maps the annotation column headers to the previous values.
 oncokbcache = {}
 
+HOTSPOT_HEADERS = ['IS-A-HOTSPOT', 'IS-A-3D-HOTSPOT']
+
 
 def cacheannotated(annotatedfile, defaultCancerType, cancerTypeMap):
-    with open(annotatedfile, DEFAULT_READ_FILE_MODE) as infile:
-        try:
-            reader = csv.reader(infile, delimiter='\t')
-            headers = readheaders(reader)
+    with openinputfile(annotatedfile) as infile:
+        reader = csv.reader(infile, delimiter='\t')
+        headers = readheaders(reader)
+        if ANNOTATED_HEADER not in headers:
+            log.warning('%s is not an annotated file, the previous results are not used' % annotatedfile)
+            return
 
-            ihugo = geIndexOfHeader(headers, HUGO_HEADERS)
-            ihgvs = geIndexOfHeader(headers, HGVS_HEADERS)
-            isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
-            icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
-            imutationeffect = headers['MUTATION_EFFECT']
-            icitations = headers['CITATIONS']
-            ioncogenic = headers['ONCOGENIC']
-            igeneannotated = headers[GENE_IN_ONCOKB_HEADER]
-            ivariantannotated = headers[VARIANT_IN_ONCOKB_HEADER]
+        column_headers = [h.strip() for h in headers['^-$'].split('\t')]
+        ifirstannotation = min([headers[h] for h in HOTSPOT_HEADERS + [ANNOTATED_HEADER] if h in headers])
+        annotation_headers = column_headers[ifirstannotation:]
+        iannotated = headers[ANNOTATED_HEADER]
+        isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
+        icancertype = geIndexOfHeader(headers, CANCER_TYPE_HEADERS)
 
-            for row in reader:
-                try:
-                    hugo = row[ihugo]
-
-                    hgvs = row[ihgvs]
-                    if hgvs.startswith('p.'):
-                        hgvs = hgvs[2:]
-
-                    sample = row[isample]
-                    cancertype = defaultCancerType
-                    if icancertype >= 0:
-                        cancertype = row[icancertype]
-                    if sample in cancerTypeMap:
-                        cancertype = cancerTypeMap[sample]
-                    key = '-'.join([hugo, hgvs, cancertype])
-                    #            oncokb = row[ioncokb]
-
-                    oncokbcache[key] = {}
-                    oncokbcache[key][GENE_IN_ONCOKB_HEADER] = row[igeneannotated]
-                    oncokbcache[key][VARIANT_IN_ONCOKB_HEADER] = row[ivariantannotated]
-                    oncokbcache[key]['mutation_effect'] = row[imutationeffect]
-                    oncokbcache[key]['citations'] = row[icitations]
-                    oncokbcache[key]['oncogenic'] = row[ioncogenic]
-                    for level in levels:
-                        il = headers[level]
-                        if il < len(row):
-                            oncokbcache[key][level] = row[il].split(',')
-                        else:
-                            oncokbcache[key][level] = []
-                except Exception:
-                    pass
-        except Exception:
-            pass
+        for row in reader:
+            row = padrow(row, len(column_headers))
+            # rows that failed to annotate are queried again
+            if row[iannotated] != 'True':
+                continue
+
+            sample = row[isample] if isample >= 0 else None
+            cancertype = defaultCancerType
+            if get_cell_content(row, icancertype) is not None:
+                cancertype = row[icancertype]
+            if sample in cancerTypeMap:
+                cancertype = cancerTypeMap[sample]
+
+            key = tuple([cancertype] + row[:ifirstannotation])
+            oncokbcache[key] = dict(zip(annotation_headers, row[ifirstannotation:]))
+    log.info('%d annotated rows read from the previous results' % len(oncokbcache))
+
+
+def get_annotation_column_headers(annotatehotspots, include_descriptions, genomic_change_annotation):
+    headers = list(HOTSPOT_HEADERS) if annotatehotspots else []
+    return headers + get_oncokb_annotation_column_headers(include_descriptions, genomic_change_annotation)
+
+
+def get_previous_annotation(row, cancertype, annotation_headers):
+    if not oncokbcache:
+        return None
+    previous = oncokbcache.get(tuple([cancertype] + row))
+    if previous is None:
+        return None
+    try:
+        return [previous[h] for h in annotation_headers]
+    except KeyError:
+        # the previous results were annotated with other options (-a, -d), so the columns differ
+        return None
+
+
+# Number of batches pulled concurrently by the process_* functions. With more than one, batches are pulled by a
+# pool of workers while the input is still being read, and the annotated rows are written in input order.
+MAX_BATCHES_IN_FLIGHT = 1
+
+# Identical queries, e.g. a recurrent hotspot across the samples of a cohort, are pulled once per run. This bounds
+# the number of distinct queries whose annotation is kept for the rows that follow.
+DEDUPLICATED_QUERIES_CACHE_SIZE = 100000
+
+
+def setmaxbatchesinflight(n):
+    global MAX_BATCHES_IN_FLIGHT
+    MAX_BATCHES_IN_FLIGHT = max(1, n)
+    if API_POOL_SIZE < MAX_BATCHES_IN_FLIGHT:
+        setoncokbsessionoptions(pool_size=MAX_BATCHES_IN_FLIGHT)
+
+
+def querykey(query):
+    return json.dumps(query, default=lambda o: o.__dict__, sort_keys=True)
+
+
+class AnnotationPipeline:
+    def __init__(self, outf, ncols):
+        self.outf = outf
+        self.ncols = ncols
+        self.executor = ThreadPoolExecutor(MAX_BATCHES_IN_FLIGHT) if MAX_BATCHES_IN_FLIGHT > 1 else None
+        # batches in submission order, so a batch is written only after all batches read before it
+        self.pending = deque()
+        # query key -> annotation, or (future, index) while the batch pulling the query is in flight
+        self.annotated = OrderedDict()
+
+    def submit(self, rows, previous_annotations, queries, pull, *pull_args):
+        # rows found in the previous results keep their annotation, the other rows refer to the annotation of an
+        # earlier row with the same query or to the position of their query in this batch
+        refs = []
+        missed_queries = OrderedDict()
+        for query, annotation in zip(queries, previous_annotations):
+            if annotation is not None:
+                refs.append(annotation)
+                continue
+            key = querykey(query)
+            if key in self.annotated:
+                self.annotated.move_to_end(key)
+                refs.append(self.annotated[key])
+            else:
+                if key not in missed_queries:
+                    missed_queries[key] = (len(missed_queries), query)
+                refs.append(missed_queries[key][0])
+
+        while len(self.pending) >= MAX_BATCHES_IN_FLIGHT:
+            self.writenext()
+
+        unique_queries = [query for _, query in missed_queries.values()]
+        if self.executor is None or len(unique_queries) == 0:
+            future = Future()
+            future.set_result(pull(unique_queries, *pull_args) if len(unique_queries) > 0 else [])
+        else:
+            future = self.executor.submit(pull, unique_queries, *pull_args)
+
+        for key, (index, _) in missed_queries.items():
+            self.annotated[key] = (future, index)
+        while len(self.annotated) > DEDUPLICATED_QUERIES_CACHE_SIZE:
+            self.annotated.popitem(last=False)
+
+        refs = [(future, ref) if isinstance(ref, int) else ref for ref in refs]
+        self.pending.append((rows, refs, future, list(missed_queries)))
+        if self.executor is None:
+            self.writenext()
+
+    def writenext(self):
+        rows, refs, future, keys = self.pending.popleft()
+        annotations = [ref[0].result()[ref[1]] if isinstance(ref, tuple) else ref for ref in refs]
+        append_annotation_to_file(self.outf, self.ncols, rows, annotations)
+
+        # the annotations of this batch are kept by value, so the batch itself can be released
+        pulled = future.result()
+        for key in keys:
+            ref = self.annotated.get(key)
+            if isinstance(ref, tuple) and ref[0] is future:
+                self.annotated[key] = pulled[ref[1]]
+
+    def close(self):
+        try:
+            while len(self.pending) > 0:
+                self.writenext()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        # after a failed pull the batches still queued are dropped instead of being waited for
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.shutdown()
 
 
 def geIndexOfHeader(headers, keywords):
@@ -1451,9 +1914,8 @@ def geIndexOfHeader(headers, keywords):
 def pull3dhotspots(hugo, consequence, start, end):
     try:
         if hugo in _3dhotspots and consequence == "missense_variant":
-            for i in range(int(start), int(end) + 1):
-                if i in _3dhotspots[hugo]:
-                    return "Y"
+            if overlapshotspot(_3dhotspots[hugo], int(start), int(end)):
+                return "Y"
     except TypeError:
         log.error("%s: %s-%s" % (hugo, str(start), str(end)))
     return ""
@@ -1587,6 +2049,16 @@ class StructuralVariantQuery:
 
 def pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
     url = oncokb_annotation_api_url + '/annotate/mutations/byProteinChange'
+    annotation = getannotations(url, queries, fetch_protein_change_annotations)
+
+    processed_annotation = []
+    for query_annotation in annotation:
+        processed_annotation.append(
+            process_oncokb_annotation(query_annotation, include_descriptions, False, annotate_hotspot))
+    return processed_annotation
+
+
+def fetch_protein_change_annotations(url, queries):
     response = makeoncokbpostrequest(url, queries)
     if response.status_code == 401:
         raise Exception('unauthorized')
@@ -1614,16 +2086,21 @@ def pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
                 # if the api call fails, we should still push a None into the list
                 # to keep the same length of the queries
                 annotation.append(None)
+    return annotation
+
+
+def pull_hgvsg_info(queries, include_descriptions, annotate_hotspot):
+    url = oncokb_annotation_api_url + '/annotate/mutations/byHGVSg'
+    annotation = getannotations(url, queries, fetch_hgvsg_annotations)
 
     processed_annotation = []
     for query_annotation in annotation:
         processed_annotation.append(
-            process_oncokb_annotation(query_annotation, include_descriptions, False, annotate_hotspot))
+            process_oncokb_annotation(query_annotation, include_descriptions, True, annotate_hotspot))
     return processed_annotation
 
 
-def pull_hgvsg_info(queries, include_descriptions, annotate_hotspot):
-    url = oncokb_annotation_api_url + '/annotate/mutations/byHGVSg'
+def fetch_hgvsg_annotations(url, queries):
     response = makeoncokbpostrequest(url, queries)
     if response.status_code == 401:
         raise Exception('unauthorized')
@@ -1643,6 +2120,12 @@ def pull_hgvsg_info(queries, include_descriptions, annotate_hotspot):
                 # to keep the same length of the queries
                 print('Error on annotating the url ' + geturl)
                 annotation.append(None)
+    return annotation
+
+
+def pull_genomic_change_info(queries, include_descriptions, annotate_hotspot):
+    url = oncokb_annotation_api_url + '/annotate/mutations/byGenomicChange'
+    annotation = getannotations(url, queries, fetch_genomic_change_annotations)
 
     processed_annotation = []
     for query_annotation in annotation:
@@ -1651,8 +2134,7 @@ def pull_hgvsg_info(queries, include_descriptions, annotate_hotspot):
     return processed_annotation
 
 
-def pull_genomic_change_info(queries, include_descriptions, annotate_hotspot):
-    url = oncokb_annotation_api_url + '/annotate/mutations/byGenomicChange'
+def fetch_genomic_change_annotations(url, queries):
     response = makeoncokbpostrequest(url, queries)
     if response.status_code == 401:
         raise Exception('unauthorized')
@@ -1672,17 +2154,21 @@ def pull_genomic_change_info(queries, include_descriptions, annotate_hotspot):
                 # to keep the same length of the queries
                 print('Error on annotating the url ' + geturl)
                 annotation.append(None)
+    return annotation
+
+
+def pull_cna_info(queries, include_descriptions):
+    url = oncokb_annotation_api_url + '/annotate/copyNumberAlterations'
+    annotation = getannotations(url, queries, fetch_cna_annotations)
 
     processed_annotation = []
     for query_annotation in annotation:
         processed_annotation.append(
-            process_oncokb_annotation(query_annotation, include_descriptions, True, annotate_hotspot))
+            process_oncokb_annotation(query_annotation, include_descriptions, False, annotate_hotspot=False))
     return processed_annotation
 
 
-def pull_cna_info(queries, include_descriptions):
-    url = oncokb_annotation_api_url + '/annotate/copyNumberAlterations'
-
+def fetch_cna_annotations(url, queries):
     response = makeoncokbpostrequest(url, queries)
     if response.status_code == 401:
         raise Exception('unauthorized')
@@ -1703,6 +2189,12 @@ def pull_cna_info(queries, include_descriptions):
                 # to keep the same length of the queries
                 print('Error on annotating the url ' + geturl)
                 annotation.append(None)
+    return annotation
+
+
+def pull_structural_variant_info(queries, include_descriptions):
+    url = oncokb_annotation_api_url + '/annotate/structuralVariants'
+    annotation = getannotations(url, queries, fetch_structural_variant_annotations)
 
     processed_annotation = []
     for query_annotation in annotation:
@@ -1711,9 +2203,7 @@ def pull_cna_info(queries, include_descriptions):
     return processed_annotation
 
 
-def pull_structural_variant_info(queries, include_descriptions):
-    url = oncokb_annotation_api_url + '/annotate/structuralVariants'
-
+def fetch_structural_variant_annotations(url, queries):
     response = makeoncokbpostrequest(url, queries)
     if response.status_code == 401:
         raise Exception('unauthorized')
@@ -1738,12 +2228,7 @@ def pull_structural_variant_info(queries, include_descriptions):
                 # to keep the same length of the queries
                 print('Error on annotating the url ' + geturl)
                 annotation.append(None)
-
-    processed_annotation = []
-    for query_annotation in annotation:
-        processed_annotation.append(
-            process_oncokb_annotation(query_annotation, include_descriptions, False, annotate_hotspot=False))
-    return processed_annotation
+    return annotation
 
 
 def process_oncokb_annotation(annotation, include_descriptions, genomic_change_annotation, annotate_hotspot):
@@ -1915,7 +2400,7 @@ def gettreatments(evidence):
 
 
 def readCancerTypes(clinicalFile, data):
-    with open(clinicalFile, DEFAULT_READ_FILE_MODE) as infile:
+    with openinputfile(clinicalFile) as infile:
         reader = csv.reader(infile, delimiter='\t')
         headers = readheaders(reader)
 
@@ -7,6 +7,8 @@ import logging
 from AnnotatorCore import setsampleidsfileterfile
 from AnnotatorCore import setoncokbbaseurl
 from AnnotatorCore import setoncokbapitoken
+from AnnotatorCore import setannotationcachefile
+from AnnotatorCore import setmaxbatchesinflight
 from AnnotatorCore import readCancerTypes
 from AnnotatorCore import validate_oncokb_token
 from AnnotatorCore import process_cna_data
@@ -22,7 +24,8 @@ def main(argv):
             '\n'
             'CnaAnnotator.py -i <input CNA file> -o <output CNA file> [-p previous results] [-c <input clinical file>] '
             '[-s sample list filter] [-t <default tumor type>] [-u oncokb-base-url] [-b oncokb_api_bear_token] '
-            '[-z annotate_gain_loss] [-f CNA file formt, gistic or individual] [-d include descriptions]\n'
+            '[-z annotate_gain_loss] [-f CNA file formt, gistic or individual] [-d include descriptions] '
+            '[-k annotation cache file] [-n number of batches in flight]\n'
             '  Input CNA file uses GISTIC output by default (https://docs.cbioportal.org/5.1-data-loading/data-loading/file-formats#data-file-1). You can also list copy number alteration individually by specifying -f=individual\n'
             '  Essential clinical columns:\n'
             '    SAMPLE_ID: sample ID\n'
@@ -51,6 +54,9 @@ def main(argv):
     if argv.oncokb_api_url:
         setoncokbbaseurl(argv.oncokb_api_url)
     setoncokbapitoken(argv.oncokb_api_bearer_token)
+    if argv.annotation_cache_file:
+        setannotationcachefile(argv.annotation_cache_file)
+    setmaxbatchesinflight(argv.batches_in_flight)
 
     cancertypemap = {}
     if argv.input_clinical_file:
@@ -78,6 +84,8 @@ if __name__ == "__main__":
     parser.add_argument('-z', dest='annotate_gain_loss', action="store_true", default=False)
     parser.add_argument('-f', dest='cna_file_format', default=CNA_FILE_FORMAT_GISTIC)
     parser.add_argument('-d', dest='include_descriptions', action="store_true", default=False)
+    parser.add_argument('-k', dest='annotation_cache_file', default='', type=str)
+    parser.add_argument('-n', dest='batches_in_flight', default=1, type=int)
     parser.set_defaults(func=main)
 
     args = parser.parse_args()
@@ -8,6 +8,8 @@ from AnnotatorCore import setsampleidsfileterfile
 from AnnotatorCore import setcancerhotspotsbaseurl
 from AnnotatorCore import setoncokbbaseurl
 from AnnotatorCore import setoncokbapitoken
+from AnnotatorCore import setannotationcachefile
+from AnnotatorCore import setmaxbatchesinflight
 from AnnotatorCore import readCancerTypes
 from AnnotatorCore import validate_oncokb_token
 from AnnotatorCore import process_fusion
@@ -23,7 +25,7 @@ def main(argv):
             "FusionAnnotator.py -i <input Fusion file> -o <output Fusion file> [-p previous results] "
             "[-c <input clinical file>] [-s sample list filter] [-t <default tumor type>] [-u <oncokb api url>] "
             "[-b <oncokb api bear token>] [-r <structural variant name format, default: [A-Za-z\\d]+-[A-Za-z\\d]+>] "
-            "[-d include descriptions]\n"
+            "[-d include descriptions] [-k annotation cache file] [-n number of batches in flight]\n"
             '  Essential Fusion columns (case insensitive):\n'
             '    HUGO_SYMBOL: Hugo gene symbol\n'
             '    VARIANT_CLASSIFICATION: Translational effect of variant allele\n'
@@ -58,6 +60,9 @@ def main(argv):
     if argv.oncokb_api_url:
         setoncokbbaseurl(argv.oncokb_api_url)
     setoncokbapitoken(argv.oncokb_api_bearer_token)
+    if argv.annotation_cache_file:
+        setannotationcachefile(argv.annotation_cache_file)
+    setmaxbatchesinflight(argv.batches_in_flight)
 
     cancertypemap = {}
     if argv.input_clinical_file:
@@ -86,6 +91,8 @@ if __name__ == "__main__":
     parser.add_argument('-b', dest='oncokb_api_bearer_token', default='', type=str)
     parser.add_argument('-r', dest='structural_variant_name_format', default=None, type=str)
     parser.add_argument('-d', dest='include_descriptions', action="store_true", default=False)
+    parser.add_argument('-k', dest='annotation_cache_file', default='', type=str)
+    parser.add_argument('-n', dest='batches_in_flight', default=1, type=int)
     parser.set_defaults(func=main)
 
     args = parser.parse_args()
@@ -8,6 +8,8 @@ from AnnotatorCore import setsampleidsfileterfile
 from AnnotatorCore import setcancerhotspotsbaseurl
 from AnnotatorCore import setoncokbbaseurl
 from AnnotatorCore import setoncokbapitoken
+from AnnotatorCore import setannotationcachefile
+from AnnotatorCore import setmaxbatchesinflight
 from AnnotatorCore import readCancerTypes
 from AnnotatorCore import validate_oncokb_token
 from AnnotatorCore import processalterationevents
@@ -24,7 +26,8 @@ def main(argv):
             '\n'
             'MafAnnotator.py -i <input MAF file> -o <output MAF file> [-p previous results] [-c <input clinical file>] '
             '[-s sample list filter] [-t <default tumor type>] [-u oncokb-base-url] [-b oncokb api bear token] [-a] '
-            '[-q query type] [-r default reference genome] [-d include descriptions]\n'
+            '[-q query type] [-r default reference genome] [-d include descriptions] '
+            '[-k annotation cache file] [-n number of batches in flight]\n'
             'For definitions of the MAF format, please see https://docs.gdc.cancer.gov/Data/File_Formats/MAF_Format/\n\n'
             'Essential MAF columns for querying HGVSp_Short and HGVSp(case insensitive):\n'
             '    Hugo_Symbol: Hugo gene symbol\n'
@@ -84,6 +87,9 @@ def main(argv):
     if argv.oncokb_api_url:
         setoncokbbaseurl(argv.oncokb_api_url)
     setoncokbapitoken(argv.oncokb_api_bearer_token)
+    if argv.annotation_cache_file:
+        setannotationcachefile(argv.annotation_cache_file)
+    setmaxbatchesinflight(argv.batches_in_flight)
 
     cancertypemap = {}
     if argv.input_clinical_file:
@@ -134,6 +140,8 @@ if __name__ == "__main__":
     parser.add_argument('-q', dest='query_type', default=None, type=str)
     parser.add_argument('-r', dest='default_reference_genome', default=None, type=str)
     parser.add_argument('-d', dest='include_descriptions', action="store_true", default=False)
+    parser.add_argument('-k', dest='annotation_cache_file', default='', type=str)
+    parser.add_argument('-n', dest='batches_in_flight', default=1, type=int)
     parser.set_defaults(func=main)
 
     args = parser.parse_args()
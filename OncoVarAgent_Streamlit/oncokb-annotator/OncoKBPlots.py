@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 from AnnotatorCore import setsampleidsfileterfile
 from AnnotatorCore import readheaders
 from AnnotatorCore import geIndexOfHeader
+from AnnotatorCore import openinputfile
 from AnnotatorCore import sampleidsfilter
 from AnnotatorCore import levels
 from AnnotatorCore import dxLevels
@@ -29,7 +30,7 @@ def plotclinicalactionability(ax, annotatedclinicalfile, outfile, parameters):
     if "levels" in parameters:
         extlevels = parameters["levels"]
 
-    with open(annotatedclinicalfile, 'rU') as clinfile:
+    with openinputfile(annotatedclinicalfile) as clinfile:
         reader = csv.reader(clinfile, delimiter='\t')
         headers = readheaders(reader)
         isample = geIndexOfHeader(headers, SAMPLE_HEADERS)
@@ -100,7 +101,7 @@ def plotimplications(ax, header, title, levels, annotatedclinicalfile, outfile,
     if "levels" in parameters:
         extlevels = parameters["levels"]
 
-    with open(annotatedclinicalfile, 'rU') as clinfile:
+    with openinputfile(annotatedclinicalfile) as clinfile:
         reader = csv.reader(clinfile, delimiter='\t')
         headers = readheaders(reader)
         isample = headers['SAMPLE_ID']
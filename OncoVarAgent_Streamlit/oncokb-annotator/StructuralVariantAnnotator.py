@@ -8,6 +8,8 @@ from AnnotatorCore import setsampleidsfileterfile
 from AnnotatorCore import setcancerhotspotsbaseurl
 from AnnotatorCore import setoncokbbaseurl
 from AnnotatorCore import setoncokbapitoken
+from AnnotatorCore import setannotationcachefile
+from AnnotatorCore import setmaxbatchesinflight
 from AnnotatorCore import readCancerTypes
 from AnnotatorCore import validate_oncokb_token
 from AnnotatorCore import process_sv
@@ -22,7 +24,8 @@ def main(argv):
             '\n'
             'StructuralVariantAnnotator.py -i <input structural variant file> -o <output structural variant file> '
             '[-p previous results] [-c <input clinical file>] [-s sample list filter] [-t <default tumor type>] '
-            '[-u <oncokb api url>] [-b <oncokb api bear token>] [-d include descriptions]\n'
+            '[-u <oncokb api url>] [-b <oncokb api bear token>] [-d include descriptions] '
+            '[-k annotation cache file] [-n number of batches in flight]\n'
             '  Essential structural variant columns (case insensitive):\n'
             '    GENEA: Hugo gene symbol for gene A\n'
             '    GENEB: Hugo gene symbol for gene B\n'
@@ -57,6 +60,9 @@ def main(argv):
     if argv.oncokb_api_url:
         setoncokbbaseurl(argv.oncokb_api_url)
     setoncokbapitoken(argv.oncokb_api_bearer_token)
+    if argv.annotation_cache_file:
+        setannotationcachefile(argv.annotation_cache_file)
+    setmaxbatchesinflight(argv.batches_in_flight)
 
     cancertypemap = {}
     if argv.input_clinical_file:
@@ -85,6 +91,8 @@ if __name__ == "__main__":
     parser.add_argument('-v', dest='cancer_hotspots_base_url', default='', type=str)
     parser.add_argument('-b', dest='oncokb_api_bearer_token', default='', type=str)
     parser.add_argument('-d', dest='include_descriptions', action="store_true", default=False)
+    parser.add_argument('-k', dest='annotation_cache_file', default='', type=str)
+    parser.add_argument('-n', dest='batches_in_flight', default=1, type=int)
     parser.set_defaults(func=main)
 
     args = parser.parse_args()
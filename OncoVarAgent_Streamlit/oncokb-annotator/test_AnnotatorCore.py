@@ -1,5 +1,10 @@
 #!/usr/bin/env python
+import gzip
+
 import pytest
+import requests
+
+import AnnotatorCore
 
 from AnnotatorCore import getgenesfromfusion
 from AnnotatorCore import conversion
@@ -7,6 +12,18 @@ from AnnotatorCore import replace_all
 from AnnotatorCore import resolve_query_type
 from AnnotatorCore import get_highest_tx_level
 from AnnotatorCore import get_cna
+from AnnotatorCore import annotatealterationrecords
+from AnnotatorCore import processalterationevents
+from AnnotatorCore import process_cna_data
+from AnnotatorCore import process_clinical_data
+from AnnotatorCore import openinputfile
+from AnnotatorCore import getannotations
+from AnnotatorCore import append_annotation_to_file
+from AnnotatorCore import gethotspots
+from AnnotatorCore import pull3dhotspots
+from AnnotatorCore import getoncokbsession
+from AnnotatorCore import setoncokbsessionoptions
+from AnnotatorCore import ProteinChangeQuery
 from AnnotatorCore import QueryType
 from AnnotatorCore import ALTERATION_HEADER
 from AnnotatorCore import HGVSP_HEADER
@@ -182,3 +199,341 @@ def test_cna():
     assert get_cna('-1.5', True) == CNA_DELETION_TXT
     assert get_cna('-1', True) == CNA_LOSS_TXT
     assert get_cna('0', True) is None
+
+
+def test_annotatealterationrecords(monkeypatch):
+    pulled = []
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        pulled.extend(queries)
+        return [['True', 'True', 'True', 'Gain-of-function', '', 'Oncogenic'] for _ in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+
+    assert annotatealterationrecords([], 'MEL') == []
+
+    records = [
+        {'Hugo_Symbol': 'BRAF', 'HGVSp_Short': 'p.V600E', 'Tumor_Sample_Barcode': 'S1'},
+        {'Hugo_Symbol': 'KRAS', 'HGVSp_Short': 'p.G12C', 'Tumor_Sample_Barcode': 'S2'},
+    ]
+    annotated = annotatealterationrecords(records, 'MEL', {'S2': 'LUAD'})
+    assert [(q.gene.hugoSymbol, q.alteration, q.tumorType) for q in pulled] == [('BRAF', 'V600E', 'MEL'),
+                                                                               ('KRAS', 'G12C', 'LUAD')]
+    assert len(annotated) == 2
+    assert annotated[0]['Hugo_Symbol'] == 'BRAF'
+    assert annotated[0]['HGVSp_Short'] == 'p.V600E'
+    assert annotated[0]['ONCOGENIC'] == 'Oncogenic'
+    assert annotated[1]['MUTATION_EFFECT'] == 'Gain-of-function'
+    assert annotated[1]['HIGHEST_LEVEL'] == ''
+
+
+def test_getannotations_cache(monkeypatch, tmp_path):
+    fetched = []
+
+    def fake_fetch(url, queries):
+        fetched.append([q.alteration for q in queries])
+        return [None if q.alteration == 'X1Y' else {'query': {'alteration': q.alteration}} for q in queries]
+
+    url = 'https://www.oncokb.org/api/v1/annotate/mutations/byProteinChange'
+    queries = [ProteinChangeQuery('BRAF', 'V600E', 'MEL'), ProteinChangeQuery('KRAS', 'X1Y', 'LUAD')]
+
+    # Without a cache file every query goes to the fetcher
+    monkeypatch.setattr(AnnotatorCore, 'annotation_cache_file', None)
+    assert getannotations(url, queries, fake_fetch)[1] is None
+    assert fetched == [['V600E', 'X1Y']]
+
+    fetched.clear()
+    monkeypatch.setattr(AnnotatorCore, 'annotation_cache_file', str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setattr(AnnotatorCore, '_oncokb_data_version', 'v1')
+    monkeypatch.setattr(AnnotatorCore, 'annotation_cache_stats', {'hits': 0, 'misses': 0})
+    assert getannotations(url, queries, fake_fetch)[0] == {'query': {'alteration': 'V600E'}}
+
+    # Only the failed query is sent again
+    queries.append(ProteinChangeQuery('BRAF', 'V600E', 'LUAD'))
+    annotations = getannotations(url, queries, fake_fetch)
+    assert fetched == [['V600E', 'X1Y'], ['X1Y', 'V600E']]
+    assert annotations == [{'query': {'alteration': 'V600E'}}, None, {'query': {'alteration': 'V600E'}}]
+    assert AnnotatorCore.annotation_cache_stats == {'hits': 1, 'misses': 4}
+
+    # A new OncoKB data version invalidates the cached annotations
+    monkeypatch.setattr(AnnotatorCore, '_oncokb_data_version', 'v2')
+    getannotations(url, queries[:1], fake_fetch)
+    assert fetched[-1] == ['V600E']
+
+
+def test_processalterationevents_previous_results(monkeypatch, tmp_path):
+    pulled = []
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        pulled.append([q.alteration for q in queries])
+        return [['True', 'True', 'True', 'Gain-of-function', '', 'Oncogenic'] for _ in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+
+    maf = tmp_path / 'maf.txt'
+    previous = tmp_path / 'previous.txt'
+    output = tmp_path / 'output.txt'
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n'
+                   'BRAF\tp.V600E\tS1\n'
+                   'KRAS\tp.G12C\tS2\n')
+    processalterationevents(str(maf), str(previous), '', 'MEL', {}, False, None, None, False)
+    assert pulled == [['V600E', 'G12C']]
+
+    # Only the new row is queried, and the output keeps the row order
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n'
+                   'BRAF\tp.V600E\tS1\n'
+                   'EGFR\tp.L858R\tS3\n'
+                   'KRAS\tp.G12C\tS2\n')
+    processalterationevents(str(maf), str(output), str(previous), 'MEL', {}, False, None, None, False)
+    assert pulled[1] == ['L858R']
+    lines = output.read_text().splitlines()
+    assert [lines[0], lines[1], lines[3]] == previous.read_text().splitlines()
+    assert lines[2].startswith('EGFR\tp.L858R\tS3\tTrue')
+
+    # Previous results annotated without descriptions can not fill the description columns
+    processalterationevents(str(maf), str(output), str(previous), 'MEL', {}, False, None, None, True)
+    assert pulled[2] == ['V600E', 'L858R', 'G12C']
+
+
+def test_getoncokbsession(monkeypatch):
+    monkeypatch.setattr(AnnotatorCore, '_oncokb_session', None)
+    monkeypatch.setattr(AnnotatorCore, 'API_POOL_SIZE', AnnotatorCore.API_POOL_SIZE)
+    monkeypatch.setattr(AnnotatorCore, 'API_KEEP_ALIVE', AnnotatorCore.API_KEEP_ALIVE)
+    monkeypatch.setattr(AnnotatorCore, 'API_REQUEST_RETRIES', AnnotatorCore.API_REQUEST_RETRIES)
+
+    session = getoncokbsession()
+    assert getoncokbsession() is session
+    assert session.headers['Connection'] == 'keep-alive'
+    assert session.get_adapter('https://').max_retries.allowed_methods == ['HEAD', 'GET', 'POST']
+
+    # Changing the options replaces the shared session
+    setoncokbsessionoptions(pool_size=2, keep_alive=False, retries=5)
+    session = getoncokbsession()
+    assert session.get_adapter('https://')._pool_maxsize == 2
+    assert session.get_adapter('https://').max_retries.total == 5
+    assert session.headers['Connection'] == 'close'
+
+
+def test_processalterationevents_batches_in_flight(monkeypatch, tmp_path):
+    import threading
+    import time
+
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        # later batches finish first
+        time.sleep(0.05 / int(queries[0].alteration[1:]))
+        with lock:
+            running[0] -= 1
+        return [['True', 'True', 'True', 'Gain-of-function', '', q.alteration] for q in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+    monkeypatch.setattr(AnnotatorCore, 'POST_QUERIES_THRESHOLD', 2)
+    monkeypatch.setattr(AnnotatorCore, 'MAX_BATCHES_IN_FLIGHT', 3)
+
+    maf = tmp_path / 'maf.txt'
+    output = tmp_path / 'output.txt'
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n' +
+                   ''.join('BRAF\tp.V%d\tS%d\n' % (i, i) for i in range(1, 10)))
+    processalterationevents(str(maf), str(output), '', 'MEL', {}, False, None, None, False)
+
+    lines = output.read_text().splitlines()[1:]
+    assert [line.split('\t')[1] for line in lines] == ['p.V%d' % i for i in range(1, 10)]
+    assert [line.split('\t')[8] for line in lines] == ['V%d' % i for i in range(1, 10)]
+    assert max_running[0] == 3
+
+
+def test_processalterationevents_failed_pull(monkeypatch, tmp_path):
+    executors = []
+
+    class RecordingExecutor(AnnotatorCore.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super(RecordingExecutor, self).__init__(*args, **kwargs)
+            executors.append(self)
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        if queries[0].alteration == 'V3':
+            raise requests.exceptions.ConnectionError('OncoKB is down')
+        return [['True', 'True', 'True', 'Gain-of-function', '', q.alteration] for q in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'ThreadPoolExecutor', RecordingExecutor)
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+    monkeypatch.setattr(AnnotatorCore, 'POST_QUERIES_THRESHOLD', 2)
+    monkeypatch.setattr(AnnotatorCore, 'MAX_BATCHES_IN_FLIGHT', 3)
+
+    maf = tmp_path / 'maf.txt'
+    output = tmp_path / 'output.txt'
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n' +
+                   ''.join('BRAF\tp.V%d\tS%d\n' % (i, i) for i in range(1, 10)))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        processalterationevents(str(maf), str(output), '', 'MEL', {}, False, None, None, False)
+
+    # The worker threads are shut down on the error path too
+    assert len(executors) == 1
+    assert executors[0]._shutdown
+
+
+@pytest.mark.parametrize('batches_in_flight', [1, 3])
+def test_processalterationevents_deduplicates_queries(monkeypatch, tmp_path, batches_in_flight):
+    pulled = []
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        pulled.append([q.alteration for q in queries])
+        return [['True', 'True', 'True', 'Gain-of-function', '', q.alteration] for q in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+    monkeypatch.setattr(AnnotatorCore, 'POST_QUERIES_THRESHOLD', 3)
+    monkeypatch.setattr(AnnotatorCore, 'MAX_BATCHES_IN_FLIGHT', batches_in_flight)
+
+    alterations = ['V600E', 'V600E', 'G12C', 'V600E', 'G12C', 'G12D', 'V600E']
+    maf = tmp_path / 'maf.txt'
+    output = tmp_path / 'output.txt'
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n' +
+                   ''.join('BRAF\tp.%s\tS%d\n' % (a, i) for i, a in enumerate(alterations)))
+    processalterationevents(str(maf), str(output), '', 'MEL', {}, False, None, None, False)
+
+    # Each distinct query is pulled once, within and across batches
+    assert pulled == [['V600E', 'G12C'], ['G12D']]
+    lines = output.read_text().splitlines()[1:]
+    assert [line.split('\t')[2] for line in lines] == ['S%d' % i for i in range(len(alterations))]
+    assert [line.split('\t')[8] for line in lines] == alterations
+
+
+def test_process_cna_data_streams_gistic_data(monkeypatch, tmp_path):
+    pulled = []
+
+    def fake_pull_cna_info(queries, include_descriptions):
+        pulled.append([(q.gene.hugoSymbol, q.copyNameAlterationType) for q in queries])
+        return [['True', 'True', 'True', 'Loss-of-function', '', 'Likely Oncogenic'] for _ in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_cna_info', fake_pull_cna_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+    monkeypatch.setattr(AnnotatorCore, 'POST_QUERIES_THRESHOLD', 2)
+
+    cna = tmp_path / 'cna.txt'
+    output = tmp_path / 'output.txt'
+    cna.write_text('Hugo_Symbol\tEntrez_Gene_Id\tS1\tS2\n'
+                   'TP53\t7157\t-2\t0\n'
+                   'ERBB2\t2064\t2\t2\n'
+                   'PTEN\t5728\t0\t-2\n')
+    process_cna_data(str(cna), str(output), '', 'BRCA', {'S2': 'LUAD'}, False)
+
+    assert pulled == [[('TP53', 'DELETION'), ('ERBB2', 'AMPLIFICATION')],
+                      [('ERBB2', 'AMPLIFICATION'), ('PTEN', 'DELETION')]]
+    lines = output.read_text().splitlines()
+    assert lines[0].startswith('SAMPLE_ID\tCANCER_TYPE\tHUGO_SYMBOL\tALTERATION\tANNOTATED')
+    assert [line.split('\t')[:3] for line in lines[1:]] == [['S1', 'BRCA', 'TP53'], ['S1', 'BRCA', 'ERBB2'],
+                                                             ['S2', 'LUAD', 'ERBB2'], ['S2', 'LUAD', 'PTEN']]
+
+    # Rows of an individual CNA file that can not be queried keep their place
+    cna.write_text('Sample_Id\tHugo_Symbol\tAlteration\n'
+                   'S1\tTP53\tDeletion\n'
+                   'S1\tCDK4\t-1\n'
+                   'S2\tERBB2\tAmplification\n')
+    process_cna_data(str(cna), str(output), '', 'BRCA', {}, False, cna_format='individual')
+    lines = output.read_text().splitlines()
+    assert [line.split('\t')[:4] for line in lines[1:]] == [['S1', 'TP53', 'Deletion', 'True'],
+                                                             ['S1', 'CDK4', '-1', ''],
+                                                             ['S2', 'ERBB2', 'Amplification', 'True']]
+
+
+def test_append_annotation_to_file(tmp_path):
+    output = tmp_path / 'output.txt'
+    with open(str(output), 'w+') as outf:
+        append_annotation_to_file(outf, 4, [], [])
+        append_annotation_to_file(outf, 4, [['BRAF', 'V600E'], ['KRAS', 'G12C'], ['TP53']],
+                                  [['True', 'Oncogenic'], None, ['True', 'Likely Oncog\u00e9nic', '', 'extra']])
+        append_annotation_to_file(outf, 4, [['EGFR', 'L858R']], [['True', 'Oncogenic']])
+
+    # Rows are padded or cut to the number of columns, non-ascii characters are dropped
+    assert output.read_text() == ('BRAF\tV600E\tTrue\tOncogenic\n'
+                                  'KRAS\tG12C\t\t\n'
+                                  'TP53\tTrue\tLikely Oncognic\t\n'
+                                  'EGFR\tL858R\tTrue\tOncogenic\n')
+
+
+@pytest.mark.parametrize('extension', ['.gz', '.bgz', '.zst'])
+def test_compressed_files(monkeypatch, tmp_path, extension):
+    if extension == '.zst':
+        pytest.importorskip('zstandard')
+
+    def fake_pull_protein_change_info(queries, include_descriptions, annotate_hotspot):
+        return [['True', 'True', 'True', 'Gain-of-function', '', 'Oncogenic', 'LEVEL_1'] for _ in queries]
+
+    monkeypatch.setattr(AnnotatorCore, 'pull_protein_change_info', fake_pull_protein_change_info)
+    monkeypatch.setattr(AnnotatorCore, 'oncokbcache', {})
+
+    maf = tmp_path / 'maf.txt.gz'
+    clinical = tmp_path / 'clinical.txt'
+    output = tmp_path / ('output.txt' + extension)
+    clinical_output = tmp_path / ('clinical_output.txt' + extension)
+    with gzip.open(str(maf), 'wt') as f:
+        f.write('Hugo_Symbol\tHGVSp_Short\tTumor_Sample_Barcode\n'
+                'BRAF\tp.V600E\tS1\n'
+                'KRAS\tp.G12C\tS2\n')
+    clinical.write_text('SAMPLE_ID\tONCOTREE_CODE\nS1\tMEL\nS2\tLUAD\n')
+
+    # Compressed input is detected by its content, the output is compressed by its extension
+    processalterationevents(str(maf), str(output), '', 'MEL', {}, False, QueryType.HGVSP_SHORT, None, False)
+    assert not output.read_bytes().startswith(b'Hugo_Symbol')
+    with openinputfile(str(output)) as f:
+        lines = f.read().splitlines()
+    assert [line.split('\t')[:4] for line in lines] == [['Hugo_Symbol', 'HGVSp_Short', 'Tumor_Sample_Barcode', 'ANNOTATED'],
+                                                          ['BRAF', 'p.V600E', 'S1', 'True'],
+                                                          ['KRAS', 'p.G12C', 'S2', 'True']]
+
+    process_clinical_data([str(output)], str(clinical), str(clinical_output))
+    with openinputfile(str(clinical_output)) as f:
+        lines = f.read().splitlines()
+    assert [line.split('\t')[0] for line in lines] == ['SAMPLE_ID', 'S1', 'S2']
+
+
+def test_gethotspots(monkeypatch, tmp_path):
+    catalog = [
+        {'hugoSymbol': 'KRAS', 'type': '3d', 'aminoAcidPosition': {'start': 12, 'end': 13}},
+        {'hugoSymbol': 'KRAS', 'type': '3d', 'aminoAcidPosition': {'start': 61, 'end': 61}},
+        {'hugoSymbol': 'KRAS', 'type': '3d', 'aminoAcidPosition': {'start': 14, 'end': 20}},
+        {'hugoSymbol': 'EGFR', 'type': '3d', 'aminoAcidPosition': {'start': 746, 'end': 750}},
+    ]
+    downloads = []
+
+    class FakeResponse:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return catalog
+
+    def fake_get(url, timeout):
+        downloads.append(url)
+        return FakeResponse()
+
+    monkeypatch.setattr(AnnotatorCore.requests, 'get', fake_get)
+    monkeypatch.setattr(AnnotatorCore, 'hotspotscachedir', str(tmp_path))
+
+    hotspots = gethotspots('http://hotspots/api/hotspots/3d', None)
+    # Adjacent and overlapping ranges are merged
+    assert hotspots == {'KRAS': ([12, 61], [20, 61]), 'EGFR': ([746], [750])}
+
+    # The catalog is read from the disk cache on the next start
+    assert gethotspots('http://hotspots/api/hotspots/3d', None) == hotspots
+    assert downloads == ['http://hotspots/api/hotspots/3d']
+
+    monkeypatch.setattr(AnnotatorCore, '_3dhotspots', hotspots)
+    assert pull3dhotspots('KRAS', 'missense_variant', 13, 13) == 'Y'
+    assert pull3dhotspots('KRAS', 'missense_variant', 21, 60) == ''
+    assert pull3dhotspots('KRAS', 'missense_variant', 21, 61) == 'Y'
+    assert pull3dhotspots('KRAS', 'missense_variant', 62, 62) == ''
+    assert pull3dhotspots('EGFR', 'missense_variant', 700, 800) == 'Y'
+    assert pull3dhotspots('EGFR', 'missense_variant', 745, 745) == ''
+    assert pull3dhotspots('EGFR', 'inframe_deletion', 746, 750) == ''
+    assert pull3dhotspots('BRAF', 'missense_variant', 600, 600) == ''
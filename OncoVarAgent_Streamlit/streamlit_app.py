@@ -449,15 +449,27 @@ async def run_local_agent_stream(
     }
 
     final_state_result = None
-    async for event in oncovar_agent.app.astream(initial_state, config=run_config):
-        event_key, event_value = list(event.items())[0]
-        if event_key == "deep_researcher":
-            on_log(f"--- [Node: {event_key}] ---\nThe deep research node has been executed.")
-        else:
-            detail = safe_json(event_value) if event_value else "The node has been executed."
-            on_log(f"--- [Node: {event_key}] ---\n{detail}")
-        if event_key == "final_combiner":
-            final_state_result = event_value
+    try:
+        # Each variant runs in its own 'process_variant' sub-workflow; subgraphs=True streams the nodes inside it.
+        # Deeper events are the ReAct agent's own steps, which already reach the log through send_react_log.
+        async for namespace, event in oncovar_agent.app.astream(initial_state, config=run_config, subgraphs=True):
+            if len(namespace) > 1:
+                continue
+            event_key, event_value = list(event.items())[0]
+            if event_key == "deep_researcher":
+                on_log(f"--- [Node: {event_key}] ---\nThe deep research node has been executed.")
+            elif event_key == "process_variant":
+                reports = (event_value or {}).get("processed_variants_reports", [])
+                rows = sorted({report.get("variant_index", 0) + 1 for report in reports})
+                on_log(f"--- [Node: {event_key}] ---\nThe variant report is ready for input row(s) {', '.join(map(str, rows))}.")
+            else:
+                detail = safe_json(event_value) if event_value else "The node has been executed."
+                on_log(f"--- [Node: {event_key}] ---\n{detail}")
+            if event_key == "final_combiner" and not namespace:
+                final_state_result = event_value
+    finally:
+        # Each asyncio.run gets a fresh loop and pooled HTTP client; close it before the loop goes away
+        await oncovar_agent.aclose_http_clients()
 
     if not final_state_result:
         raise RuntimeError("Workflow finished without a final_combiner result.")
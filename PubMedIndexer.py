@@ -0,0 +1,113 @@
+# --- PubMedIndexer.py ---
+# Builds the local PubMed abstract store used by OncoVarAgent's `pubmed_search` tool
+# (PUBMED_LOCAL_DB). Ingests PubMed baseline/update XML files (plain or .gz) with a
+# streaming parser into a SQLite database with an FTS5 full-text index.
+#
+# Baseline and update files: https://ftp.ncbi.nlm.nih.gov/pubmed/
+
+import argparse
+import gzip
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+
+# Articles live in a regular table keyed by PMID; `articles_fts` is an external-content
+# FTS5 index over title/abstract that the triggers keep in sync on insert/update/delete.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    rowid INTEGER PRIMARY KEY,
+    pmid TEXT UNIQUE NOT NULL,
+    title TEXT,
+    abstract TEXT,
+    pub_year INTEGER
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(
+    title, abstract, content='articles', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS articles_ai AFTER INSERT ON articles BEGIN
+    INSERT INTO articles_fts(rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_ad AFTER DELETE ON articles BEGIN
+    INSERT INTO articles_fts(articles_fts, rowid, title, abstract) VALUES ('delete', old.rowid, old.title, old.abstract);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_au AFTER UPDATE ON articles BEGIN
+    INSERT INTO articles_fts(articles_fts, rowid, title, abstract) VALUES ('delete', old.rowid, old.title, old.abstract);
+    INSERT INTO articles_fts(rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract);
+END;
+"""
+
+UPSERT_SQL = """
+INSERT INTO articles (pmid, title, abstract, pub_year) VALUES (?, ?, ?, ?)
+ON CONFLICT(pmid) DO UPDATE SET title = excluded.title, abstract = excluded.abstract, pub_year = excluded.pub_year
+"""
+
+COMMIT_EVERY = 10000
+
+
+def open_store(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _open_xml(path: str):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def parse_article(article: ET.Element) -> tuple:
+    """Extracts (pmid, title, abstract, year) from a <PubmedArticle> element."""
+    citation = article.find("MedlineCitation")
+    pmid = citation.findtext("PMID")
+    title_elem = citation.find("Article/ArticleTitle")
+    title = "".join(title_elem.itertext()) if title_elem is not None else None
+    abstract = "\n".join("".join(e.itertext()) for e in citation.findall("Article/Abstract/AbstractText")) or None
+    year = citation.findtext("Article/Journal/JournalIssue/PubDate/Year")
+    return pmid, title, abstract, int(year) if year and year.isdigit() else None
+
+
+def ingest_file(conn: sqlite3.Connection, path: str) -> tuple:
+    """Streams one PubMed XML file into the store; returns (upserted, deleted) counts."""
+    upserted, deleted = 0, 0
+    with _open_xml(path) as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == "PubmedArticle":
+                pmid, title, abstract, year = parse_article(elem)
+                if pmid:
+                    conn.execute(UPSERT_SQL, (pmid, title, abstract, year))
+                    upserted += 1
+            elif elem.tag == "DeleteCitation":
+                pmids = [(p.text,) for p in elem.findall("PMID") if p.text]
+                conn.executemany("DELETE FROM articles WHERE pmid = ?", pmids)
+                deleted += len(pmids)
+            else:
+                continue
+            # Drop the processed subtree so memory stays flat on multi-GB files
+            root.clear()
+            if upserted and upserted % COMMIT_EVERY == 0:
+                conn.commit()
+    conn.commit()
+    return upserted, deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the local PubMed abstract store for OncoVarAgent.")
+    parser.add_argument("xml_files", nargs="+", help="PubMed baseline/update XML files (.xml or .xml.gz), applied in order.")
+    parser.add_argument("--db", type=str, default="pubmed_local.sqlite", help="SQLite database to create or update.")
+    parser.add_argument("--optimize", action="store_true", help="Merge the FTS5 index segments after loading.")
+    args = parser.parse_args()
+
+    conn = open_store(args.db)
+    for xml_file in args.xml_files:
+        start = time.time()
+        upserted, deleted = ingest_file(conn, xml_file)
+        print(f"---{xml_file}: {upserted} articles upserted, {deleted} deleted in {time.time() - start:.1f}s---")
+    if args.optimize:
+        conn.execute("INSERT INTO articles_fts(articles_fts) VALUES ('optimize')")
+        conn.commit()
+    conn.close()
+    print(f"--- ✅ Local PubMed store ready at '{args.db}' ---")
@@ -0,0 +1,93 @@
+# --- benchmarks/amp_tier.py ---
+# Compares the vectorized add_amp_tier_to_df with the row-wise DataFrame.apply version it replaced,
+# on a synthetic OncoKB-annotated table, and checks that both produce the same frame.
+#
+#   python benchmarks/amp_tier.py --rows 500000 --agent backend
+
+import argparse
+import importlib.util
+import os
+import random
+import time
+
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AGENT_FILES = {
+    "cli": os.path.join(REPO_DIR, "OncoVarAgent.py"),
+    "backend": os.path.join(REPO_DIR, "OncoVarAgent_Streamlit", "backend", "OncoVarAgent.py"),
+}
+LEVEL_KEYS = ['1', '2', '3A', '3B', '4', 'R1', 'R2']
+DRUG_CELLS = ['Dabrafenib', 'Trametinib', 'Dabrafenib + Trametinib', 'Osimertinib', ' Sotorasib ', '', ' , ',
+              'Erlotinib,Gefitinib']
+ONCOGENIC_VALUES = ['Oncogenic', 'Likely Oncogenic', 'Likely Neutral', 'Neutral', 'Unknown', None]
+
+
+def add_amp_tier_to_df_rowwise(df: pd.DataFrame, level_precedence: list, amp_mapping: dict) -> pd.DataFrame:
+    """The row-wise implementation add_amp_tier_to_df used before it was vectorized, kept as the reference."""
+    def process_row(row):
+        drug_info_list, tier = [], None
+        for key in level_precedence:
+            col = f'LEVEL_{key}'
+            if col in row.index and pd.notna(row[col]):
+                drugs, mapping = str(row[col]), amp_mapping.get(key)
+                if not mapping: continue
+                if tier is None: tier = mapping['tier']
+                status = "resistance" if 'R' in key else "sensitive"
+                for drug in [d.strip() for d in drugs.split(',') if d.strip()]:
+                    drug_info_list.append(f"{drug}({status}, Level {mapping['level']} Evidence)")
+        if tier is None:
+            oncogenic_status = row.get('ONCOGENIC')
+            if oncogenic_status in ['Oncogenic', 'Likely Oncogenic']:
+                tier = "Tier II"
+            elif oncogenic_status in ['Likely Neutral', 'Neutral']:
+                tier = "Tier IV"
+            else:
+                tier = "Tier III"
+        drugs_str = "; ".join(drug_info_list) or "N/A"
+        return pd.Series([tier, drugs_str])
+    df[['AMP_TIER', 'Drugs']] = df.apply(process_row, axis=1)
+    return df
+
+
+def make_annotated_table(rows: int, seed: int = 0, level_keys: list = LEVEL_KEYS, level_fill: float = 0.08) -> pd.DataFrame:
+    """Synthetic annotator output: mostly empty LEVEL_* columns with single, combined, padded and blank drug cells."""
+    rng = random.Random(seed)
+    data = {'Hugo_Symbol': [f'G{i % 500}' for i in range(rows)],
+            'ONCOGENIC': [rng.choice(ONCOGENIC_VALUES) for _ in range(rows)]}
+    for key in level_keys:
+        data[f'LEVEL_{key}'] = [rng.choice(DRUG_CELLS) if rng.random() < level_fill else None for _ in range(rows)]
+    return pd.DataFrame(data)
+
+
+def load_agent(name: str):
+    # The agents build their LLM clients at import time; placeholder settings are enough as no request is sent
+    for var, value in [('LLM_API_KEY', 'benchmark'), ('LLM_BASE_URL', 'http://localhost'), ('MODEL_NAME', 'benchmark'),
+                       ('LLM_API_TOKEN', 'benchmark'), ('LLM_API_URL', 'http://localhost'), ('LLM_MODEL', 'benchmark')]:
+        os.environ.setdefault(var, value)
+    spec = importlib.util.spec_from_file_location(f'OncoVarAgent_{name}', AGENT_FILES[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark add_amp_tier_to_df against the row-wise version.")
+    parser.add_argument("--rows", type=int, default=500000, help="Rows in the synthetic annotated table.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic table.")
+    parser.add_argument("--agent", choices=sorted(AGENT_FILES), default="backend", help="Agent module to benchmark.")
+    args = parser.parse_args()
+
+    agent = load_agent(args.agent)
+    table = make_annotated_table(args.rows, args.seed)
+
+    start = time.perf_counter()
+    expected = add_amp_tier_to_df_rowwise(table.copy(), agent.LEVEL_PRECEDENCE, agent.ONCOKB_TO_AMP_MAPPING)
+    rowwise = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = agent.add_amp_tier_to_df(table.copy())
+    vectorized = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(actual, expected)
+    print(f"--- {args.rows} rows: row-wise {rowwise:.2f}s, vectorized {vectorized:.2f}s "
+          f"({rowwise / vectorized:.0f}x), identical output ---")
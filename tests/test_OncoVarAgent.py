@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+import asyncio
+import importlib.util
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.messages import HumanMessage
+from langchain_core.messages import ToolMessage
+from langgraph.graph.message import add_messages
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.amp_tier import add_amp_tier_to_df_rowwise
+from benchmarks.amp_tier import make_annotated_table
+import ClinicalTrialsIndexer
+import PubMedIndexer
+
+AGENT_FILES = {
+    'cli': os.path.join(REPO_DIR, 'OncoVarAgent.py'),
+    'backend': os.path.join(REPO_DIR, 'OncoVarAgent_Streamlit', 'backend', 'OncoVarAgent.py'),
+}
+
+# The agents build their LLM clients at import time; placeholder settings are enough as no request is sent
+for name, value in [('LLM_API_KEY', 'test'), ('LLM_BASE_URL', 'http://localhost'), ('MODEL_NAME', 'test'),
+                    ('LLM_API_TOKEN', 'test'), ('LLM_API_URL', 'http://localhost'), ('LLM_MODEL', 'test')]:
+    os.environ.setdefault(name, value)
+
+_modules = {}
+
+
+@pytest.fixture(params=sorted(AGENT_FILES))
+def agent(request):
+    if request.param not in _modules:
+        spec = importlib.util.spec_from_file_location('OncoVarAgent_' + request.param, AGENT_FILES[request.param])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[request.param] = module
+    return _modules[request.param]
+
+
+def test_fan_out_variants(agent):
+    variants = [
+        {'Hugo_Symbol': 'KRAS', 'HGVSp_Short': 'p.G12C'},
+        {'Hugo_Symbol': 'TP53', 'HGVSp_Short': ''},
+        {'Hugo_Symbol': 'kras', 'HGVSp_Short': 'G12C'},
+        {'Hugo_Symbol': 'TP53', 'HGVSp_Short': None},
+        {'Hugo_Symbol': 'BRAF', 'HGVSp_Short': 'p.V600E'},
+        {'Hugo_Symbol': 'TP53', 'HGVSp_Short': 'p.'},
+        {'Hugo_Symbol': 'KRAS', 'HGVSp_Short': 'p.G12C'},
+    ]
+    sends = agent.fan_out_variants({'patient_info': {'cancer_type': 'LUAD'}, 'variants_to_process': variants})
+
+    # Recurrent hotspots are researched once, rows without a protein change each get their own branch
+    assert [send.arg['variant_indices'] for send in sends] == [[0, 2, 6], [1], [3], [4], [5]]
+    assert all(send.node == 'process_variant' for send in sends)
+    assert [send.arg['current_variant_info'] for send in sends] == [variants[i] for i in [0, 1, 3, 4, 5]]
+
+    assert agent.fan_out_variants({'patient_info': {}, 'variants_to_process': []}) == 'final_combiner'
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_token_bucket_spacing(agent, tmp_path, shared):
+    rate = 20
+    bucket = agent.TokenBucket(rate, capacity=1, state_file=str(tmp_path / 'ncbi.state') if shared else None)
+    times = []
+    for _ in range(6):
+        bucket.acquire()
+        times.append(time.time())
+
+    # A single-token bucket never bursts: consecutive requests are at least 1/rate apart
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / rate - 0.005
+    assert times[-1] - times[0] >= 5 / rate - 0.005
+    assert agent.NCBI_RATE_LIMITER.capacity == 1
+
+
+def test_tool_call_succeeded(agent):
+    assert agent.tool_call_succeeded('{"status": "success", "articles": []}')
+    assert agent.tool_call_succeeded('{"status": "no results found", "articles": []}')
+    assert not agent.tool_call_succeeded('{"status": "error", "message": "PubMed search failed: 429"}')
+    assert not agent.tool_call_succeeded('CRITICAL ERROR: OncoKB annotator failed.')
+    assert not agent.tool_call_succeeded("Error: ConnectionError('network is unreachable')")
+
+
+def test_research_cache_creates_its_directory(agent, tmp_path):
+    cache_path = str(tmp_path / 'cache' / 'oncovaragent' / 'research_cache.sqlite')
+    variant = {'Hugo_Symbol': 'BRAF', 'HGVSp_Short': 'p.V600E'}
+    key = agent.research_cache_key(variant, 'MEL', 'model', 'task')
+    assert agent.load_cached_research(cache_path, key, 30) is None
+
+    agent.store_cached_research(cache_path, key, variant, 'MEL', 'model', {'summarized_evidence': 'text'})
+    assert agent.load_cached_research(cache_path, key, 30) == {'summarized_evidence': 'text'}
+
+
+def test_aclose_http_clients(agent):
+    if not hasattr(agent, 'aclose_http_clients'):
+        pytest.skip('only the Streamlit backend uses an async HTTP client')
+
+    async def run():
+        client = agent._get_async_http_client()
+        assert agent._get_async_http_client() is client
+        await agent.aclose_http_clients()
+        await agent.aclose_http_clients()
+        return client
+
+    client = asyncio.run(run())
+    assert client.is_closed
+    assert len(agent._async_http_clients) == 0
+
+
+def test_parse_clinical_trials_payload_stats(agent):
+    summary = 'Osimertinib in EGFR mutant lung cancer. ' * 50
+    data = {'totalCount': 1, 'studies': [{'protocolSection': {
+        'identificationModule': {'nctId': 'NCT00000001', 'briefTitle': 'Title'},
+        'descriptionModule': {'briefSummary': summary}}}]}
+
+    # Texts are kept whole unless compact mode is asked for; only measured numbers are reported
+    result = agent.parse_clinical_trials(data, 5000)
+    assert result['trials'][0]['brief_summary'] == summary
+    assert result['payload_stats'] == {'downloaded_bytes': 5000, 'truncated_chars': 0}
+
+    result = agent.parse_clinical_trials(data, text_limit=100)
+    assert len(result['trials'][0]['brief_summary']) <= 100 + len(' ...[truncated]')
+    assert result['payload_stats']['truncated_chars'] == len(summary) - len(result['trials'][0]['brief_summary'])
+
+    # Compacted history keeps the trial digest but not the payload statistics
+    digest = json.loads(agent.digest_tool_output('query_clinical_trials', json.dumps(result)))
+    assert 'payload_stats' not in digest
+    assert digest['trials'][0]['nct_id'] == 'NCT00000001'
+
+
+@pytest.mark.parametrize('level_keys', [['1', '2', '3A', '3B', '4', 'R1', 'R2'], ['3A', 'R2'], []])
+def test_add_amp_tier_to_df_matches_rowwise(agent, level_keys):
+    table = make_annotated_table(3000, seed=len(level_keys), level_keys=level_keys, level_fill=0.3)
+    tables = [table, table.drop(columns='ONCOGENIC'), table.set_index(pd.Index(np.arange(len(table))[::-1] * 7))]
+    for df in tables:
+        expected = add_amp_tier_to_df_rowwise(df.copy(), agent.LEVEL_PRECEDENCE, agent.ONCOKB_TO_AMP_MAPPING)
+        pd.testing.assert_frame_equal(agent.add_amp_tier_to_df(df.copy()), expected)
+
+
+def make_study(nct_id, intervention, condition, status='RECRUITING'):
+    return {'protocolSection': {
+        'identificationModule': {'nctId': nct_id, 'briefTitle': f'{intervention} in {condition}'},
+        'designModule': {'studyType': 'INTERVENTIONAL', 'phases': ['PHASE2']},
+        'statusModule': {'overallStatus': status},
+        'conditionsModule': {'conditions': [condition]},
+        'armsAndInterventionsModule': {'interventions': [{'type': 'DRUG', 'name': intervention}]}}}
+
+
+def test_local_trials_report_total_found(agent, tmp_path, monkeypatch):
+    export = tmp_path / 'studies.jsonl'
+    studies = [make_study(f'NCT0000000{i}', 'Sotorasib', 'Non-Small Cell Lung Cancer') for i in range(4)]
+    studies += [make_study('NCT00000010', 'Sotorasib', 'Colorectal Cancer'),
+                make_study('NCT00000011', 'Sotorasib', 'Non-Small Cell Lung Cancer', status='COMPLETED')]
+    export.write_text('\n'.join(json.dumps(study) for study in studies))
+    db_path = str(tmp_path / 'trials.sqlite')
+    conn = ClinicalTrialsIndexer.open_store(db_path)
+    assert ClinicalTrialsIndexer.ingest_file(conn, str(export)) == 6
+    conn.close()
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_LOCAL_DB', db_path)
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_BACKEND', 'local')
+
+    # total_found counts every active match, not just the max_results returned
+    result = agent._search_local_trials_first('sotorasib', 'lung cancer', None, 2, 'Active', 'Interventional')
+    assert len(result['trials']) == 2
+    assert result['total_found'] == 4
+    assert result['trials'][0]['phase'] == 'PHASE2'
+
+    result = agent._search_local_trials_first('sotorasib', None, None, 10, 'Active', 'Interventional')
+    assert len(result['trials']) == result['total_found'] == 5
+    assert agent._search_local_trials_first('osimertinib', None, None, 10, 'Active', 'Interventional')['trials'] == []
+
+
+def test_annotate_in_process_keeps_its_token(agent, tmp_path, monkeypatch):
+    # Stand-in for AnnotatorCore, whose token is a module global read while annotating
+    core = types.ModuleType('AnnotatorCore')
+    core.token = None
+    core.setoncokbapitoken = lambda token: setattr(core, 'token', token)
+    core.validate_oncokb_token = lambda: None
+
+    def annotatealterationrecords(records, tumor_type, cancer_type_map, include_descriptions=False):
+        token = core.token
+        time.sleep(0.05)
+        return [{**record, 'token': core.token if core.token == token else 'switched'} for record in records]
+    core.annotatealterationrecords = annotatealterationrecords
+    monkeypatch.setitem(sys.modules, 'AnnotatorCore', core)
+
+    maf = tmp_path / 'variants.maf'
+    maf.write_text('Hugo_Symbol\tHGVSp_Short\nBRAF\tp.V600E\n')
+    tokens = {}
+
+    def annotate(token):
+        df = agent.annotate_in_process(str(maf), 'MEL', str(tmp_path / 'MafAnnotator.py'), token)
+        tokens[token] = df['token'].tolist()
+
+    threads = [threading.Thread(target=annotate, args=(f'token-{i}',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == {f'token-{i}': [f'token-{i}'] for i in range(4)}
+
+
+PUBMED_ARTICLES = [
+    ('1', 'Sotorasib in KRAS G12C mutated non-small cell lung cancer', 'KRAS p.G12C inhibition with sotorasib.'),
+    ('2', 'Adagrasib for KRAS G12C colorectal cancer', 'Adagrasib combined with cetuximab.'),
+    ('3', 'EGFR inhibitor resistance in lung adenocarcinoma', 'Osimertinib resistance mechanisms.'),
+    ('4', 'BRAF V600E melanoma treated with dabrafenib', 'Dabrafenib inhibits BRAF.'),
+    ('5', 'BRAF V600E colorectal cancer', 'Encorafenib plus cetuximab.'),
+    ('6', 'TP53 mutation and prognosis', 'TP53 variants in ALK-positive NSCLC.'),
+]
+
+
+def make_pubmed_store(db_path):
+    conn = PubMedIndexer.open_store(db_path)
+    conn.executemany(PubMedIndexer.UPSERT_SQL, [(pmid, title, abstract, 2024) for pmid, title, abstract in PUBMED_ARTICLES])
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('query,pmids', [
+    ('KRAS G12C AND (sotorasib OR adagrasib)', ['1', '2']),
+    ('"non-small cell lung cancer"[tiab] AND KRAS[Gene]', ['1']),
+    ('EGFR inhibit* resistance', ['3']),
+    ('BRAF p.V600E NOT melanoma', ['5']),
+    ('(BRAF OR KRAS) AND cetuximab', ['2', '5']),
+    ('TP53[Gene] AND (mutation[tiab] OR variant)', ['6']),
+    ('ALK-positive NSCLC', ['6']),
+    ('dabrafenib OR encorafenib', ['4', '5']),
+])
+def test_pubmed_query_to_fts5(agent, query, pmids):
+    conn = make_pubmed_store(':memory:')
+    expression = agent.pubmed_query_to_fts5(query)
+    rows = conn.execute("SELECT a.pmid FROM articles_fts JOIN articles a ON a.rowid = articles_fts.rowid "
+                        "WHERE articles_fts MATCH ?", (expression,)).fetchall()
+    assert sorted(pmid for (pmid,) in rows) == pmids
+
+
+def test_search_local_pubmed(agent, tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'pubmed.sqlite')
+    make_pubmed_store(db_path).close()
+    monkeypatch.setattr(agent, 'PUBMED_LOCAL_DB', db_path)
+
+    articles = agent.search_local_pubmed('KRAS G12C AND (sotorasib OR adagrasib)', 5)
+    assert sorted(a['support_literatures'] for a in articles) == ['1', '2']
+    assert {a['title'] for a in articles} == {PUBMED_ARTICLES[0][1], PUBMED_ARTICLES[1][1]}
+    assert len(agent.search_local_pubmed('KRAS G12C', 1)) == 1
+
+    # Unbalanced parentheses and dangling operators are invalid FTS5; every term is then required
+    conn = make_pubmed_store(':memory:')
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("SELECT * FROM articles_fts WHERE articles_fts MATCH ?", (agent.pubmed_query_to_fts5('KRAS AND (sotorasib'),))
+    for query in ['KRAS AND (sotorasib', 'cetuximab OR BRAF) colorectal', 'AND KRAS G12C AND']:
+        assert agent.search_local_pubmed(query, 5), query
+    assert agent.search_local_pubmed('osimertinib AND (melanoma', 5) == []
+
+
+def test_pubmed_cache_get_search(agent, tmp_path):
+    db_path = str(tmp_path / 'pubmed_cache.sqlite')
+    cache = agent.PubMedCache(db_path, 10, search_ttl_hours=1)
+    pmids = [str(pmid) for pmid in range(20)]
+    assert cache.get_search('KRAS G12C', 5) is None
+
+    # A larger cached search answers a smaller one with its first hits; the query is normalized
+    cache.put_search('KRAS  G12C AND Sotorasib', 20, pmids)
+    assert cache.get_search('kras g12c AND sotorasib', 5) == pmids[:5]
+    assert cache.get_search('KRAS G12C AND sotorasib', 20) == pmids
+    assert cache.get_search('KRAS G12C OR sotorasib', 5) is None
+
+    # A smaller one cannot answer a larger one, unless it already returned every hit
+    cache.put_search('BRAF V600E', 5, pmids[:5])
+    assert cache.get_search('BRAF V600E', 3) == pmids[:3]
+    assert cache.get_search('BRAF V600E', 10) is None
+    cache.put_search('ALK fusion', 5, pmids[:2])
+    assert cache.get_search('ALK fusion', 10) == pmids[:2]
+
+    # Searches older than the TTL are ignored
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE pubmed_searches SET created_at = created_at - 3601 WHERE query = ?",
+                     (agent.normalize_pubmed_query('BRAF V600E'),))
+    conn.close()
+    assert cache.get_search('BRAF V600E', 3) is None
+    assert cache.get_search('ALK fusion', 10) == pmids[:2]
+    assert agent.PubMedCache(None, 10, 1).get_search('ALK fusion', 10) is None
+
+
+def tool_step(step, name, output):
+    call_id = f'call_{step}'
+    return [AIMessage(content='', tool_calls=[{'name': name, 'args': {'query': f'query {step}'}, 'id': call_id}]),
+            ToolMessage(content=json.dumps(output), name=name, tool_call_id=call_id)]
+
+
+def test_compact_history(agent, monkeypatch):
+    abstract = 'KRAS G12C is a driver. ' * 40 + 'Sotorasib improved survival.'
+    articles = {'status': 'success', 'articles': [{'title': 'T', 'abstract': abstract, 'support_literatures': '1'}]}
+    trials = {'status': 'success', 'total_found': 1, 'trials': [{'nct_id': 'NCT00000001', 'title': 'T', 'status': 'RECRUITING',
+              'phase': 'PHASE2', 'interventions': [{'type': 'DRUG', 'name': 'Sotorasib'}],
+              'brief_summary': abstract, 'eligibility_criteria_text': abstract}],
+              'payload_stats': {'downloaded_bytes': 1000, 'truncated_chars': 0}}
+    messages = add_messages([HumanMessage(content='Research KRAS G12C')],
+                            tool_step(1, 'pubmed_search', articles) + tool_step(2, 'query_clinical_trials', trials) +
+                            tool_step(3, 'pubmed_search', articles))
+    originals, ids = [m.content for m in messages], [m.id for m in messages]
+
+    # Two full tool steps are kept when asked for; with one, both earlier results are digested in place
+    monkeypatch.setattr(agent, 'REACT_FULL_TOOL_STEPS', 2)
+    assert [p['tool_call_id'] for p in agent.compact_history({'messages': messages})['tool_payloads']] == ['call_1']
+    monkeypatch.setattr(agent, 'REACT_FULL_TOOL_STEPS', 1)
+    update = agent.compact_history({'messages': messages})
+    assert [p['content'] for p in update['tool_payloads']] == [originals[2], originals[4]]
+    messages = add_messages(messages, update['messages'])
+    assert [m.id for m in messages] == ids
+    assert [bool(m.additional_kwargs.get('compacted')) for m in messages] == [False, False, True, False, True, False, False]
+    assert messages[6].content == originals[6]
+    pubmed_digest, trials_digest = json.loads(messages[2].content), json.loads(messages[4].content)
+    assert pubmed_digest['articles'] == [{'pmid': '1', 'title': 'T', 'key_sentences': ['KRAS G12C is a driver.', 'Sotorasib improved survival.']}]
+    assert trials_digest['trials'][0]['interventions'] == 'Sotorasib'
+    assert 'brief_summary' not in trials_digest['trials'][0]
+
+    # The next step only digests the result that just fell out of the window
+    messages = add_messages(messages, tool_step(4, 'query_clinical_trials', trials))
+    update = agent.compact_history({'messages': messages})
+    assert [p['tool_call_id'] for p in update['tool_payloads']] == ['call_3']
+    assert update['tool_payloads'][0]['content'] == originals[6]
+    assert [m.id for m in update['messages']] == [messages[6].id]
+
+    # Nothing left to compact, and a single tool step is never compacted
+    messages = add_messages(messages, update['messages'])
+    assert agent.compact_history({'messages': messages}) == {}
+    assert agent.compact_history({'messages': messages[:3]}) == {}
+
+
+class FakeResponse:
+    def __init__(self, page):
+        self.page, self.content = page, json.dumps(page).encode()
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.page
+
+
+def test_clinical_trials_pagination(agent, monkeypatch):
+    pages = {
+        None: {'totalCount': 3, 'nextPageToken': 'page-2',
+               'studies': [make_study('NCT00000001', 'Sotorasib', 'NSCLC'), make_study('NCT00000002', 'Sotorasib', 'NSCLC')]},
+        'page-2': {'studies': [make_study('NCT00000002', 'Sotorasib', 'NSCLC'), make_study('NCT00000003', 'Sotorasib', 'NSCLC')]},
+    }
+    requested = []
+
+    def http_get(url, params=None, stream=False):
+        requested.append(params.get('pageToken'))
+        return FakeResponse(pages[params.get('pageToken')])
+
+    async def ahttp_get(url, params=None, stream=False):
+        return http_get(url, params, stream)
+
+    monkeypatch.setattr(agent, 'http_get', http_get)
+    monkeypatch.setattr(agent, 'ahttp_get', ahttp_get, raising=False)
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_BACKEND', 'remote')
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_PAGE_CACHE', agent.ClinicalTrialsPageCache(16))
+    monkeypatch.setattr(agent.time, 'sleep', lambda seconds: None)
+    query = agent.query_clinical_trials.func
+
+    # nextPageToken is followed and the NCT ID repeated on page 2 is kept once
+    result = query(intervention='sotorasib', max_results=10)
+    assert requested == [None, 'page-2']
+    assert [t['nct_id'] for t in result['trials']] == ['NCT00000001', 'NCT00000002', 'NCT00000003']
+    assert result['total_found'] == 3
+    assert result['payload_stats']['downloaded_bytes'] == sum(len(FakeResponse(page).content) for page in pages.values())
+
+    # Cached pages are reused without a request, whatever max_results is
+    requested.clear()
+    result = query(intervention='sotorasib', max_results=2)
+    assert requested == []
+    assert [t['nct_id'] for t in result['trials']] == ['NCT00000001', 'NCT00000002']
+    assert result['payload_stats']['downloaded_bytes'] == 0
+
+    # Paging stops once max_results trials are collected, or after CLINICAL_TRIALS_MAX_PAGES pages
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_PAGE_CACHE', agent.ClinicalTrialsPageCache(16))
+    query(intervention='sotorasib', max_results=2)
+    assert requested == [None]
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_PAGE_CACHE', agent.ClinicalTrialsPageCache(16))
+    monkeypatch.setattr(agent, 'CLINICAL_TRIALS_MAX_PAGES', 1)
+    requested.clear()
+    assert len(query(intervention='sotorasib', max_results=10)['trials']) == 2
+    assert requested == [None]
+
+    if hasattr(agent, 'aiter_clinical_trials_pages'):
+        monkeypatch.setattr(agent, 'CLINICAL_TRIALS_PAGE_CACHE', agent.ClinicalTrialsPageCache(16))
+        monkeypatch.setattr(agent, 'CLINICAL_TRIALS_MAX_PAGES', 10)
+        requested.clear()
+        result = asyncio.run(agent.query_clinical_trials.coroutine(intervention='sotorasib', max_results=10))
+        assert requested == [None, 'page-2']
+        assert [t['nct_id'] for t in result['trials']] == ['NCT00000001', 'NCT00000002', 'NCT00000003']
+
+
+def test_deep_research_cache_runs_off_the_event_loop(agent, monkeypatch):
+    if not asyncio.iscoroutinefunction(agent.deep_research_node):
+        pytest.skip('only the Streamlit backend runs the research node on an event loop')
+    threads = []
+
+    def load_cached_research(cache_path, cache_key, ttl_days):
+        threads.append(threading.current_thread())
+        return {'summarized_evidence': 'cached'}
+    monkeypatch.setattr(agent, 'load_cached_research', load_cached_research)
+
+    state = {'current_variant_info': {'Hugo_Symbol': 'BRAF', 'HGVSp_Short': 'p.V600E', 'MUTATION_EFFECT': 'Gain-of-function',
+                                      'MUTATION_EFFECT_DESCRIPTION': ''},
+             'patient_info': {'cancer_type': 'MEL'}}
+    assert asyncio.run(agent.deep_research_node(state, {})) == {'summarized_evidence': 'cached'}
+    assert threads and threads[0] is not threading.main_thread()